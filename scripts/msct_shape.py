@@ -21,7 +21,7 @@ import math
 
 import numpy as np
 
-import tqdm
+from scipy import ndimage
 from skimage import measure, filters
 
 import sct_utils as sct
@@ -91,14 +91,165 @@ def properties2d(image, resolution=None):
     return sc_properties
 
 
+def _largest_component(patches):
+    """
+    Keep the largest connected component (8-connectivity) of each 2D patch, with a single labeling of the stack.
+    :param patches: numpy array (n, nx, ny): non-zero pixels are the foreground
+    :return: boolean numpy array (n, nx, ny)
+    """
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = True  # no connection between patches
+    labels, nb_labels = ndimage.label(patches != 0, structure=structure)
+    mask = np.zeros(patches.shape, dtype=bool)
+    if nb_labels == 0:
+        return mask
+    areas = np.bincount(labels.ravel())[1:]
+    # patch of each label (all the pixels of a label are in the same patch)
+    index_patch = np.broadcast_to(np.arange(len(patches))[:, np.newaxis, np.newaxis], patches.shape)
+    label_patch = ndimage.minimum(index_patch, labels, np.arange(1, nb_labels + 1)).astype(int)
+    # sort by patch then by area: the last label of each patch is the largest
+    order = np.lexsort((areas, label_patch))
+    is_last = np.append(label_patch[order][1:] != label_patch[order][:-1], True)
+    label_largest = np.zeros(len(patches), dtype=int)
+    label_largest[label_patch[order][is_last]] = order[is_last] + 1
+    return (labels == label_largest[:, np.newaxis, np.newaxis]) & (labels > 0)
+
+
+def _envelope(values, upper=True):
+    """
+    Concave majorant (upper=True) or convex minorant (upper=False) of the points (t, values[:, t]) of each row, by
+    repeatedly removing the points which are not strictly outside the chord between their neighbours.
+    :param values: numpy array (n, nt), NaN for missing points
+    :return: numpy array (n, nt): envelope evaluated at each t (NaN outside of the range of the points)
+    """
+    if not upper:
+        return -_envelope(-values, upper=True)
+    n, nt = values.shape
+    t = np.arange(nt)
+    rows = np.arange(n)[:, np.newaxis]
+    valid = ~np.isnan(values)
+
+    def neighbours(valid):
+        # index of the last valid point at or before t, and of the first valid point at or after t
+        prev_incl = np.maximum.accumulate(np.where(valid, t, -1), axis=1)
+        next_incl = np.minimum.accumulate(np.where(valid, t, nt)[:, ::-1], axis=1)[:, ::-1]
+        return prev_incl, next_incl
+
+    while True:
+        prev_incl, next_incl = neighbours(valid)
+        prev = np.column_stack((np.full(n, -1), prev_incl[:, :-1]))
+        next = np.column_stack((next_incl[:, 1:], np.full(n, nt)))
+        inner = valid & (prev >= 0) & (next < nt)
+        prev_c, next_c = np.clip(prev, 0, nt - 1), np.clip(next, 0, nt - 1)
+        with np.errstate(invalid='ignore'):
+            chord = values[rows, prev_c] + (values[rows, next_c] - values[rows, prev_c]) * (t - prev) / (next - prev)
+            remove = inner & (values <= chord + 1e-9)
+        if not remove.any():
+            break
+        valid &= ~remove
+
+    prev_incl, next_incl = neighbours(valid)
+    inside = (prev_incl >= 0) & (next_incl < nt)
+    prev_c, next_c = np.clip(prev_incl, 0, nt - 1), np.clip(next_incl, 0, nt - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(next_c > prev_c, (t - prev_c) / np.maximum(next_c - prev_c, 1), 0.)
+        envelope = values[rows, prev_c] + (values[rows, next_c] - values[rows, prev_c]) * weight
+    return np.where(inside, envelope, np.nan)
+
+
+def _convex_hull_area(mask):
+    """
+    Number of pixels of the convex hull of each 2D patch, computed as skimage.morphology.convex_hull_image does: hull of
+    the midpoints of the pixel edges, pixels whose center is inside the hull (or on its border). The hull is built
+    from the leftmost and rightmost pixels of each row, for all the patches at once.
+    :param mask: boolean numpy array (n, nx, ny)
+    :return: numpy array (n,)
+    """
+    n, nx, ny = mask.shape
+    any_x = mask.any(axis=1)
+    first = np.where(any_x, np.argmax(mask, axis=1), np.nan)
+    last = np.where(any_x, nx - 1 - np.argmax(mask[:, ::-1, :], axis=1), np.nan)
+    # points on a grid of half rows: odd indexes are the rows of pixels (t = 2 * y + 1), even indexes are the edges
+    # between rows
+    left = np.full((n, 2 * ny + 1), np.nan)
+    right = np.full((n, 2 * ny + 1), np.nan)
+    left[:, 1::2] = first - 0.5
+    right[:, 1::2] = last + 0.5
+    nan_column = np.full((n, 1), np.nan)
+    left[:, ::2] = np.fmin(np.column_stack((nan_column, first)), np.column_stack((first, nan_column)))
+    right[:, ::2] = np.fmax(np.column_stack((nan_column, last)), np.column_stack((last, nan_column)))
+    left = _envelope(left, upper=False)[:, 1::2]
+    right = _envelope(right, upper=True)[:, 1::2]
+    count = np.floor(right + 1e-9) - np.ceil(left - 1e-9) + 1
+    return np.nansum(np.maximum(count, 0), axis=1)
+
+
+def properties2d_batch(patches, resolution=None):
+    """
+    Shape properties of the largest object of each 2D patch, computed for all the patches at once from image moments.
+    Values are the same as properties2d (which uses skimage.measure.regionprops, with the conventions of
+    scikit-image 0.12 for the orientation).
+    :param patches: numpy array (n, nx, ny): first axis of each patch along X' (right-left), second along Y'
+      (antero-posterior)
+    :param resolution: [rx, ry]: pixel size in mm (assumed isotropic)
+    :return: dict of numpy arrays (n,) with keys: area, equivalent_diameter, minor_axis_length, major_axis_length,
+      ratio_minor_major, eccentricity, solidity, orientation (in deg). NaN for empty patches.
+    """
+    mask = _largest_component(patches)
+    n, nx, ny = mask.shape
+    x, y = np.arange(nx, dtype=float), np.arange(ny, dtype=float)
+    mask_f = mask.astype(float)
+    area = mask_f.sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # second order central moments, normalized by the area
+        sum_x, sum_y = mask_f.sum(axis=2), mask_f.sum(axis=1)
+        mean_x, mean_y = sum_x.dot(x) / area, sum_y.dot(y) / area
+        var_x = sum_x.dot(x ** 2) / area - mean_x ** 2
+        var_y = sum_y.dot(y ** 2) / area - mean_y ** 2
+        cov_xy = np.einsum('kij,i,j->k', mask_f, x, y) / area - mean_x * mean_y
+        # eigenvalues of the inertia tensor
+        delta = np.sqrt(4 * cov_xy ** 2 + (var_x - var_y) ** 2) / 2
+        l1, l2 = (var_x + var_y) / 2 + delta, np.maximum((var_x + var_y) / 2 - delta, 0)
+        major_l, minor_l = 4 * np.sqrt(l1), 4 * np.sqrt(l2)
+        ratio_minor_major = np.where(major_l > 0, minor_l / major_l, 0.)
+        eccentricity = np.where(l1 > 0, np.sqrt(1 - l2 / l1), 0.)
+        # angle between X' and the major axis, in the image transposed (as in properties2d)
+        orientation = np.where(var_x == var_y, np.where(cov_xy > 0, -math.pi / 4, math.pi / 4),
+                               -0.5 * np.arctan2(2 * cov_xy, var_x - var_y))
+        solidity = area / _convex_hull_area(mask)
+    diameter = np.sqrt(4 * area / math.pi)
+    if resolution is not None:
+        area = area * resolution[0] * resolution[1]
+        diameter, major_l, minor_l = diameter * resolution[0], major_l * resolution[0], minor_l * resolution[0]
+    properties = {'area': area,
+                  'equivalent_diameter': diameter,
+                  'minor_axis_length': minor_l,
+                  'major_axis_length': major_l,
+                  'ratio_minor_major': ratio_minor_major,
+                  'eccentricity': eccentricity,
+                  'solidity': solidity,
+                  'orientation': orientation * 180.0 / math.pi}
+    empty = ~mask.any(axis=(1, 2))
+    for key in properties:
+        properties[key] = np.where(empty, np.nan, properties[key])
+    return properties
+
+
 def assign_AP_and_RL_diameter(properties):
     """
     This script checks the orientation of the spinal cord and inverts axis if necessary to make sure the major axis is
     always labeled as right-left (RL), and the minor antero-posterior (AP).
-    :param properties: dictionary generated by properties2d()
+    :param properties: dictionary generated by properties2d() or properties2d_batch()
     :return: properties updated with new fields: AP_diameter, RL_diameter
     """
-    if -45.0 < properties['orientation'] < 45.0:
+    if isinstance(properties['orientation'], np.ndarray):
+        # output of properties2d_batch
+        is_major_rl = (-45.0 < properties['orientation']) & (properties['orientation'] < 45.0)
+        properties['RL_diameter'] = np.where(is_major_rl, properties['major_axis_length'],
+                                             properties['minor_axis_length'])
+        properties['AP_diameter'] = np.where(is_major_rl, properties['minor_axis_length'],
+                                             properties['major_axis_length'])
+    elif -45.0 < properties['orientation'] < 45.0:
         properties['RL_diameter'] = properties['major_axis_length']
         properties['AP_diameter'] = properties['minor_axis_length']
     else:
@@ -166,49 +317,29 @@ def compute_properties_along_centerline(im_seg, smooth_factor=5.0, interpolation
                             np.ones_like(x_centerline_deriv))
 
     sct.printv('Computing spinal cord shape along the spinal cord...')
-    with tqdm.tqdm(total=len(range(min_z_index, max_z_index))) as pbar:
-
-        # Extracting patches perpendicular to the spinal cord and computing spinal cord shape
-        i_centerline = 0  # index of the centerline() object
-        for iz in range(min_z_index, max_z_index-1):
-        # for index in range(centerline.number_of_points):  Julien
-            # value_out = -5.0
-            value_out = 0.0
-            # TODO: correct for angulation using the cosine. The current approach has 2 issues:
-            # - the centerline is not homogeneously sampled along z (which is the reason it is oversampled)
-            # - computationally expensive
-            # - requires resampling to higher resolution --> to check: maybe required with cosine approach
-            current_patch = centerline.extract_perpendicular_square(im_seg, i_centerline, size=size_patch,
-                                                                    resolution=resolution,
-                                                                    interpolation_mode=interpolation_mode,
-                                                                    border='constant', cval=value_out)
-
-            # check for pixels close to the spinal cord segmentation that are out of the image
-            patch_zero = np.copy(current_patch)
-            patch_zero[patch_zero == value_out] = 0.0
-            # patch_borders = dilation(patch_zero) - patch_zero
-
-            """
-            if np.count_nonzero(patch_borders + current_patch == value_out + 1.0) != 0:
-                c = image.transfo_phys2pix([centerline.points[index]])[0]
-                print('WARNING: no patch for slice', c[2])
-                continue
-            """
-            # compute shape properties on 2D patch
-            sc_properties = properties2d(patch_zero, [resolution, resolution])
-            # assign AP and RL to minor or major axis, depending on the orientation
-            sc_properties = assign_AP_and_RL_diameter(sc_properties)
-            # loop across properties and assign values for function output
-            if sc_properties is not None:
-                # properties['incremental_length'][iz] = centerline.incremental_length[i_centerline]
-                for property_name in property_list:
-                    properties[property_name][iz] = sc_properties[property_name]
-            else:
-                c = im_seg.transfo_phys2pix([centerline.points[i_centerline]])[0]
-                sct.printv('WARNING: no properties for slice', c[2])
-
-            i_centerline += 1
-            pbar.update(1)
+    # Extracting patches perpendicular to the spinal cord and computing spinal cord shape, for all slices at once
+    # TODO: correct for angulation using the cosine. The current approach has 2 issues:
+    # - the centerline is not homogeneously sampled along z (which is the reason it is oversampled)
+    # - computationally expensive
+    # - requires resampling to higher resolution --> to check: maybe required with cosine approach
+    list_z = np.arange(min_z_index, max_z_index - 1)
+    if len(list_z):
+        # index of the centerline() object
+        indexes_centerline = np.arange(len(list_z))
+        # pixels out of the image are set to 0
+        patches = centerline.extract_perpendicular_squares(im_seg, indexes_centerline, size=size_patch,
+                                                           resolution=resolution,
+                                                           interpolation_mode=interpolation_mode,
+                                                           border='constant', cval=0.0)
+        # compute shape properties on 2D patches
+        sc_properties = properties2d_batch(patches, [resolution, resolution])
+        # assign AP and RL to minor or major axis, depending on the orientation
+        sc_properties = assign_AP_and_RL_diameter(sc_properties)
+        for property_name in property_list:
+            properties[property_name][list_z] = sc_properties[property_name]
+        for i_centerline in np.where(np.isnan(sc_properties['area']))[0]:
+            c = im_seg.transfo_phys2pix([centerline.points[i_centerline]])[0]
+            sct.printv('WARNING: no properties for slice', c[2])
 
     # # smooth the spinal cord shape with a gaussian kernel if required
     # # TODO: remove this smoothing
@@ -16,7 +16,7 @@
 
 from __future__ import division, absolute_import
 
-from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis, zeros
+from numpy import dot, cross, array, einsum
 from numpy.linalg import norm, inv
 import numpy as np
 from scipy.spatial import cKDTree
@@ -180,10 +180,6 @@ class Centerline:
                  fname=None):
         # initialization of variables
         self.length = 0.0
-        self.progressive_length = [0.0]
-        self.progressive_length_inverse = [0.0]
-        self.incremental_length = [0.0]
-        self.incremental_length_inverse = [0.0]
 
         # variables used for vertebral distribution
         self.first_label, self.last_label = None, None
@@ -210,40 +206,60 @@ class Centerline:
             # Load centerline data from points and derivatives in parameters
             if points_x is None or points_y is None or points_z is None or deriv_x is None or deriv_y is None or deriv_z is None:
                 raise ValueError('Data must be provided to centerline to be initialized')
-            self.points = np.array(list(zip(points_x, points_y, points_z)))
-            self.derivatives = array(list(zip(deriv_x, deriv_y, deriv_z)))
+            self.points = np.column_stack((points_x, points_y, points_z)).astype(np.float64)
+            self.derivatives = np.column_stack((deriv_x, deriv_y, deriv_z)).astype(np.float64)
 
         self.number_of_points = len(self.points)
 
         # computation of centerline features, based on points and derivatives
         self.compute_length()
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
+        self.compute_coordinate_systems()
 
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
-
-        # initialization of KDTree for enabling computation of nearest points in centerline
-        self.tree_points = cKDTree(self.points)
+        # KDTree for enabling computation of nearest points in centerline (built the first time it is needed)
+        self._tree_points = None
 
         if self.compute_init_distribution:
             self.compute_vertebral_distribution(disks_levels=self.disks_levels, label_reference=self.label_reference)
 
+    @property
+    def tree_points(self):
+        """cKDTree of the centerline points, built once on first use."""
+        if self._tree_points is None:
+            self._tree_points = cKDTree(self.points)
+        return self._tree_points
+
     def compute_length(self):
-        for i in range(0, self.number_of_points - 1):
-            distance = np.sqrt((self.points[i][0] - self.points[i + 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i + 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i + 1][2]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-            self.incremental_length.append(self.incremental_length[-1] + distance)
-        for i in range(self.number_of_points - 1, 0, -1):
-            distance = np.sqrt((self.points[i][0] - self.points[i - 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i - 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i - 1][2]) ** 2)
-            self.progressive_length_inverse.append(distance)
-            self.incremental_length_inverse.append(self.incremental_length_inverse[-1] + distance)
+        """
+        Compute the distance between consecutive points (progressive_length, starting with 0), the cumulative length
+        from the first point (incremental_length), the same quantities from the last point (*_inverse) and the total
+        length.
+        """
+        distances = norm(np.diff(self.points, axis=0), axis=1)
+        self.progressive_length = np.concatenate(([0.0], distances))
+        self.progressive_length_inverse = np.concatenate(([0.0], distances[::-1]))
+        self.incremental_length = np.cumsum(self.progressive_length)
+        self.incremental_length_inverse = np.cumsum(self.progressive_length_inverse)
+        self.length = float(np.sum(distances))
+
+    def compute_coordinate_systems(self):
+        """
+        Compute the coordinate system (X', Y', Z') of the plane orthogonal to the centerline at each point, and the
+        parameters of the plane equations. Z' is the normalized derivative (the derivatives are normalized in place),
+        Y' is the projection of the Y axis on the plane and X' = Y' x Z'.
+        """
+        self.derivatives /= norm(self.derivatives, axis=1)[:, np.newaxis]
+        z_prime_axis = self.derivatives
+        y_prime_axis = np.array([0, 1, 0]) - z_prime_axis[:, [1]] * z_prime_axis
+        y_prime_axis /= norm(y_prime_axis, axis=1)[:, np.newaxis]
+        x_prime_axis = cross(y_prime_axis, z_prime_axis)
+        x_prime_axis /= norm(x_prime_axis, axis=1)[:, np.newaxis]
+        # the axes are the columns of the matrices
+        self.matrices = np.stack((x_prime_axis, y_prime_axis, z_prime_axis), axis=2)
+        self.inverse_matrices = inv(self.matrices)
+
+        # parameters [a, b, c, d] of the plane equations a*x + b*y + c*z + d = 0
+        self.offset_plans = - einsum('ij,ij->i', self.derivatives, self.points)
+        self.plans_parameters = np.column_stack((self.derivatives, self.offset_plans))
 
     def find_nearest_index(self, coord):
         """
@@ -280,16 +296,11 @@ class Centerline:
         :return: List of parameters [a, b, c, d], corresponding to plane parametric equation a*x + b*y + c*z + d = 0
         """
         if 0 <= index < self.number_of_points:
-            a = self.derivatives[index][0]
-            b = self.derivatives[index][1]
-            c = self.derivatives[index][2]
-            d = - (a * self.points[index][0] + b * self.points[index][1] + c * self.points[index][2])
+            return self.plans_parameters[index].tolist()
         else:
             raise IndexError('ERROR in msct_types.Centerline.get_plan_parameters: index (' + str(index) + ') should be '
                              'within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
 
-        return [a, b, c, d]
-
     def get_distance_from_plane(self, coord, index, plane_params=None):
         """
         This function returns the distance between a coordinate and the plan at index position.
@@ -300,7 +311,7 @@ class Centerline:
         from index.
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -336,19 +347,9 @@ class Centerline:
         """
         if 0 <= index < self.number_of_points:
             origin = self.points[index]
-            z_prime_axis = self.derivatives[index]
-            z_prime_axis /= norm(z_prime_axis)
-            y_axis = array([0, 1, 0])
-            y_prime_axis = (y_axis - dot(y_axis, z_prime_axis) * z_prime_axis)
-            y_prime_axis /= norm(y_prime_axis)
-            x_prime_axis = cross(y_prime_axis, z_prime_axis)
-            x_prime_axis /= norm(x_prime_axis)
-
-            matrix_base = array([[x_prime_axis[0], y_prime_axis[0], z_prime_axis[0]],
-                                 [x_prime_axis[1], y_prime_axis[1], z_prime_axis[1]],
-                                 [x_prime_axis[2], y_prime_axis[2], z_prime_axis[2]]])
-
-            inverse_matrix = inv(matrix_base)
+            matrix_base = self.matrices[index]
+            x_prime_axis, y_prime_axis, z_prime_axis = matrix_base.T
+            inverse_matrix = self.inverse_matrices[index]
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -363,7 +364,7 @@ class Centerline:
         :param plane_params:
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -372,7 +373,8 @@ class Centerline:
         return coord - dot(coord - self.points[index], n) * n
 
     def get_projected_coordinates_on_planes(self, coordinates, indexes):
-        return coordinates - multiply(tile(einsum('ij,ij->i', coordinates - self.points[indexes], self.derivatives[indexes]), (3, 1)).transpose(), self.derivatives[indexes])
+        derivatives = self.derivatives[indexes]
+        return coordinates - einsum('ij,ij->i', coordinates - self.points[indexes], derivatives)[:, np.newaxis] * derivatives
 
     def get_in_plane_coordinates(self, coord, index):
         """
@@ -383,17 +385,16 @@ class Centerline:
         :return:
         """
         if 0 <= index < self.number_of_points:
-            origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix = self.coordinate_system[index]
-            return inverse_matrix.dot(coord - origin)
+            return self.inverse_matrices[index].dot(coord - self.points[index])
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
 
     def get_in_plans_coordinates(self, coordinates, indexes):
-        return einsum('mnr,nr->mr', rollaxis(self.inverse_matrices[indexes], 0, 3), (coordinates - self.points[indexes]).transpose()).transpose()
+        return einsum('ijk,ik->ij', self.inverse_matrices[indexes], coordinates - self.points[indexes])
 
     def get_inverse_plans_coordinates(self, coordinates, indexes):
-        return einsum('mnr,nr->mr', rollaxis(self.matrices[indexes], 0, 3), coordinates.transpose()).transpose() + self.points[indexes]
+        return einsum('ijk,ik->ij', self.matrices[indexes], coordinates) + self.points[indexes]
 
     def compute_vertebral_distribution(self, disks_levels, label_reference='C1'):
         """
@@ -426,10 +427,8 @@ class Centerline:
         if not is_C2_here and C1 is not None and C3 is not None:
             disks_levels.append([(C1[0] + C3[0]) / 2.0, (C1[1] + C3[1]) / 2.0, (C1[2] + C3[2]) / 2.0, 2])
 
-        labels_points = [0] * self.number_of_points
         self.l_points = [0] * self.number_of_points
-        self.dist_points = [0] * self.number_of_points
-        self.dist_points_rel = [0] * self.number_of_points
+        self.dist_points_rel = np.zeros(self.number_of_points)
         self.index_disk, index_disk_inv = {}, []
 
         # extracting each level based on position and computing its nearest point along the centerline
@@ -439,7 +438,6 @@ class Centerline:
                 coord_level = [level[0], level[1], level[2]]
                 disk = self.regions_labels[str(int(level[3]))]
                 nearest_index = self.find_nearest_index(coord_level)
-                labels_points[nearest_index] = disk + '-0.0'
                 self.index_disk[disk] = nearest_index
                 index_disk_inv.append([nearest_index, disk])
 
@@ -465,9 +463,8 @@ class Centerline:
         index_disk_inv.append([0, 'bottom'])
         index_disk_inv = sorted(index_disk_inv, key=itemgetter(0))
 
-        progress_length = zeros(self.number_of_points)
-        for i in range(self.number_of_points - 1):
-            progress_length[i + 1] = progress_length[i] + self.progressive_length[i]
+        # cumulative length, shifted by one point
+        progress_length = np.concatenate(([0.0], np.cumsum(self.progressive_length[:-1])))
 
         self.label_reference = label_reference
         if self.label_reference not in self.index_disk:
@@ -484,47 +481,51 @@ class Centerline:
             self.distance_from_C1label[disk] = progress_length[self.index_disk[self.label_reference]] - progress_length[self.index_disk[disk]]
 
         for i in range(1, len(index_disk_inv)):
-            for j in range(index_disk_inv[i - 1][0], index_disk_inv[i][0]):
-                self.l_points[j] = index_disk_inv[i][1]
-
-        for i in range(self.number_of_points):
-            self.dist_points[i] = progress_length[self.index_disk[self.label_reference]] - progress_length[i]
-
-        for i in range(self.number_of_points):
-            current_label = self.l_points[i]
-
+            index_start, index_end = index_disk_inv[i - 1][0], index_disk_inv[i][0]
+            self.l_points[index_start:index_end] = [index_disk_inv[i][1]] * (index_end - index_start)
+
+        self.dist_points = progress_length[self.index_disk[self.label_reference]] - progress_length
+
+        # relative position of each point within its vertebral level (all points of a level are processed at once)
+        dist = self.dist_points
+        rank_first, rank_last = self.list_labels.index(self.first_label), self.list_labels.index(self.last_label)
+        array_labels = np.array(self.l_points, dtype=object)
+        for label in set(self.l_points):
+            indexes = array_labels == label
+            current_label = label
             if current_label == 0:
                 if 'PMG' in self.index_disk:
-                    self.dist_points_rel[i] = self.dist_points[i] - self.dist_points[self.index_disk['PMG']]
+                    self.dist_points_rel[indexes] = dist[indexes] - dist[self.index_disk['PMG']]
                     continue
                 else:
                     current_label = 'PMG'
 
-            if self.list_labels.index(self.labels_regions[current_label]) < self.list_labels.index(self.first_label):
-                reference_level_position = self.dist_points[self.index_disk[self.regions_labels[str(self.first_label)]]]
-                self.dist_points_rel[i] = self.dist_points[i] - reference_level_position
+            rank_current = self.list_labels.index(self.labels_regions[current_label])
+            if rank_current < rank_first:
+                reference_level_position = dist[self.index_disk[self.regions_labels[str(self.first_label)]]]
+                self.dist_points_rel[indexes] = dist[indexes] - reference_level_position
 
-            elif self.list_labels.index(self.labels_regions[current_label]) >= self.list_labels.index(self.last_label):
-                reference_level_position = self.dist_points[self.index_disk[self.regions_labels[str(self.last_label)]]]
-                self.dist_points_rel[i] = self.dist_points[i] - reference_level_position
+            elif rank_current >= rank_last:
+                reference_level_position = dist[self.index_disk[self.regions_labels[str(self.last_label)]]]
+                self.dist_points_rel[indexes] = dist[indexes] - reference_level_position
 
             else:
-                index_current_label = self.list_labels.index(self.labels_regions[self.l_points[i]])
-
-                if self.list_labels.index(self.first_label) <= index_current_label < self.list_labels.index(self.last_label):
-                    next_label = self.regions_labels[str(self.list_labels[index_current_label + 1])]
-
-                    if current_label in ['PMJ', 'PMG']:
-                        if next_label in self.index_disk:
-                            self.dist_points_rel[i] = - (self.dist_points[i] - self.dist_points[self.index_disk[next_label]]) / abs(self.dist_points[self.index_disk[next_label]] - self.dist_points[self.index_disk[current_label]])
-                        else:
-                            self.dist_points_rel[i] = (self.average_vert_length[current_label] - self.dist_points[i] + self.dist_points[self.index_disk[current_label]]) / self.average_vert_length[current_label]
+                next_label = self.regions_labels[str(self.list_labels[rank_current + 1])]
+                dist_current = dist[self.index_disk[current_label]]
+                if current_label in ['PMJ', 'PMG']:
+                    if next_label in self.index_disk:
+                        dist_next = dist[self.index_disk[next_label]]
+                        self.dist_points_rel[indexes] = - (dist[indexes] - dist_next) / abs(dist_next - dist_current)
+                    else:
+                        self.dist_points_rel[indexes] = (self.average_vert_length[current_label] - dist[indexes] +
+                                                         dist_current) / self.average_vert_length[current_label]
+                else:
+                    if next_label in self.index_disk:
+                        dist_next = dist[self.index_disk[next_label]]
+                        self.dist_points_rel[indexes] = (dist[indexes] - dist_current) / abs(dist_next - dist_current)
                     else:
-                        next_label = self.regions_labels[str(self.list_labels[self.list_labels.index(self.labels_regions[self.l_points[i]]) + 1])]
-                        if next_label in self.index_disk:
-                            self.dist_points_rel[i] = (self.dist_points[i] - self.dist_points[self.index_disk[current_label]]) / abs(self.dist_points[self.index_disk[next_label]] - self.dist_points[self.index_disk[current_label]])
-                        else:
-                            self.dist_points_rel[i] = (self.dist_points[i] - self.dist_points[self.index_disk[current_label]]) / self.average_vert_length[current_label]
+                        self.dist_points_rel[indexes] = (dist[indexes] - dist_current) / \
+                                                        self.average_vert_length[current_label]
 
     def get_closest_to_relative_position(self, vertebral_level, relative_position, mode='levels'):
         """
@@ -623,12 +624,30 @@ class Centerline:
     def extract_perpendicular_square(self, image, index, size=20, resolution=0.5, interpolation_mode=0, border='constant', cval=0.0):
         # TODO: use native resolution instead of forcing to 0.5. In case native is much higher res, we loose precision!!!
         # TODO: replace with existing function (if exists). There is a lot of arbitrary params in there
+        return self.extract_perpendicular_squares(image, [index], size=size, resolution=resolution,
+                                                  interpolation_mode=interpolation_mode, border=border, cval=cval)[0]
+
+    def extract_perpendicular_squares(self, image, indexes, size=20, resolution=0.5, interpolation_mode=0,
+                                      border='constant', cval=0.0):
+        """
+        Resample the squares perpendicular to the centerline at several points, with a single interpolation.
+        :param image: Image
+        :param indexes: list of int: indexes of the centerline points
+        :param size: float: half size of the squares, in mm
+        :param resolution: float: in mm
+        :return: numpy array of shape (len(indexes), n, n). The first axis of each square is along X', the second
+          along Y' (see compute_coordinate_systems).
+        """
         x_grid, y_grid, z_grid = np.mgrid[-size:size:resolution, -size:size:resolution, 0:1]
-        coordinates_grid = np.array(list(zip(x_grid.ravel(), y_grid.ravel(), z_grid.ravel())))
-        coordinates_phys = self.get_inverse_plans_coordinates(coordinates_grid, np.array([index] * len(coordinates_grid)))
-        coordinates_im = image.transfo_phys2pix(coordinates_phys, real=False)
-        square = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border, cval=cval)
-        return square.reshape((len(x_grid), len(x_grid)))
+        coordinates_grid = np.column_stack((x_grid.ravel(), y_grid.ravel(), z_grid.ravel()))
+        indexes = np.asarray(indexes, dtype=int)
+        # physical coordinates of the grid in the plane of each point: shape (len(indexes), len(grid), 3)
+        coordinates_phys = einsum('kij,gj->kgi', self.matrices[indexes], coordinates_grid) + \
+            self.points[indexes][:, np.newaxis, :]
+        coordinates_im = image.transfo_phys2pix(coordinates_phys.reshape(-1, 3), real=False)
+        squares = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border,
+                                   cval=cval)
+        return squares.reshape((len(indexes), len(x_grid), len(x_grid)))
 
     def save_centerline(self, image=None, fname_output='centerline.sct'):
         if image is not None:
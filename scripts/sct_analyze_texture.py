@@ -22,6 +22,7 @@ from skimage.feature import greycomatrix, greycoprops
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.roi import run_in_roi
 from msct_parser import Parser
 
 def get_parser():
@@ -109,7 +110,7 @@ class ExtractGLCM:
             text_name = m[0] if m[0].upper() != 'asm'.upper() else m[0].upper()
             self.metric_lst.append(text_name + '_' + str(self.param_glcm.distance) + '_' + str(m[1]))
 
-        # dct_im_seg{'im': list_of_axial_slice, 'seg': list_of_axial_masked_slice}
+        # dct_im_seg{'im': Image, 'seg': Image}, re-oriented for the extraction
         self.dct_im_seg = {'im': None, 'seg': None}
 
         # to re-orient the data at the end if needed
@@ -192,71 +193,66 @@ class ExtractGLCM:
             im.change_orientation(self.orientation_extraction)
             seg.change_orientation(self.orientation_extraction)
 
-        # extract axial slices in self.dct_im_seg
-        self.dct_im_seg['im'], self.dct_im_seg['seg'] = [im.data[:, :, z] for z in range(im.dim[2])], [seg.data[:, :, z] for z in range(im.dim[2])]
-
-    # def init_metric_im(self):
-    #     # open image and re-orient it to RPI if needed
-    #     im_tmp = Image(self.param.fname_im)
-    #     if self.orientation_im != self.orientation_extraction:
-    #         im_tmp = msct_image.change_orientation(im_tmp, self.orientation_extraction)
-
-    #     # create Image objects with zeros values for each output image needed
-    #     for m in self.metric_lst:
-    #         im_2save = msct_image.zeros_like(im_tmp, dtype=np.float64)
-    #         fname_out = sct.add_suffix(''.join(sct.extract_fname(self.param.fname_im)[1:]), '_' + m)
-    #         im_2save.save(fname_out)
-    #         self.fname_metric_lst[m] = fname_out
+        # images are kept in self.dct_im_seg, slices are extracted within the bounding box of the mask in
+        # compute_texture_roi()
+        self.dct_im_seg['im'], self.dct_im_seg['seg'] = im, seg
 
     def compute_texture(self):
 
         offset = int(self.param_glcm.distance)
         sct.printv('\nCompute texture metrics...', self.param.verbose, 'normal')
 
-        # open image and re-orient it to RPI if needed
-        im_tmp = Image(self.param.fname_im)
-        if self.orientation_im != self.orientation_extraction:
-            im_tmp.change_orientation(self.orientation_extraction)
+        # texture is only computed within the mask: crop the data around the mask (padded by the GLCM distance), and
+        # paste the results back in the original space
+        im, seg = self.dct_im_seg['im'], self.dct_im_seg['seg']
+        im_metric_lst = run_in_roi(self.compute_texture_roi, [im, seg], seg, pad=offset)
+
+        for m, im_metric in zip(self.metric_lst, im_metric_lst):
+            fname_out = sct.add_suffix(''.join(sct.extract_fname(self.param.fname_im)[1:]), '_' + m)
+            im_metric.save(fname_out)
+            self.fname_metric_lst[m] = fname_out
+
+    def compute_texture_roi(self, im, seg):
+        """
+        Compute the texture metrics, slice by slice
+        :param im: Image cropped around the mask
+        :param seg: mask, cropped the same way as im
+        :return: list of Images (one per metric of self.metric_lst), on the cropped grid
+        """
+        offset = int(self.param_glcm.distance)
 
         dct_metric = {}
         for m in self.metric_lst:
-            im_2save = msct_image.zeros_like(im_tmp, dtype='float64')
-            dct_metric[m] = im_2save
-            # dct_metric[m] = Image(self.fname_metric_lst[m])
+            dct_metric[m] = msct_image.zeros_like(im, dtype='float64')
 
         with tqdm.tqdm() as pbar:
-            for im_z, seg_z, zz in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'], range(len(self.dct_im_seg['im']))):
-                for xx in range(im_z.shape[0]):
-                    for yy in range(im_z.shape[1]):
-                        if not seg_z[xx, yy]:
-                            continue
-                        if xx < offset or yy < offset:
-                            continue
-                        if xx > (im_z.shape[0] - offset - 1) or yy > (im_z.shape[1] - offset - 1):
-                            continue  # to check if the whole glcm_window is in the axial_slice
-                        if False in np.unique(seg_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]):
-                            continue  # to check if the whole glcm_window is in the mask of the axial_slice
-
-                        glcm_window = im_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]
-                        glcm_window = glcm_window.astype(np.uint8)
-
-                        dct_glcm = {}
-                        for a in self.param_glcm.angle.split(','):  # compute the GLCM for self.param_glcm.distance and for each self.param_glcm.angle
-                            dct_glcm[a] = greycomatrix(glcm_window,
-                                                       [self.param_glcm.distance], [np.radians(int(a))],
-                                                       symmetric=self.param_glcm.symmetric,
-                                                       normed=self.param_glcm.normed)
-
-                        for m in self.metric_lst:  # compute the GLCM property (m.split('_')[0]) of the voxel xx,yy,zz
-                            dct_metric[m].data[xx, yy, zz] = greycoprops(dct_glcm[m.split('_')[2]], m.split('_')[0])[0][0]
-
-                        pbar.set_postfix(pos="{}/{}".format(zz, len(self.dct_im_seg["im"])))
-                        pbar.update(1)
-
-        for m in self.metric_lst:
-            fname_out = sct.add_suffix(''.join(sct.extract_fname(self.param.fname_im)[1:]), '_' + m)
-            dct_metric[m].save(fname_out)
-            self.fname_metric_lst[m] = fname_out
+            for zz in range(im.data.shape[2]):
+                im_z, seg_z = im.data[:, :, zz], seg.data[:, :, zz]
+                for xx, yy in zip(*np.nonzero(seg_z)):
+                    if xx < offset or yy < offset:
+                        continue
+                    if xx > (im_z.shape[0] - offset - 1) or yy > (im_z.shape[1] - offset - 1):
+                        continue  # to check if the whole glcm_window is in the axial_slice
+                    if False in np.unique(seg_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]):
+                        continue  # to check if the whole glcm_window is in the mask of the axial_slice
+
+                    glcm_window = im_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]
+                    glcm_window = glcm_window.astype(np.uint8)
+
+                    dct_glcm = {}
+                    for a in self.param_glcm.angle.split(','):  # compute the GLCM for self.param_glcm.distance and for each self.param_glcm.angle
+                        dct_glcm[a] = greycomatrix(glcm_window,
+                                                   [self.param_glcm.distance], [np.radians(int(a))],
+                                                   symmetric=self.param_glcm.symmetric,
+                                                   normed=self.param_glcm.normed)
+
+                    for m in self.metric_lst:  # compute the GLCM property (m.split('_')[0]) of the voxel xx,yy,zz
+                        dct_metric[m].data[xx, yy, zz] = greycoprops(dct_glcm[m.split('_')[2]], m.split('_')[0])[0][0]
+
+                    pbar.set_postfix(pos="{}/{}".format(zz, im.data.shape[2]))
+                    pbar.update(1)
+
+        return [dct_metric[m] for m in self.metric_lst]
 
     def reorient_data(self):
         for f in self.fname_metric_lst:
@@ -15,6 +15,8 @@ from __future__ import absolute_import, division
 import sys, io, os, time, shutil
 
 import numpy as np
+from scipy.ndimage import affine_transform
+from scipy.spatial import cKDTree
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -54,141 +56,113 @@ class Thinning:
                 sct.printv('-- changing orientation ...')
                 self.image.change_orientation('IRP')
 
-            thinned_data = np.asarray([self.zhang_suen(im_slice) for im_slice in self.image.data])
+            # all axial slices are thinned at once (the algorithm operates on the last two axes)
+            thinned_data = self.zhang_suen(self.image.data)
 
             self.thinned_image = msct_image.empty_like(self.image)
             self.thinned_image.data = thinned_data
             self.thinned_image.absolutepath = sct.add_suffix(self.image.absolutepath, "_thinned")
 
     # ------------------------------------------------------------------------------------------------------------------
-    def get_neighbours(self, x, y, image):
+    def get_neighbours(self, image):
         """
-        Return 8-neighbours of image point P1(x,y), in a clockwise order
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param x:
-        :param y:
-        :param image:
-        :return:
+        Return the 8-neighbours P2,...,P9 of every pixel of image, in a clockwise order (P2 being the upper neighbour).
+        Neighbours are computed on the last two axes, so that a stack of 2D slices can be processed at once. Pixels
+        outside of the image are considered as background (border pixels are never removed, see zhang_suen).
+        :param image: ndarray (2D or stack of 2D slices)
+        :return: list of 8 ndarrays of the same shape as image
         """
-        # now = time.time()
-        x_1, y_1, x1, y1 = x - 1, y - 1, x + 1, y + 1
-        neighbours = [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],     # P2,P3,P4,P5
-                      image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]    # P6,P7,P8,P9
-        # t = time.time() - now
-        # sct.printv('t neighbours: ', t)
-        return neighbours
+        nx, ny = image.shape[-2:]
+        padded = np.pad(image, [(0, 0)] * (image.ndim - 2) + [(1, 1), (1, 1)], mode='constant')
+        offsets = [(-1, 0), (-1, 1), (0, 1), (1, 1),     # P2,P3,P4,P5
+                   (1, 0), (1, -1), (0, -1), (-1, -1)]   # P6,P7,P8,P9
+        return [padded[..., 1 + dx:1 + dx + nx, 1 + dy:1 + dy + ny] for dx, dy in offsets]
 
     # ------------------------------------------------------------------------------------------------------------------
     def transitions(self, neighbours):
         """
-        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param neighbours:
-        :return:
+        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence P2, P3, ... , P8, P9, P2
+        :param neighbours: list of 8 ndarrays, as returned by get_neighbours
+        :return: ndarray with the number of transitions of each pixel
         """
-        # now = time.time()
-        n = neighbours + neighbours[0:1]      # P2, P3, ... , P8, P9, P2
-        s = np.sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
-        # t = time.time() - now
-        # sct.printv('t transitions sum: ', t)
-        return s
+        n = neighbours + neighbours[0:1]
+        return np.sum([(n1 == 0) & (n2 == 1) for n1, n2 in zip(n, n[1:])], axis=0)
 
     # ------------------------------------------------------------------------------------------------------------------
     def zhang_suen(self, image):
         """
-        the Zhang-Suen Thinning Algorithm
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param image:
-        :return:
+        the Zhang-Suen Thinning Algorithm, vectorized over all pixels (and over all slices if image is 3D)
+        adapted from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
+        :param image: binary ndarray (2D or stack of 2D slices along the first axis)
+        :return: thinned ndarray, with the same type as image
         """
-        # now = time.time()
-        image_thinned = image.copy()  # deepcopy to protect the original image
-        changing1 = changing2 = 1  # the points to be removed (set as 0)
-        while changing1 or changing2:  # iterates until no further changes occur in the image
-            # Step 1
-            changing1 = []
-            max = len(image_thinned) - 1
-            pass_list = [1, max]
-            # rows, columns = image_thinned.shape  # x for rows, y for columns
-
-            # for x in range(1, rows - 1):         # No. of  rows
-            # for y in range(1, columns - 1):  # No. of columns
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0: Point P1 in the object regions
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and    # Condition 1: 2<= N(P1) <= 6
-                        P2 * P4 * P6 == 0 and    # Condition 3
-                        P4 * P6 * P8 == 0 and   # Condition 4
-                        self.transitions(n) == 1):    # Condition 2: S(P1)=1
-                        changing1.append((x, y))
-            for x, y in changing1:
-                image_thinned[x][y] = 0
-            # Step 2
-            changing2 = []
-
-            # for x in range(1, rows - 1):
-            # for y in range(1, columns - 1):
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and       # Condition 1
-                        P2 * P4 * P8 == 0 and       # Condition 3
-                        P2 * P6 * P8 == 0 and  # Condition 4
-                        self.transitions(n) == 1):    # Condition 2
-                        changing2.append((x, y))
-            for x, y in changing2:
-                image_thinned[x][y] = 0
-        # t = time.time() - now
-        # sct.printv('t thinning: ', t)
-        return image_thinned
+        image_thinned = bin_data(image).astype(np.uint8)  # copy to protect the original image
+        changing = True
+        while changing:  # iterates until no further changes occur in the image
+            changing = False
+            for step in [1, 2]:
+                P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(image_thinned)
+                nb_neighbours = np.sum(n, axis=0)
+                if step == 1:
+                    cond_34 = (P2 * P4 * P6 == 0) & (P4 * P6 * P8 == 0)  # Conditions 3 and 4 of step 1
+                else:
+                    cond_34 = (P2 * P4 * P8 == 0) & (P2 * P6 * P8 == 0)  # Conditions 3 and 4 of step 2
+                to_remove = ((image_thinned == 1) &                           # Condition 0: Point P1 in the object regions
+                             (nb_neighbours >= 2) & (nb_neighbours <= 6) &    # Condition 1: 2<= N(P1) <= 6
+                             (self.transitions(n) == 1) &                     # Condition 2: S(P1)=1
+                             cond_34)
+                # as in the original algorithm, only the interior pixels are candidates for removal
+                to_remove[..., [0, -1], :] = False
+                to_remove[..., :, [0, -1]] = False
+                if to_remove.any():
+                    image_thinned[to_remove] = 0
+                    changing = True
+        return image_thinned.astype(image.dtype)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # HAUSDORFF'S DISTANCE -------------------------------------------------------------------------------------------------
 class HausdorffDistance:
-    def __init__(self, data1, data2, v=1):
+    def __init__(self, data1, data2, v=1, spacing=None):
         """
         the hausdorff distance between two sets is the maximum of the distances from a point in any of the sets to the nearest point in the other set
+        :param data1: binary ndarray (2D or 3D)
+        :param data2: binary ndarray, with the same shape as data1
+        :param v: verbose
+        :param spacing: list of float: pixel size along each axis. If None, distances are expressed in pixel.
         :return:
         """
-        # now = time.time()
-        sct.printv('Computing 2D Hausdorff\'s distance ... ', v, 'normal')
+        sct.printv('Computing ' + str(data1.ndim) + 'D Hausdorff\'s distance ... ', v, 'normal')
         self.data1 = bin_data(data1)
         self.data2 = bin_data(data2)
+        if spacing is None:
+            spacing = [1.0] * self.data1.ndim
+        self.spacing = np.asarray(spacing, dtype=float)
 
         self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v)
         self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v)
 
-        # relatives hausdorff's distances in pixel
+        # relatives hausdorff's distances (in pixel if no spacing was given)
         self.h1 = np.max(self.min_distances_1)
         self.h2 = np.max(self.min_distances_2)
 
-        # Hausdorff's distance in pixel
+        # Hausdorff's distance (in pixel if no spacing was given)
         self.H = max(self.h1, self.h2)
-        # t = time.time() - now
-        # sct.printv('Hausdorff dist time :', t)
 
     # ------------------------------------------------------------------------------------------------------------------
     def relative_hausdorff_dist(self, dat1, dat2, v=1):
+        """
+        For each non-zero point of dat1, compute the euclidean distance to the nearest non-zero point of dat2, using a
+        KD-tree built on the (spacing-scaled) coordinates of dat2.
+        :return: ndarray with the same shape as dat1, containing the minimal distances at the non-zero points of dat1
+        """
         h = np.zeros(dat1.shape)
-        nz_coord_1 = non_zero_coord(dat1)
-        nz_coord_2 = non_zero_coord(dat2)
-        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0 :
-            for x1, y1 in nz_coord_1:
-                # for x1 in range(dat1.shape[0]):
-                # for y1 in range(dat1.shape[1]):
-                # if dat1[x1, y1] == 1:
-                d_p1_dat2 = []
-                p1 = np.asarray([x1, y1])
-                for x2, y2 in nz_coord_2:
-                    # for x2 in range(dat2.shape[0]):
-                    # for y2 in range(dat2.shape[1]):
-                    # if dat2[x2, y2] == 1:
-                    p2 = np.asarray([x2, y2])
-                    d_p1_dat2.append(np.linalg.norm(p1 - p2))  # Euclidean distance between p1 and p2
-                h[x1, y1] = min(d_p1_dat2)
+        nz_coord_1 = np.transpose(np.nonzero(dat1))
+        nz_coord_2 = np.transpose(np.nonzero(dat2))
+        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0:
+            tree = cKDTree(nz_coord_2 * self.spacing)
+            min_distances, _ = tree.query(nz_coord_1 * self.spacing)
+            h[tuple(nz_coord_1.T)] = min_distances
         else:
             sct.printv('Warning: an image is empty', v, 'warning')
         return h
@@ -201,7 +175,6 @@ class ComputeDistances:
         self.im1 = im1
         self.im2 = im2
         self.dim_im = len(self.im1.data.shape)
-        self.dim_pix = 0
         self.distances = None
         self.res = ''
         self.param = param
@@ -257,9 +230,9 @@ class ComputeDistances:
                 med1 = np.median(self.dist1_distribution[i])
                 med2 = np.median(self.dist2_distribution[i])
                 if self.im2 is None:
-                    self.res += 'Slice ' + str(i) + ' - slice ' + str(i + 1) + ': ' + str(d.H * self.dim_pix) + '  -  ' + str(med1 * self.dim_pix) + '  -  ' + str(med2 * self.dim_pix) + ' \n'
+                    self.res += 'Slice ' + str(i) + ' - slice ' + str(i + 1) + ': ' + str(d.H) + '  -  ' + str(med1) + '  -  ' + str(med2) + ' \n'
                 else:
-                    self.res += 'Slice ' + str(i) + ': ' + str(d.H * self.dim_pix) + '  -  ' + str(med1 * self.dim_pix) + '  -  ' + str(med2 * self.dim_pix) + ' \n'
+                    self.res += 'Slice ' + str(i) + ': ' + str(d.H) + '  -  ' + str(med1) + '  -  ' + str(med2) + ' \n'
 
         sct.printv('-----------------------------------------------------------------------------\n' +
                    self.res, self.param.verbose, 'normal')
@@ -272,8 +245,7 @@ class ComputeDistances:
         nx1, ny1, nz1, nt1, px1, py1, pz1, pt1 = self.im1.dim
         nx2, ny2, nz2, nt2, px2, py2, pz2, pt2 = self.im2.dim
 
-        assert np.isclose(px1, px2) and np.isclose(py1, py2) and np.isclose(px1, py1)
-        self.dim_pix = py1
+        assert np.isclose(px1, px2) and np.isclose(py1, py2)
 
         if self.param.thinning:
             dat1 = self.thinning1.thinned_image.data
@@ -282,15 +254,15 @@ class ComputeDistances:
             dat1 = bin_data(self.im1.data)
             dat2 = bin_data(self.im2.data)
 
-        self.distances = HausdorffDistance(dat1, dat2, self.param.verbose)
-        self.res = 'Hausdorff\'s distance : ' + str(self.distances.H * self.dim_pix) + ' mm\n\n' \
-                   'First relative Hausdorff\'s distance : ' + str(self.distances.h1 * self.dim_pix) + ' mm\n' \
-                   'Second relative Hausdorff\'s distance : ' + str(self.distances.h2 * self.dim_pix) + ' mm'
+        # distances in mm
+        self.distances = HausdorffDistance(dat1, dat2, self.param.verbose, spacing=[px1, py1])
+        self.res = 'Hausdorff\'s distance : ' + str(self.distances.H) + ' mm\n\n' \
+                   'First relative Hausdorff\'s distance : ' + str(self.distances.h1) + ' mm\n' \
+                   'Second relative Hausdorff\'s distance : ' + str(self.distances.h2) + ' mm'
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_1im_3d(self):
         nx1, ny1, nz1, nt1, px1, py1, pz1, pt1 = self.im1.dim
-        self.dim_pix = py1
 
         if self.param.thinning:
             dat1 = self.thinning1.thinned_image.data
@@ -299,7 +271,9 @@ class ComputeDistances:
 
         self.distances = []
         for i, dat_slice in enumerate(dat1[:-1]):
-            self.distances.append(HausdorffDistance(bin_data(dat_slice), bin_data(dat1[i + 1]), self.param.verbose))
+            # axial slices (IRP orientation): distances in mm in the RP plane
+            self.distances.append(HausdorffDistance(bin_data(dat_slice), bin_data(dat1[i + 1]), self.param.verbose,
+                                                    spacing=[py1, pz1]))
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_2im_3d(self):
@@ -307,7 +281,6 @@ class ComputeDistances:
         nx2, ny2, nz2, nt2, px2, py2, pz2, pt2 = self.im2.dim
         # assert np.round(pz1, 5) == np.round(pz2, 5) and np.round(py1, 5) == np.round(py2, 5)
         assert nx1 == nx2
-        self.dim_pix = py1
 
         if self.param.thinning:
             dat1 = self.thinning1.thinned_image.data
@@ -318,7 +291,7 @@ class ComputeDistances:
 
         self.distances = []
         for slice1, slice2 in zip(dat1, dat2):
-            self.distances.append(HausdorffDistance(slice1, slice2, self.param.verbose))
+            self.distances.append(HausdorffDistance(slice1, slice2, self.param.verbose, spacing=[py1, pz1]))
 
     # ------------------------------------------------------------------------------------------------------------------
     def show_results(self):
@@ -332,20 +305,20 @@ class ComputeDistances:
         data_dist = {"distances": [], "image": [], "slice": []}
 
         if self.dim_im == 2:
-            data_dist["distances"].append([dist * self.dim_pix for dist in self.dist1_distribution])
+            data_dist["distances"].append(list(self.dist1_distribution))
             data_dist["image"].append(len(self.dist1_distribution) * [1])
             data_dist["slice"].append(len(self.dist1_distribution) * [0])
 
-            data_dist["distances"].append([dist * self.dim_pix for dist in self.dist2_distribution])
+            data_dist["distances"].append(list(self.dist2_distribution))
             data_dist["image"].append(len(self.dist2_distribution) * [2])
             data_dist["slice"].append(len(self.dist2_distribution) * [0])
 
         if self.dim_im == 3:
             for i in range(len(self.distances)):
-                data_dist["distances"].append([dist * self.dim_pix for dist in self.dist1_distribution[i]])
+                data_dist["distances"].append(list(self.dist1_distribution[i]))
                 data_dist["image"].append(len(self.dist1_distribution[i]) * [1])
                 data_dist["slice"].append(len(self.dist1_distribution[i]) * [i])
-                data_dist["distances"].append([dist * self.dim_pix for dist in self.dist2_distribution[i]])
+                data_dist["distances"].append(list(self.dist2_distribution[i]))
                 data_dist["image"].append(len(self.dist2_distribution[i]) * [2])
                 data_dist["slice"].append(len(self.dist2_distribution[i]) * [i])
 
@@ -364,69 +337,58 @@ def bin_data(data):
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-def resample_image(fname, suffix='_resampled.nii.gz', binary=False, npx=0.3, npy=0.3, thr=0.0, interpolation='spline'):
+def resample_image(im_in, suffix='_resampled', binary=False, npx=0.3, npy=0.3, thr=0.0, interpolation='spline'):
     """
-    Resampling function: add a padding, resample, crop the padding
-    :param fname: name of the image file to be resampled
-    :param suffix: suffix added to the original fname after resampling
+    Resampling function: resample an image in the axial plane, in memory (no intermediate file is written)
+    :param im_in: Image to be resampled (2D or 3D)
+    :param suffix: suffix added to the original path after resampling
     :param binary: boolean, image is binary or not
     :param npx: new pixel size in the x direction
     :param npy: new pixel size in the y direction
     :param thr: if the image is binary, it will be thresholded at thr (default=0) after the resampling
     :param interpolation: type of interpolation used for the resampling
-    :return: file name after resampling (or original fname if it was already in the correct resolution)
+    :return: Image after resampling (or original image if it was already in the correct resolution)
     """
-    im_in = Image(fname)
+    dict_interp = {'nn': 0, 'linear': 1, 'spline': 2}
+
     orientation = im_in.orientation
-    if orientation != 'RPI':
-        fname = im_in.change_orientation(im_in, 'RPI', generate_path=True).save().absolutepath
+    im_rpi = im_in
+    if im_in.data.ndim == 3 and orientation != 'RPI':
+        im_rpi = msct_image.change_orientation(im_in, 'RPI')
 
-    nx, ny, nz, nt, px, py, pz, pt = im_in.dim
+    nx, ny, nz, nt, px, py, pz, pt = im_rpi.dim
 
     if np.round(px, 2) != np.round(npx, 2) or np.round(py, 2) != np.round(npy, 2):
-        name_resample = sct.extract_fname(fname)[1] + suffix
         if binary:
             interpolation = 'nn'
 
-        if nz == 1:  # when data is 2d: we convert it to a 3d image in order to avoid nipy problem of conversion nifti-->nipy with 2d data
-            sct.run(['sct_image', '-i', ','.join([fname, fname]), '-concat', 'z', '-o', fname])
-
-        sct.run(['sct_resample', '-i', fname, '-mm', str(npx) + 'x' + str(npy) + 'x' + str(pz), '-o', name_resample, '-x', interpolation])
-
-        if nz == 1:  # when input data was 2d: re-convert data 3d-->2d
-            sct.run(['sct_image', '-i', name_resample, '-split', 'z'])
-            im_split = Image(name_resample.split('.nii.gz')[0] + '_Z0000.nii.gz')
-            im_split.save(name_resample)
-
+        # same sampling as sct_resample: the first voxel is kept, and the FOV is split into the new number of voxels
+        shape = im_rpi.data.shape
+        shape_r = (int(np.round(nx * px / npx)), int(np.round(ny * py / npy))) + shape[2:]
+        factors = [shape[i] / float(shape_r[i]) for i in range(len(shape))]
+        data_r = affine_transform(im_rpi.data.astype(np.float64), factors, output_shape=shape_r,
+                                  order=dict_interp[interpolation], mode='nearest')
         if binary:
-            sct.run(['sct_maths', '-i', name_resample, '-bin', str(thr), '-o', name_resample])
-
-        if orientation != 'RPI':
-            name_resample = Image(name_resample) \
-             .change_orientation(orientation, generate_path=True) \
-             .save() \
-             .absolutepath
-
-        return name_resample
+            data_r = (data_r > thr).astype(np.uint8)
+
+        # update header: the voxel-to-world affine is scaled by the resampling factors
+        affine_r = np.dot(im_rpi.hdr.get_best_affine(), np.diag((factors + [1.0, 1.0])[:3] + [1.0]))
+        hdr_r = im_rpi.hdr.copy()
+        hdr_r.set_data_shape(shape_r)
+        hdr_r.set_data_dtype(data_r.dtype)
+        hdr_r.set_sform(affine_r)
+        hdr_r.set_qform(affine_r)
+
+        im_r = Image(data_r, hdr=hdr_r)
+        if im_r.data.ndim == 3 and orientation != 'RPI':
+            im_r.change_orientation(orientation)
+        if im_in.absolutepath is not None:
+            im_r.absolutepath = sct.add_suffix(im_in.absolutepath, suffix)
+
+        return im_r
     else:
-        if orientation != 'RPI':
-            fname = sct.add_suffix(fname, "_RPI")
-            im_in = msct_image.change_orientation(im_in, orientation).save(fname)
-
         sct.printv('Image resolution already ' + str(npx) + 'x' + str(npy) + 'xpz')
-        return fname
-
-
-# ----------------------------------------------------------------------------------------------------------------------
-def non_zero_coord(data):
-    dim = len(data.shape)
-    if dim == 3:
-        X, Y, Z = (data > 0).nonzero()
-        list_coordinates = [(X[i], Y[i], Z[i]) for i in range(0, len(X))]
-    elif dim == 2:
-        X, Y = (data > 0).nonzero()
-        list_coordinates = [(X[i], Y[i]) for i in range(0, len(X))]
-    return list_coordinates
+        return im_in
 
 
 def get_parser():
@@ -525,10 +487,10 @@ if __name__ == "__main__":
         os.chdir(tmp_dir)
 
         # now = time.time()
-        input_im1 = Image(resample_image(im1_name, binary=True, thr=0.5, npx=resample_to, npy=resample_to))
+        input_im1 = resample_image(Image(im1_name), binary=True, thr=0.5, npx=resample_to, npy=resample_to)
         input_im1.absolutepath = os.path.basename(input_fname)
         if im2_name is not None:
-            input_im2 = Image(resample_image(im2_name, binary=True, thr=0.5, npx=resample_to, npy=resample_to))
+            input_im2 = resample_image(Image(im2_name), binary=True, thr=0.5, npx=resample_to, npy=resample_to)
             input_im2.absolutepath = os.path.basename(input_second_fname)
         else:
             input_im2 = None
@@ -18,6 +18,7 @@ import sys
 import numpy as np
 from msct_parser import Parser
 from spinalcordtoolbox.image import Image, empty_like
+from spinalcordtoolbox.roi import get_bounding_box
 from spinalcordtoolbox.utils import parse_num_list
 import sct_utils as sct
 
@@ -160,7 +161,12 @@ def main():
             # snr_roi = np.average(snr_map[mask_std_nonzero], weights=mask[mask_std_nonzero])
 
     elif method == 'diff':
-        data_2vol = np.take(data, index_vol, axis=3)
+        # only the bounding box of the mask contributes to the weighted averages below
+        bbox = get_bounding_box(mask)
+        if bbox is None:
+            sct.printv('ERROR: mask is empty.', 1, 'error')
+        mask = mask[bbox]
+        data_2vol = np.take(data[bbox], index_vol, axis=3)
         # Compute mean in ROI
         data_mean = np.mean(data_2vol, axis=3)
         mean_in_roi = np.average(data_mean, weights=mask)
@@ -21,13 +21,9 @@ import os
 
 import numpy as np
 
-import nibabel
-from scipy import ndimage
-
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
-from sct_image import concat_data
 from msct_parser import Parser
 
 
@@ -45,7 +41,6 @@ class Param:
         self.even = 0
         self.file_prefix = 'mask_'  # output prefix
         self.verbose = 1
-        self.remove_temp_files = 1
         self.offset = '0,0'
 
 
@@ -71,8 +66,6 @@ def main(args=None):
         param.shape = arguments['-f']
     if '-o' in arguments:
         param.fname_out = os.path.abspath(arguments['-o'])
-    if '-r' in arguments:
-        param.remove_temp_files = int(arguments['-r'])
     if '-v' in arguments:
         param.verbose = int(arguments['-v'])
 
@@ -99,25 +92,14 @@ def create_mask(param):
     if param.fname_out == '':
         param.fname_out = os.path.abspath(param.file_prefix + file_data + ext_data)
 
-    path_tmp = sct.tmp_create(basename="create_mask", verbose=param.verbose)
-
+    # load input data and re-orient to RPI (in memory)
+    im_input = Image(param.fname_data)
+    orientation_input = im_input.orientation
     sct.printv('\nOrientation:', param.verbose)
-    orientation_input = Image(param.fname_data).orientation
     sct.printv('  ' + orientation_input, param.verbose)
-
-    # copy input data to tmp folder and re-orient to RPI
-    Image(param.fname_data).change_orientation("RPI").save(os.path.join(path_tmp, "data_RPI.nii"))
-    if method_type == 'centerline':
-        Image(method_val).change_orientation("RPI").save(os.path.join(path_tmp, "centerline_RPI.nii"))
-    if method_type == 'point':
-        Image(method_val).change_orientation("RPI").save(os.path.join(path_tmp, "point_RPI.nii"))
-
-    # go to tmp folder
-    curdir = os.getcwd()
-    os.chdir(path_tmp)
+    im_data = msct_image.change_orientation(im_input, "RPI")
 
     # Get dimensions of data
-    im_data = Image('data_RPI.nii')
     nx, ny, nz, nt, px, py, pz, pt = im_data.dim
     sct.printv('\nDimensions:', param.verbose)
     sct.printv(im_data.dim, param.verbose)
@@ -125,125 +107,77 @@ def create_mask(param):
     if nt != 1:
         sct.printv('WARNING in ' + os.path.basename(__file__) + ': Input image is 4d but output mask will be 3D from first time slice.', param.verbose, 'warning')
         # extract first volume to have 3d reference
-        nii = msct_image.empty_like(Image('data_RPI.nii'))
-        data3d = nii.data[:, :, :, 0]
-        nii.data = data3d
-        nii.save('data_RPI.nii')
+        im_data.data = im_data.data[:, :, :, 0]
+        im_data.header.set_data_shape(im_data.data.shape)
 
     if method_type == 'coord':
         # parse to get coordinate
         coord = [x for x in map(int, method_val.split('x'))]
 
     if method_type == 'point':
-        # get file name
         # extract coordinate of point
         sct.printv('\nExtract coordinate of point...', param.verbose)
-        # TODO: change this way to remove dependence to sct.run. ProcessLabels.display_voxel returns list of coordinates
-        status, output = sct.run(['sct_label_utils', '-i', 'point_RPI.nii', '-display'], verbose=param.verbose)
-        # parse to get coordinate
-        # TODO fixup... this is quite magic
-        coord = output[output.find('Position=') + 10:-17].split(',')
+        data_point = Image(method_val).change_orientation("RPI").data
+        coord_point = np.transpose(np.nonzero(data_point))
+        if len(coord_point) == 0:
+            sct.printv('ERROR: The point image ' + method_val + ' is empty.', 1, 'error')
+        coord = coord_point[0][:2]
 
     if method_type == 'center':
         # set coordinate at center of FOV
         coord = np.round(float(nx) / 2), np.round(float(ny) / 2)
 
     if method_type == 'centerline':
-        # get name of centerline from user argument
-        fname_centerline = 'centerline_RPI.nii'
+        # get center of mass of the centerline in each slice
+        data_centerline = Image(method_val).change_orientation("RPI").data
+        centers = get_centers_of_mass(data_centerline)
     else:
-        # generate volume with line along Z at coordinates 'coord'
-        sct.printv('\nCreate line...', param.verbose)
-        fname_centerline = create_line(param, 'data_RPI.nii', coord, nz)
+        # line along Z at coordinates 'coord'
+        centers = np.tile(np.array([int(coord[0]), int(coord[1])], dtype=np.float64), (nz, 1))
 
     # create mask
     sct.printv('\nCreate mask...', param.verbose)
-    centerline = nibabel.load(fname_centerline)  # open centerline
-    hdr = centerline.get_header()  # get header
-    hdr.set_data_dtype('uint8')  # set imagetype to uint8
-    spacing = hdr.structarr['pixdim']
-    data_centerline = centerline.get_data()  # get centerline
-    # if data is 2D, reshape with empty third dimension
-    if len(data_centerline.shape) == 2:
-        data_centerline_shape = list(data_centerline.shape)
-        data_centerline_shape.append(1)
-        data_centerline = data_centerline.reshape(data_centerline_shape)
-    z_centerline_not_null = [iz for iz in range(0, nz, 1) if data_centerline[:, :, iz].any()]
-    # get center of mass of the centerline
-    cx = [0] * nz
-    cy = [0] * nz
-    for iz in range(0, nz, 1):
-        if iz in z_centerline_not_null:
-            cx[iz], cy[iz] = ndimage.measurements.center_of_mass(np.array(data_centerline[:, :, iz]))
-    # create 2d masks
-    file_mask = 'data_mask'
-    for iz in range(nz):
-        if iz not in z_centerline_not_null:
-            # write an empty nifty volume
-            img = nibabel.Nifti1Image(data_centerline[:, :, iz], None, hdr)
-            nibabel.save(img, (file_mask + str(iz) + '.nii'))
-        else:
-            center = np.array([cx[iz], cy[iz]])
-            mask2d = create_mask2d(param, center, param.shape, param.size, im_data=im_data)
-            # Write NIFTI volumes
-            img = nibabel.Nifti1Image(mask2d, None, hdr)
-            nibabel.save(img, (file_mask + str(iz) + '.nii'))
-
-    fname_list = [file_mask + str(iz) + '.nii' for iz in range(nz)]
-    im_out = concat_data(fname_list, dim=2).save('mask_RPI.nii.gz')
+    data_mask = create_mask3d(param, centers, param.shape, param.size, im_data=im_data)
 
+    im_out = msct_image.empty_like(im_data)
+    im_out.data = data_mask
     im_out.change_orientation(orientation_input)
-    im_out.header = Image(param.fname_data).header
+    im_out.header = im_input.header
     im_out.save(param.fname_out)
 
-    # come back
-    os.chdir(curdir)
-
-    # Remove temporary files
-    if param.remove_temp_files == 1:
-        sct.printv('\nRemove temporary files...', param.verbose)
-        sct.rmtree(path_tmp)
-
     sct.display_viewer_syntax([param.fname_data, param.fname_out], colormaps=['gray', 'red'], opacities=['', '0.5'])
 
 
-def create_line(param, fname, coord, nz):
+def get_centers_of_mass(data):
     """
-    Create vertical line in 3D volume
-    :param param:
-    :param fname:
-    :param coord:
-    :param nz:
-    :return:
+    Compute the center of mass of each axial slice of a volume
+    :param data: ndarray: 2D or 3D volume (in RPI orientation)
+    :return: ndarray (nz, 2): x and y coordinates of the center of mass in each slice. NaN for empty slices.
     """
-
-    # duplicate volume (assumes input file is nifti)
-    sct.copy(fname, 'line.nii', verbose=param.verbose)
-
-    # set all voxels to zero
-    sct.run(['sct_maths', '-i', 'line.nii', '-mul', '0', '-o', 'line.nii'], param.verbose)
-
-    cmd = ['sct_label_utils', '-i', 'line.nii', '-o', 'line.nii', '-create-add']
-    for iz in range(nz):
-        if iz == nz - 1:
-            cmd += [str(int(coord[0])) + ',' + str(int(coord[1])) + ',' + str(iz) + ',1']
-        else:
-            cmd += [str(int(coord[0])) + ',' + str(int(coord[1])) + ',' + str(iz) + ',1:']
-
-    sct.run(cmd, param.verbose)
-
-    return 'line.nii'
-
-
-def create_mask2d(param, center, shape, size, im_data):
+    # if data is 2D, reshape with empty third dimension
+    if data.ndim == 2:
+        data = data[:, :, np.newaxis]
+    data = np.asarray(data, dtype=np.float64)
+    nx, ny = data.shape[:2]
+    weight = data.sum(axis=(0, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cx = np.einsum('xyz,x->z', data, np.arange(nx)) / weight
+        cy = np.einsum('xyz,y->z', data, np.arange(ny)) / weight
+    centers = np.stack((cx, cy), axis=1)
+    centers[weight == 0] = np.nan
+    return centers
+
+
+def create_mask3d(param, centers, shape, size, im_data):
     """
-    Create a 2D mask
+    Create a 3D mask, all slices at once
     :param param:
-    :param center:
+    :param centers: ndarray (nz, 2): x and y coordinates of the center of the mask in each slice. NaN if the slice should
+      be empty.
     :param shape:
     :param size:
     :param im_data: Image object for input data.
-    :return:
+    :return: ndarray (nx, ny, nz)
     """
     # get dim
     nx, ny, nz, nt, px, py, pz, pt = im_data.dim
@@ -251,13 +185,15 @@ def create_mask2d(param, center, shape, size, im_data):
     offset = param.offset.split(',')
     offset[0] = int(offset[0])
     offset[1] = int(offset[1])
-    # px, py = spacing[0], spacing[1]
 
-    # initialize 2d grid
-    xx, yy = np.mgrid[:nx, :ny]
-    mask2d = np.zeros((nx, ny))
-    xc = center[0]
-    yc = center[1]
+    # initialize grid: xx is (nx, 1, 1), yy is (1, ny, 1) and the centers are (1, 1, nz), so that all arithmetic below
+    # is broadcast to the whole volume
+    xx = np.arange(nx, dtype=np.float64).reshape(nx, 1, 1)
+    yy = np.arange(ny, dtype=np.float64).reshape(1, ny, 1)
+    is_empty = np.isnan(centers).any(axis=1)
+    centers = np.where(is_empty[:, np.newaxis], 0, centers)
+    xc = centers[:, 0].reshape(1, 1, -1)
+    yc = centers[:, 1].reshape(1, 1, -1)
     if 'mm' in size:
         size = float(size[:-2])
         radius_x = np.ceil((int(np.round(size / px)) - 1) / 2.0)
@@ -267,16 +203,17 @@ def create_mask2d(param, center, shape, size, im_data):
         radius_y = radius_x
 
     if shape == 'box':
-        mask2d = ((abs(xx + offset[0] - xc) <= radius_x) & (abs(yy + offset[1] - yc) <= radius_y)) * 1
+        mask = ((abs(xx + offset[0] - xc) <= radius_x) & (abs(yy + offset[1] - yc) <= radius_y)).astype(np.uint8)
 
     elif shape == 'cylinder':
-        mask2d = (((xx + offset[0] - xc) / radius_x) ** 2 + ((yy + offset[1] - yc) / radius_y) ** 2 <= 1) * 1
+        mask = ((((xx + offset[0] - xc) / radius_x) ** 2 + ((yy + offset[1] - yc) / radius_y) ** 2) <= 1).astype(np.uint8)
 
     elif shape == 'gaussian':
         sigma = float(radius_x)
-        mask2d = np.exp(-(((xx + offset[0] - xc)**2) / (2 * (sigma**2)) + ((yy + offset[1] - yc)**2) / (2 * (sigma**2))))
+        mask = np.exp(-(((xx + offset[0] - xc) ** 2) / (2 * (sigma ** 2)) + ((yy + offset[1] - yc) ** 2) / (2 * (sigma ** 2))))
 
-    return mask2d
+    mask[:, :, is_empty] = 0
+    return mask
 
 
 def get_parser():
@@ -333,10 +270,10 @@ def get_parser():
                       example=['data.nii'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
-                      description='Remove temporary files.',
+                      description='Ignored: no temporary files are created anymore.',
                       mandatory=False,
-                      default_value='1',
-                      example=['0', '1'])
+                      example=['0', '1'],
+                      deprecated=True)
     parser.add_option(name="-v",
                       type_value='multiple_choice',
                       description="verbose: 0 = nothing, 1 = classic, 2 = expended",
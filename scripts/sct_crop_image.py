@@ -23,6 +23,7 @@ import sct_utils as sct
 from msct_parser import Parser
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import cropping
 
 
 class LineBuilder:
@@ -54,7 +55,7 @@ class LineBuilder:
 
 
 class ImageCropper(object):
-    def __init__(self, input_file, output_file=None, mask=None, start=None, end=None, dim=None, shift=None, background=None, bmax=False, ref=None, mesh=None, rm_tmp_files=1, verbose=1, rm_output_file=0):
+    def __init__(self, input_file, output_file=None, mask=None, start=None, end=None, dim=None, shift=None, background=None, bmax=False, ref=None, mesh=None, rm_tmp_files=1, verbose=1, rm_output_file=0, shift_mm=None):
         self.input_filename = input_file
         self.output_filename = output_file
         self.mask = mask
@@ -62,6 +63,7 @@ class ImageCropper(object):
         self.end = end
         self.dim = dim
         self.shift = shift
+        self.shift_mm = shift_mm
         self.background = background
         self.bmax = bmax
         self.ref = ref
@@ -74,23 +76,58 @@ class ImageCropper(object):
 
     def crop(self):
         """
-        Crop image (change dimension)
+        Crop image (change dimension). The image is cropped in memory, and written to output_filename unless
+        rm_output_file is set.
+        :return: cropped Image
         """
+        if self.mesh is not None:
+            # meshes can only be cropped by isct_crop_image
+            return self.crop_with_isct_crop_image()
 
-        # create command line
-
-        img_in = Image(self.input_filename)
-
-        self.cmd = ["isct_crop_image", "-i", self.input_filename, "-o", self.output_filename]
-        # Handling optional arguments
+        img_in = self.input_filename if isinstance(self.input_filename, Image) else Image(self.input_filename)
 
-        # if mask is specified, find -start and -end arguments
-        if self.mask is not None:
+        background = self.background
+        if self.ref is not None:
+            # only the header of the reference image is needed (e.g. warping field)
+            bbox = cropping.get_bbox_from_ref(img_in, nibabel.load(self.ref).header)
+        elif self.mask is not None:
             # if user already specified -start or -end arguments, let him know they will be ignored
             if self.start is not None or self.end is not None:
                 sct.printv('WARNING: Mask was specified for cropping. Arguments -start and -end will be ignored', 1, 'warning')
-            self.start, self.end, self.dim = find_mask_boundaries(self.mask)
+            data_mask = np.asarray(self.mask.data if isinstance(self.mask, Image) else Image(self.mask).data)
+            if self.background is not None:
+                self.result = self.crop_from_mask_with_background(img_in, data_mask)
+                background = None
+                bbox = None
+            else:
+                shift = self.shift
+                if self.shift_mm is not None:
+                    shift = [int(np.ceil(s / p)) for s, p in zip(self.shift_mm, img_in.dim[4:4 + len(self.shift_mm)])]
+                bbox = cropping.get_bbox_from_mask(data_mask, shift)
+        elif self.bmax:
+            bbox = cropping.get_bbox_from_max(img_in.data, self.dim)
+        else:
+            bbox = cropping.get_bbox_from_index(img_in.data.shape, self.start, self.end, self.dim)
+
+        if bbox is not None:
+            self.result = cropping.crop_image(img_in, bbox, background=background)
+
+        if self.output_filename is not None:
+            self.result.absolutepath = os.path.abspath(self.output_filename)
+        # the output file is only written if it is needed
+        if not self.rm_output_file:
+            self.result.save(verbose=self.verbose)
+            sct.display_viewer_syntax([self.output_filename])
+
+        return self.result
 
+    def crop_with_isct_crop_image(self):
+        """
+        Crop image and mesh with the isct_crop_image binary.
+        """
+        self.cmd = ["isct_crop_image", "-i", self.input_filename, "-o", self.output_filename, "-mesh", self.mesh]
+        if self.mask is not None:
+            self.start, self.end, self.dim = find_mask_boundaries(self.mask)
         if self.start is not None:
             self.cmd += ["-start", ','.join(map(str, self.start))]
         if self.end is not None:
@@ -105,62 +142,29 @@ class ImageCropper(object):
             self.cmd += ["-bmax"]
         if self.ref is not None:
             self.cmd += ["-ref", self.ref]
-        if self.mesh is not None:
-            self.cmd += ["-mesh", self.mesh]
-
-        verb = 0
-        if self.verbose == 1:
-            verb = 2
-        if self.mask is not None and self.background is not None:
-            self.crop_from_mask_with_background()
-        else:
-            # Run command line
-            sct.run(self.cmd, verb)
-
+        sct.run(self.cmd, 2 if self.verbose == 1 else 0)
         self.result = Image(self.output_filename, verbose=self.verbose)
-
-        # removes the output file created by the script if it is not needed
-        if self.rm_output_file:
-            try:
-                os.remove(self.output_filename)
-            except OSError:
-                sct.printv("WARNING : Couldn't remove output file. Either it is opened elsewhere or "
-                           "it doesn't exist.", self.verbose, 'warning')
-        else:
-            sct.display_viewer_syntax([self.output_filename])
-
         return self.result
 
     # mask the image in order to keep only voxels in the mask
     # doesn't change the image dimension
-    def crop_from_mask_with_background(self):
+    def crop_from_mask_with_background(self, image_in, data_mask):
 
-        image_in = Image(self.input_filename)
         data_array = np.asarray(image_in.data)
-        data_mask = np.asarray(Image(self.mask).data)
         assert data_array.shape == data_mask.shape
 
         # Element-wise matrix multiplication:
-        new_data = None
-        dim = len(data_array.shape)
-        if dim == 3:
-            new_data = data_mask * data_array
-        elif dim == 2:
-            new_data = data_mask * data_array
+        new_data = data_mask * data_array
 
         if self.background != 0:
             from sct_maths import get_data_or_scalar
             data_background = get_data_or_scalar(str(self.background), data_array)
             data_mask_inv = data_mask.max() - data_mask
-            if dim == 3:
-                data_background = data_mask_inv * data_background
-            elif dim == 2:
-                data_background = data_mask_inv * data_background
-            new_data += data_background
+            new_data += data_mask_inv * data_background
 
         image_out = msct_image.empty_like(image_in)
         image_out.data = new_data
-        image_out.save(self.output_filename)
+        return image_out
 
     # shows the gui to crop the image
     def crop_with_gui(self):
@@ -376,18 +380,11 @@ def find_mask_boundaries(fname_mask):
     :param fname:
     :return: float: ind_start, ind_end
     """
-    from numpy import nonzero, min, max
-    # open mask
-    data = Image(fname_mask).data
-    data_nonzero = nonzero(data)
-    # find min and max boundaries of the mask
-    dim = len(data_nonzero)
-    ind_start = [min(data_nonzero[i]) for i in range(dim)]
-    ind_end = [max(data_nonzero[i]) for i in range(dim)]
-    # create string indices
-    # ind_start = ','.join(str(i) for i in xyzmin)
-    # ind_end = ','.join(str(i) for i in xyzmax)
-    # return values
+    data = fname_mask.data if isinstance(fname_mask, Image) else Image(fname_mask).data
+    bbox = cropping.get_bbox_from_mask(data)
+    dim = len(bbox)
+    ind_start = [s.start for s in bbox]
+    ind_end = [s.stop - 1 for s in bbox]
     return ind_start, ind_end, list(range(dim))
 
 
@@ -37,6 +37,15 @@ def get_parser():
                       mandatory=False,
                       example='sc_gm_seg.nii.gz')
 
+    parser.add_option(name="-s",
+                      type_value="file",
+                      description="Spinal cord segmentation or centerline, in the same space as the input image. "
+                                  "If provided, the slices are cropped around the cord instead of around their "
+                                  "center, which is useful when the cord is far from the center of the field of "
+                                  "view.",
+                      mandatory=False,
+                      example='t2s_seg.nii.gz')
+
     parser.usage.addSection('\nMISC')
 
     parser.add_option(name='-qc',
@@ -100,6 +109,7 @@ def run_main():
     verbose = arguments["-v"]
     model_name = arguments["-m"]
     threshold = arguments['-thr']
+    mask_filename = arguments.get("-s", None)
 
     if threshold > 1.0 or threshold < 0.0:
         raise RuntimeError("Threshold should be between 0.0 and 1.0.")
@@ -109,11 +119,10 @@ def run_main():
         threshold = None
 
     from spinalcordtoolbox.deepseg_gm import deepseg_gm
-    deepseg_gm.check_backend()
 
     out_fname = deepseg_gm.segment_file(input_filename, output_filename,
                                         model_name, threshold, int(verbose),
-                                        use_tta)
+                                        use_tta, mask_filename)
 
     path_qc = arguments.get("-qc", None)
     if path_qc is not None:
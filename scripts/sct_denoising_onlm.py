@@ -11,6 +11,7 @@ import nibabel as nib
 
 from msct_parser import Parser
 import sct_utils as sct
+from spinalcordtoolbox import resources
 
 # Get path of the toolbox
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
@@ -26,6 +27,8 @@ class Param:
         self.parameter = "Rician"
         self.file_to_denoise = ''
         self.output_file_name = ''
+        self.fname_roi = ''
+        self.nb_proc = 1
 
 
 def main(file_to_denoise, param, output_file_name) :
@@ -48,32 +51,30 @@ def main(file_to_denoise, param, output_file_name) :
     # mask = data[:, :, :] > noise_threshold
     # data = data[:, :, :]
 
-    from dipy.denoise.nlmeans import nlmeans
+    from spinalcordtoolbox.denoise import nlmeans_blockwise
+
+    # region of interest (e.g. cord mask): denoising is restricted to its bounding box
+    roi = None
+    if param.fname_roi:
+        roi = nib.load(param.fname_roi).get_data()
 
     if '-std' in arguments:
         sigma = std_noise
-        # Application of NLM filter to the image
-        sct.printv('Applying Non-local mean filter...')
-        if param.parameter == 'Rician':
-            den = nlmeans(data, sigma=sigma, mask=None, rician=True, block_radius=block_radius)
-        else :
-            den = nlmeans(data, sigma=sigma, mask=None, rician=False, block_radius=block_radius)
+        mask = None
     else:
         # # Process for manual detecting of background
         mask = data > noise_threshold
         sigma = np.std(data[~mask])
-        # Application of NLM filter to the image
-        sct.printv('Applying Non-local mean filter...')
-        if param.parameter == 'Rician':
-            den = nlmeans(data, sigma=sigma, mask=mask, rician=True, block_radius=block_radius)
-        else:
-            den = nlmeans(data, sigma=sigma, mask=mask, rician=False, block_radius=block_radius)
 
+    # Application of NLM filter to the image
+    sct.printv('Applying Non-local mean filter...')
     t = time()
+    den = nlmeans_blockwise(data, sigma, mask=mask, rician=(param.parameter == 'Rician'), block_radius=block_radius,
+                            nb_proc=param.nb_proc, roi=roi)
     sct.printv("total time: %s" % (time() - t))
     sct.printv("vol size", den.shape)
 
-    axial_middle = data.shape[2] / 2
+    axial_middle = data.shape[2] // 2
 
     before = data[:, :, axial_middle].T
     after = den[:, :, axial_middle].T
@@ -142,6 +143,20 @@ if __name__ == "__main__":
                       type_value="file_output",
                       description="Name of the output NIFTI image.",
                       mandatory=False)
+    parser.add_option(name="-m",
+                      type_value="file",
+                      description="Region of interest (e.g. spinal cord segmentation or mask). If provided, only the "
+                                  "bounding box of the region is denoised, the rest of the image is left unchanged.",
+                      mandatory=False,
+                      example='t2_seg.nii.gz')
+    parser.add_option(name="-j",
+                      type_value="int",
+                      description="Number of processes. The image is split in overlapping slabs along z, which are "
+                                  "denoised in parallel. By default, the thread budget of the job (see sct_pipeline) "
+                                  "or all available CPU cores will be used, and larger values are capped at the thread "
+                                  "budget. Set to 0 for no multiprocessing.",
+                      mandatory=False,
+                      example='4')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="Remove temporary files. Specify 0 to get access to temporary files.",
@@ -176,5 +191,8 @@ if __name__ == "__main__":
     param.verbose = verbose
     param.remove_temp_files = remove_temp_files
     param.parameter = parameter
+    if "-m" in arguments:
+        param.fname_roi = arguments["-m"]
+    param.nb_proc = resources.get_nb_processes(arguments.get("-j"))
 
     main(file_to_denoise, param, output_file_name)
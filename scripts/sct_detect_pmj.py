@@ -21,6 +21,7 @@ import nibabel as nib
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from msct_parser import Parser
+from sct_crop_image import ImageCropper
 import sct_utils as sct
 from spinalcordtoolbox.reports.qc import generate_qc
 
@@ -209,7 +210,8 @@ class DetectPMJ:
             self.rl_coord = int(img.dim[2] / 2)  # Right_left coordinate
             del img
 
-        sct.run(['sct_crop_image', '-i', self.fname_im, '-start', str(self.rl_coord), '-end', str(self.rl_coord), '-dim', '2', '-o', self.slice2D_im])
+        ImageCropper(input_file=self.fname_im, output_file=self.slice2D_im, start=[self.rl_coord], end=[self.rl_coord],
+                     dim=[2], verbose=self.verbose).crop()
 
     def orient2pir(self):
         """Orient input data to PIR orientation."""
@@ -13,17 +13,24 @@
 from __future__ import absolute_import
 
 import sys
+from multiprocessing import Pool
 
+import numpy as np
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 import dipy.reconst.dti as dti
 
 from msct_parser import Parser
 import sct_utils as sct
+from spinalcordtoolbox import resources
 
 class Param:
     def __init__(self):
         self.verbose = 1
+        self.chunk_size = 10000  # number of voxels fitted per job
+
+
+param = Param()
 
 
 # PARSER
@@ -63,9 +70,20 @@ def get_parser():
                       example=['0', '1'])
     parser.add_option(name='-m',
                       type_value='file',
-                      description='Mask used to compute DTI in for faster processing.',
+                      description='Mask used to compute DTI in for faster processing: the data are cropped to the '
+                                  'bounding box of the mask, and the tensor is only fitted inside the mask. Without '
+                                  'mask, the tensor is fitted on the whole volume (e.g. use a dilated spinal cord '
+                                  'segmentation to only process the cord).',
                       mandatory=False,
                       example='mask.nii.gz')
+    parser.add_option(name="-j",
+                      type_value="int",
+                      description="Number of processes for parallel tensor fitting (the voxels are split in chunks of "
+                                  "{} voxels). By default, the thread budget of the job (see sct_pipeline) or all "
+                                  "available CPU cores will be used, and larger values are capped at the thread budget. Set to 0 "
+                                  "for no multiprocessing.".format(param.chunk_size),
+                      mandatory=False,
+                      example='4')
     parser.add_option(name='-o',
                       type_value='str',
                       description='Output prefix.',
@@ -92,7 +110,7 @@ def main(args = None):
 
     # Get parser info
     parser = get_parser()
-    arguments = parser.parse(sys.argv[1:])
+    arguments = parser.parse(args)
     fname_in = arguments['-i']
     fname_bvals = arguments['-bval']
     fname_bvecs = arguments['-bvec']
@@ -101,16 +119,17 @@ def main(args = None):
     evecs = bool(arguments['-evecs'])
     if "-m" in arguments:
         file_mask = arguments['-m']
+    nb_proc = resources.get_nb_processes(arguments.get("-j"))
     param.verbose = int(arguments['-v'])
 
     # compute DTI
-    if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask):
+    if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask, nb_proc=nb_proc):
         sct.printv('ERROR in compute_dti()', 1, 'error')
 
 
 # compute_dti
 # ==========================================================================================
-def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask):
+def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask, nb_proc=1):
     """
     Compute DTI.
     :param fname_in: input 4d file.
@@ -119,6 +138,9 @@ def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_
     :param prefix: output prefix. Example: "dti_"
     :param method: algo for computing dti
     :param evecs: bool: output diffusion tensor eigenvectors
+    :param file_mask: mask file. If provided, the data are cropped to the bounding box of the mask and the tensor is
+      only fitted inside the mask.
+    :param nb_proc: int: number of processes used to fit the voxel chunks. 0 or 1: no multiprocessing.
     :return: True/False
     """
     # Open file.
@@ -131,60 +153,122 @@ def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_
     bvals, bvecs = read_bvals_bvecs(fname_bvals, fname_bvecs)
     gtab = gradient_table(bvals, bvecs)
 
-    # mask and crop the data. This is a quick way to avoid calculating Tensors on the background of the image.
+    # noise is estimated on the whole volume (before cropping), because the background is needed for that
+    sigma = None
+    if method == 'restore':
+        import dipy.denoise.noise_estimate as ne
+        sigma = ne.estimate_sigma(data)
+
+    # mask: the data are cropped to it, to avoid calculating tensors on the background of the image
+    mask = None
     if not file_mask == '':
         sct.printv('Open mask file...', param.verbose)
-        # open mask file
-        nii_mask = Image(file_mask)
-        mask = nii_mask.data
+        mask = Image(file_mask).data > 0
+        if not mask.any():
+            sct.printv('ERROR: mask is empty.', 1, 'error')
 
-    # fit tensor model
+    # fit tensor model and compute metrics
     sct.printv('Computing tensor using "' + method + '" method...', param.verbose)
-    import dipy.reconst.dti as dti
+    metrics = fit_dti(data, gtab, method=method, evecs=evecs, mask=mask, sigma=sigma, nb_proc=nb_proc,
+                      chunk_size=param.chunk_size)
+
+    # write metrics
+    sct.printv('Computing metrics...', param.verbose)
+    for name, data_metric in metrics.items():
+        save_metric(data_metric, nii, prefix + name + '.nii.gz')
+
+    return True
+
+
+def fit_dti(data, gtab, method='standard', evecs=False, mask=None, sigma=None, nb_proc=1, chunk_size=10000):
+    """
+    Fit the tensor model voxel-wise, by chunks of voxels that can be fitted in parallel.
+    :param data: 4d ndarray
+    :param gtab: dipy GradientTable
+    :param method: {'standard', 'restore'}
+    :param evecs: bool: also return the eigenvectors
+    :param mask: 3d bool ndarray. If provided, the data are cropped to the bounding box of the mask and the tensor is
+      only fitted inside the mask (metrics are 0 outside).
+    :param sigma: noise standard deviation, for the 'restore' method
+    :param nb_proc: int: number of processes used to fit the voxel chunks. 0 or 1: no multiprocessing.
+    :param chunk_size: int: number of voxels fitted per job
+    :return: OrderedDict of float32 ndarrays with the shape of the volume: FA, MD, RD, AD and, if evecs, V1, V2, V3 (with
+      an additional dimension of size 3)
+    """
+    from collections import OrderedDict
+    from spinalcordtoolbox.roi import get_bounding_box
+
+    if mask is not None:
+        bbox = get_bounding_box(mask)
+        mask = mask[bbox]
+        sct.printv('Crop data to mask bounding box: ' + str([(b.start, b.stop) for b in bbox]), param.verbose)
+    else:
+        bbox = tuple([slice(0, n) for n in data.shape[:3]])
+        mask = np.ones(data.shape[:3], dtype=bool)
+
+    # only keep the voxels to fit, as a (nb_voxels, nb_volumes) array
+    data_vox = data[bbox][mask]
+
+    chunks = [(data_vox[i:i + chunk_size], gtab, method, sigma, evecs) for i in range(0, data_vox.shape[0], chunk_size)]
+    if nb_proc > 1 and len(chunks) > 1:
+        pool = Pool(min(nb_proc, len(chunks)))
+        try:
+            list_metrics = pool.map(fit_dti_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        list_metrics = [fit_dti_chunk(chunk) for chunk in chunks]
+
+    # paste metrics back in the native space
+    list_names = ['FA', 'MD', 'RD', 'AD']
+    if evecs:
+        list_names += ['V1', 'V2', 'V3']
+    metrics = OrderedDict()
+    for name in list_names:
+        metric_vox = np.concatenate([metrics_chunk[name] for metrics_chunk in list_metrics])
+        metrics[name] = np.zeros(data.shape[:3] + metric_vox.shape[1:], dtype=np.float32)
+        metrics[name][bbox][mask] = metric_vox
+    return metrics
+
+
+def fit_dti_chunk(args):
+    """
+    Fit the tensor model on a chunk of voxels. Defined at the module level so that it can be sent to worker processes.
+    :param args: tuple (data, gtab, method, sigma, evecs), with data a (nb_voxels, nb_volumes) array
+    :return: dict of float32 arrays: FA, MD, RD, AD (nb_voxels) and, if evecs, V1, V2, V3 (nb_voxels, 3)
+    """
+    data, gtab, method, sigma, evecs = args
     if method == 'standard':
         tenmodel = dti.TensorModel(gtab)
-        if file_mask == '':
-            tenfit = tenmodel.fit(data)
-        else:
-            tenfit = tenmodel.fit(data, mask)
     elif method == 'restore':
-        import dipy.denoise.noise_estimate as ne
-        sigma = ne.estimate_sigma(data)
-        dti_restore = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
-        if file_mask == '':
-            tenfit = dti_restore.fit(data)
-        else:
-            tenfit = dti_restore.fit(data, mask)
+        tenmodel = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
+    tenfit = tenmodel.fit(data)
 
-    # Compute metrics
-    sct.printv('Computing metrics...', param.verbose)
-    # FA
-    nii.data = tenfit.fa
-    nii.save(prefix + 'FA.nii.gz', dtype='float32')
-    # MD
-    nii.data = tenfit.md
-    nii.save(prefix + 'MD.nii.gz', dtype='float32')
-    # RD
-    nii.data = tenfit.rd
-    nii.save(prefix + 'RD.nii.gz', dtype='float32')
-    # AD
-    nii.data = tenfit.ad
-    nii.save(prefix + 'AD.nii.gz', dtype='float32')
+    metrics = {'FA': tenfit.fa, 'MD': tenfit.md, 'RD': tenfit.rd, 'AD': tenfit.ad}
     if evecs:
-        data_evecs = tenfit.evecs
-        # output 1st (V1), 2nd (V2) and 3rd (V3) eigenvectors as 4d data
+        # 1st (V1), 2nd (V2) and 3rd (V3) eigenvectors
         for idim in range(3):
-            nii.data = data_evecs[:, :, :, :, idim]
-            nii.save(prefix + 'V' + str(idim+1) + '.nii.gz', dtype="float32")
+            metrics['V' + str(idim + 1)] = tenfit.evecs[..., idim]
+    return {name: np.asarray(metric, dtype=np.float32) for name, metric in metrics.items()}
 
-    return True
+
+def save_metric(data, im_ref, fname_out):
+    """
+    Save a float32 metric map using the header of a reference image, without copying the reference data.
+    :param data: float32 ndarray (3d, or 4d for eigenvectors)
+    :param im_ref: reference Image (its header is used)
+    :param fname_out: output file name
+    """
+    from spinalcordtoolbox.image import Image
+    hdr = im_ref.hdr.copy()
+    hdr.set_data_dtype(np.float32)
+    Image(data, hdr=hdr).save(fname_out)
 
 
 # START PROGRAM
 # ==========================================================================================
 if __name__ == "__main__":
     sct.init_sct()
-    # initialize parameters
-    param = Param()
     # call main function
     main()
@@ -23,16 +23,13 @@ import numpy as np
 
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
-from sct_image import split_data
 from msct_parser import Parser
-from sct_convert import convert
 
 
 class Param:
     def __init__(self):
         self.debug = 0
         self.average = 0
-        self.remove_temp_files = 1
         self.verbose = 1
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold.
 
@@ -84,10 +81,10 @@ def get_parser():
                       default_value=str(param_default.verbose))
     parser.add_option(name='-r',
                       type_value='multiple_choice',
-                      description='remove temporary files.',
+                      description='Ignored: no temporary files are created anymore.',
                       mandatory=False,
                       example=['0', '1'],
-                      default_value=str(param_default.remove_temp_files))
+                      deprecated=True)
 
     return parser
 
@@ -108,7 +105,6 @@ def main(args=None):
     fname_bvecs = arguments['-bvec']
     average = arguments['-a']
     verbose = int(arguments['-v'])
-    remove_temp_files = int(arguments['-r'])
     path_out = arguments['-ofolder']
 
     if '-bval' in arguments:
@@ -137,28 +133,13 @@ def main(args=None):
     # Extract path, file and extension
     path_data, file_data, ext_data = sct.extract_fname(fname_data)
 
-    # create temporary folder
-    path_tmp = sct.tmp_create(basename="dmri_separate", verbose=verbose)
-
-    # copy files into tmp folder and convert to nifti
-    sct.printv('\nCopy files into temporary folder...', verbose)
-    ext = '.nii'
-    dmri_name = 'dmri'
     b0_name = file_data + '_b0'
     b0_mean_name = b0_name + '_mean'
     dwi_name = file_data + '_dwi'
     dwi_mean_name = dwi_name + '_mean'
 
-    if not convert(fname_data, os.path.join(path_tmp, dmri_name + ext)):
-        sct.printv('ERROR in convert.', 1, 'error')
-    sct.copy(fname_bvecs, os.path.join(path_tmp, "bvecs"), verbose=verbose)
-
-    # go to tmp folder
-    curdir = os.getcwd()
-    os.chdir(path_tmp)
-
-    # Get size of data
-    im_dmri = Image(dmri_name + ext)
+    # Get size of data (uncompressed data is memory-mapped: only the selected volumes are read)
+    im_dmri = Image(fname_data)
     sct.printv('\nGet dimensions data...', verbose)
     nx, ny, nz, nt, px, py, pz, pt = im_dmri.dim
     sct.printv('.. ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
@@ -167,38 +148,9 @@ def main(args=None):
     sct.printv(fname_bvals)
     index_b0, index_dwi, nb_b0, nb_dwi = identify_b0(fname_bvecs, fname_bvals, param.bval_min, verbose)
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', verbose)
-    im_dmri_split_list = split_data(im_dmri, 3)
-    for im_d in im_dmri_split_list:
-        im_d.save()
-
-    # Merge b=0 images
-    sct.printv('\nMerge b=0...', verbose)
-    from sct_image import concat_data
-    l = []
-    for it in range(nb_b0):
-        l.append(dmri_name + '_T' + str(index_b0[it]).zfill(4) + ext)
-    im_out = concat_data(l, 3).save(b0_name + ext)
-
-    # Average b=0 images
-    if average:
-        sct.printv('\nAverage b=0...', verbose)
-        sct.run(['sct_maths', '-i', b0_name + ext, '-o', b0_mean_name + ext, '-mean', 't'], verbose)
-
-    # Merge DWI
-    l = []
-    for it in range(nb_dwi):
-        l.append(dmri_name + '_T' + str(index_dwi[it]).zfill(4) + ext)
-    im_out = concat_data(l, 3).save(dwi_name + ext)
-
-    # Average DWI images
-    if average:
-        sct.printv('\nAverage DWI...', verbose)
-        sct.run(['sct_maths', '-i', dwi_name + ext, '-o', dwi_mean_name + ext, '-mean', 't'], verbose)
-
-    # come back
-    os.chdir(curdir)
+    # Select (and average) b=0 and DWI images
+    sct.printv('\nSeparate b=0 and DWI...', verbose)
+    im_b0, im_b0_mean, im_dwi, im_dwi_mean = separate_b0_and_dwi(im_dmri, index_b0, index_dwi, average)
 
     # Generate output files
     fname_b0 = os.path.abspath(os.path.join(path_out, b0_name + ext_data))
@@ -206,16 +158,11 @@ def main(args=None):
     fname_b0_mean = os.path.abspath(os.path.join(path_out, b0_mean_name + ext_data))
     fname_dwi_mean = os.path.abspath(os.path.join(path_out, dwi_mean_name + ext_data))
     sct.printv('\nGenerate output files...', verbose)
-    sct.generate_output_file(os.path.join(path_tmp, b0_name + ext), fname_b0, verbose)
-    sct.generate_output_file(os.path.join(path_tmp, dwi_name + ext), fname_dwi, verbose)
+    im_b0.save(fname_b0, verbose=verbose)
+    im_dwi.save(fname_dwi, verbose=verbose)
     if average:
-        sct.generate_output_file(os.path.join(path_tmp, b0_mean_name + ext), fname_b0_mean, verbose)
-        sct.generate_output_file(os.path.join(path_tmp, dwi_mean_name + ext), fname_dwi_mean, verbose)
-
-    # Remove temporary files
-    if remove_temp_files == 1:
-        sct.printv('\nRemove temporary files...', verbose)
-        sct.rmtree(path_tmp, verbose=verbose)
+        im_b0_mean.save(fname_b0_mean, verbose=verbose)
+        im_dwi_mean.save(fname_dwi_mean, verbose=verbose)
 
     # display elapsed time
     elapsed_time = time.time() - start_time
@@ -224,6 +171,23 @@ def main(args=None):
     return fname_b0, fname_b0_mean, fname_dwi, fname_dwi_mean
 
 
+def separate_b0_and_dwi(im_dmri, index_b0, index_dwi, average=True):
+    """
+    Select the b=0 and DW volumes of a diffusion image, and optionally average each subset.
+    :param im_dmri: Image: 4d diffusion data
+    :param index_b0: list of int: indexes of the b=0 volumes
+    :param index_dwi: list of int: indexes of the DW volumes
+    :param average: bool: also compute the mean of each subset
+    :return: tuple (im_b0, im_b0_mean, im_dwi, im_dwi_mean). The means are None if average is False.
+    """
+    list_im = []
+    for index in [index_b0, index_dwi]:
+        data = im_dmri.data[..., index]
+        list_im.append(Image(data, hdr=im_dmri.hdr.copy()))
+        list_im.append(Image(np.mean(data, axis=3), hdr=im_dmri.hdr.copy()) if average else None)
+    return tuple(list_im)
+
+
 # ==========================================================================================
 # identify b=0 and DW images
 # ==========================================================================================
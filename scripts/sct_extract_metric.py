@@ -27,6 +27,7 @@ import numpy as np
 from spinalcordtoolbox.metadata import read_label_file
 from spinalcordtoolbox.utils import parse_num_list
 from spinalcordtoolbox.aggregate_slicewise import check_labels, extract_metric, save_as_csv, Metric, LabelStruc
+from spinalcordtoolbox.atlas import load_atlas, pack_atlas
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
 from msct_parser import Parser
@@ -184,6 +185,13 @@ max: for each z-slice of the input data, extract the max value for each slice of
                       description='Discard voxels with negative value when computing metrics statistics.',
                       example=["0", "1"],
                       default_value="0")
+    parser.add_option(name='-pack-atlas',
+                      type_value='multiple_choice',
+                      mandatory=False,
+                      description='Write the packed atlas (atlas_packed.npz) in the label folder (-f), so that the next '
+                                  'runs read all the labels at once. The folder must be writable.',
+                      example=["0", "1"],
+                      default_value="0")
 
     # read the .txt files referencing the labels
     file_label = os.path.join(param_default.path_label, param_default.file_info_label)
@@ -219,7 +227,8 @@ To compute average MTR in a region defined by a single label file (could be bina
 
 def main(fname_data, path_label, method, slices, levels, fname_output, labels_user, append,
          fname_normalizing_label, normalization_method, label_to_fix, adv_param_user, fname_output_metric_map,
-         fname_mask_weight, fname_vertebral_labeling="", perslice=1, perlevel=1, discard_negative_values=False):
+         fname_mask_weight, fname_vertebral_labeling="", perslice=1, perlevel=1, discard_negative_values=False,
+         pack=False):
     """
     Extract metrics from MRI data based on mask (could be single file of folder to atlas)
     :param fname_data: data to extract metric from
@@ -245,6 +254,7 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
     :param perlevel: if user selected several levels, then the function outputs a metric within each vertebral level
            instead of a single average output.
     :param discard_negative_values: Bool: Discard negative voxels when computing metrics statistics
+    :param pack: Bool: Write the packed atlas in the label folder (see spinalcordtoolbox.atlas.pack_atlas)
     :return:
     """
 
@@ -313,20 +323,29 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
 
     data = Metric(data=input_im.data, label='')
     # Load labels
-    labels_tmp = np.empty([nb_labels], dtype=object)
-    for i_label in range(nb_labels):
-        im_label = Image(os.path.join(path_label, indiv_labels_files[i_label])).change_orientation("RPI")
-        labels_tmp[i_label] = np.expand_dims(im_label.data, 3)  # TODO: generalize to 2D input label
-    labels = np.concatenate(labels_tmp[:], 3)  # labels: (x,y,z,label)
+    if path_label:
+        # atlas folder: all the labels are read at once from the packed atlas of the folder, if it was written with
+        # -pack-atlas (see load_atlas)
+        if pack:
+            labels = pack_atlas(path_label, indiv_labels_files, orientation="RPI")
+        else:
+            labels = load_atlas(path_label, indiv_labels_files, orientation="RPI")
+        nx_atlas, ny_atlas, nz_atlas = labels.shape
+    else:
+        labels_tmp = np.empty([nb_labels], dtype=object)
+        for i_label in range(nb_labels):
+            im_label = Image(os.path.join(path_label, indiv_labels_files[i_label])).change_orientation("RPI")
+            labels_tmp[i_label] = np.expand_dims(im_label.data, 3)  # TODO: generalize to 2D input label
+        labels = np.concatenate(labels_tmp[:], 3)  # labels: (x,y,z,label)
+        nx_atlas, ny_atlas, nz_atlas = labels.shape[:3]
     # Load vertebral levels
     if vertebral_levels:
         im_vertebral_labeling = Image(fname_vertebral_labeling).change_orientation("RPI")
     else:
         im_vertebral_labeling = None
 
-        # Get dimensions of data and labels
+    # Get dimensions of data and labels
     nx, ny, nz = data.data.shape
-    nx_atlas, ny_atlas, nz_atlas, nt_atlas = labels.shape
 
     # Check dimensions consistency between atlas and data
     if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
@@ -409,9 +428,10 @@ if __name__ == "__main__":
         fname_mask_weight = ''
     # if 'discard_negative_values' in arguments:
     discard_negative_values = int(arguments['-discard-neg-val'])
+    pack = bool(int(arguments['-pack-atlas']))
 
     # call main function
     main(fname_data, path_label, method, parse_num_list(slices_of_interest), parse_num_list(vertebral_levels),
          fname_output, labels_user, append, fname_normalizing_label, normalization_method, label_to_fix,
          adv_param_user, fname_output_metric_map, fname_mask_weight, fname_vertebral_labeling=fname_vertebral_labeling,
-         perslice=perslice, perlevel=perlevel, discard_negative_values=discard_negative_values)
+         perslice=perslice, perlevel=perlevel, discard_negative_values=discard_negative_values, pack=pack)
@@ -16,7 +16,6 @@ from __future__ import absolute_import, division
 import sys
 
 import numpy as np
-from skimage import transform, img_as_float
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -59,22 +58,10 @@ def flatten_sagittal(im_anat, im_centerline, verbose):
                                             x_centerline_fit,
                                             np.ones(nz-zmax) * x_centerline_fit[-1]])
 
-    # change type to float32 and scale between -1 and 1 as requested by img_as_float(). See #1790, #2069
+    # translate each axial slice, such that the flattened centerline is centered in the medial plane (R-L)
+    translation_x = x_centerline_extended[:nz] - np.round(nx / 2.0)
     im_anat_flattened = msct_image.change_type(im_anat, np.float32)
-    min_data, max_data = np.min(im_anat_flattened.data), np.max(im_anat_flattened.data)
-    im_anat_flattened.data = 2 * im_anat_flattened.data/(max_data - min_data) - 1
-
-    # loop and translate each axial slice, such that the flattened centerline is centered in the medial plane (R-L)
-    for iz in range(nz):
-        # compute translation along x (R-L)
-        translation_x = x_centerline_extended[iz] - np.round(nx/2.0)
-        # apply transformation to 2D image with linear interpolation
-        # tform = tf.SimilarityTransform(scale=1, rotation=0, translation=(translation_x, 0))
-        tform = transform.SimilarityTransform(translation=(0, translation_x))
-        # important to force input in float to skikit image, because it will output float values
-        img = img_as_float(im_anat_flattened.data[:, :, iz])
-        img_reg = transform.warp(img, tform)
-        im_anat_flattened.data[:, :, iz] = img_reg
+    im_anat_flattened.data = translate_slices_x(im_anat_flattened.data, translation_x)
 
     # change back to native orientation
     im_anat_flattened.change_orientation(orientation_native)
@@ -82,6 +69,26 @@ def flatten_sagittal(im_anat, im_centerline, verbose):
     return im_anat_flattened
 
 
+def translate_slices_x(data, translation_x):
+    """
+    Translate each axial slice of a volume along x, with linear interpolation (zero outside of the volume). All the
+    slices are interpolated at once: data_out[x, y, z] = data[x + translation_x[z], y, z].
+    :param data: 3d array (x, y, z)
+    :param translation_x: 1d array: translation of each slice, in voxels
+    :return: 3d array (float32)
+    """
+    nx = data.shape[0]
+    translation_floor = np.floor(translation_x)
+    weight = (translation_x - translation_floor).astype(np.float32)[np.newaxis, np.newaxis, :]
+    # index along x of the left neighbour of each sample: (nx, 1, nz), broadcast along y
+    x0 = (np.arange(nx)[:, np.newaxis] + translation_floor.astype(int)[np.newaxis, :])[:, np.newaxis, :]
+    data_out = np.zeros(data.shape, dtype=np.float32)
+    for x, w in [(x0, 1 - weight), (x0 + 1, weight)]:
+        inside = (x >= 0) & (x < nx)
+        data_out += np.take_along_axis(data, np.clip(x, 0, nx - 1), axis=0) * (w * inside)
+    return data_out
+
+
 def main(fname_anat, fname_centerline, verbose):
     """
     Main function
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Local server keeping the CNN models of sct_deepseg_sc, sct_deepseg_gm and sct_deepseg_lesion loaded, so that each run
+# does not have to import TensorFlow and load the models again (e.g. when processing many subjects with sct_pipeline).
+
+from __future__ import absolute_import
+
+import sys
+
+import sct_utils as sct
+from msct_parser import Parser
+from spinalcordtoolbox import inference
+from spinalcordtoolbox import resources
+
+
+def get_parser():
+    parser = Parser(__file__)
+    parser.usage.set_description('Run a local inference server for the deep learning segmentation tools '
+                                 '(sct_deepseg_sc, sct_deepseg_gm, sct_deepseg_lesion). Models are loaded on first '
+                                 'use and kept in memory, and requests received at the same time from several '
+                                 'processes are predicted in a single batch. The tools use the server when it is '
+                                 'running (same socket), and run the models in-process otherwise. Stop the server with '
+                                 'Ctrl+C.')
+
+    parser.add_option(name="-socket",
+                      type_value="str",
+                      description="Unix socket of the server. Default: environment variable SCT_INFERENCE_SOCKET if "
+                                  "set, otherwise a socket of the current user in the temporary folder. Clients must "
+                                  "use the same SCT_INFERENCE_SOCKET.",
+                      mandatory=False,
+                      example="/tmp/sct_inference.sock")
+
+    parser.add_option(name="-batch",
+                      type_value="int",
+                      description="Batch size of the predictions.",
+                      mandatory=False,
+                      default_value=32)
+
+    parser.add_option(name="-threads",
+                      type_value="int",
+                      description="Number of TensorFlow threads. Default: all cores.",
+                      mandatory=False)
+
+    parser.add_option(name="-v",
+                      type_value='multiple_choice',
+                      description="Verbose: 0 = no verbosity, 1 = verbose.",
+                      mandatory=False,
+                      example=['0', '1'],
+                      default_value='1')
+
+    return parser
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    arguments = get_parser().parse(args)
+    verbose = int(arguments['-v'])
+
+    if '-threads' in arguments:
+        resources.set_thread_budget(arguments['-threads'])
+
+    server = inference.InferenceServer(socket_path=arguments.get('-socket'), batch_size=arguments['-batch'])
+    sct.printv('Inference server listening on {}'.format(server.socket_path), verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sct.printv('\nInference server stopped', verbose)
+
+
+if __name__ == '__main__':
+    sct.init_sct()
+    main()
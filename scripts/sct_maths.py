@@ -19,6 +19,7 @@ from msct_parser import Parser
 from spinalcordtoolbox.image import Image
 from sct_utils import printv, extract_fname
 import sct_utils as sct
+from spinalcordtoolbox import resources
 
 ALMOST_ZERO = 0.000000001
 
@@ -140,6 +141,9 @@ def get_parser():
                         'p: (patch radius) similar patches in the non-local means are searched for locally, inside a cube of side 2*p+1 centered at each voxel of interest. Default: p=1\n'
                         'b: (block radius) the size of the block to be used (2*b+1) in the blockwise non-local means implementation. Default: b=5 '
                         '(Block radius must be smaller than the smaller image dimension: default value is lowered for small images)\n'
+                        'j: number of processes. The volume is split in overlapping slabs along z which are denoised in parallel. Default: '
+                        'the thread budget of the job (see sct_pipeline), or all available CPU cores (larger values are capped at the '
+                        'thread budget)\n'
                         'To use default parameters, write -denoise 1',
                       mandatory=False,
                       example="")
@@ -303,14 +307,16 @@ def main(args = None):
 
     elif '-denoise' in arguments:
         # parse denoising arguments
-        p, b = 1, 5  # default arguments
+        p, b, j = 1, 5, None  # default arguments
         list_denoise = arguments['-denoise']
         for i in list_denoise:
             if 'p' in i:
                 p = int(i.split('=')[1])
             if 'b' in i:
                 b = int(i.split('=')[1])
-        data_out = denoise_nlmeans(data, patch_radius=p, block_radius=b)
+            if 'j' in i:
+                j = int(i.split('=')[1])
+        data_out = denoise_nlmeans(data, patch_radius=p, block_radius=b, nb_proc=resources.get_nb_processes(j))
 
     elif '-symmetrize' in arguments:
         data_out = (data + data[list(range(data.shape[0] - 1, -1, -1)), :, :]) / float(2)
@@ -501,21 +507,26 @@ def concatenate_along_4th_dimension(data1, data2):
     return np.concatenate((data1, data2), axis=3)
 
 
-def denoise_nlmeans(data_in, patch_radius=1, block_radius=5):
+def denoise_nlmeans(data_in, patch_radius=1, block_radius=5, nb_proc=1, roi=None, sigma=None):
     """
     data_in: nd_array to denoise
     for more info about patch_radius and block radius, please refer to the dipy website: http://nipy.org/dipy/reference/dipy.denoise.html#dipy.denoise.nlmeans.nlmeans
+    nb_proc: number of processes: the volume is split in overlapping slabs which are denoised in parallel
+    roi: nd_array: if provided, only the bounding box of its non-zero voxels is denoised
+    sigma: noise standard deviation. If None, it is estimated once on the whole volume.
     """
-    from dipy.denoise.nlmeans import nlmeans
     from dipy.denoise.noise_estimate import estimate_sigma
+    from spinalcordtoolbox.denoise import nlmeans_blockwise
     from numpy import asarray
     data_in = asarray(data_in)
 
     block_radius_max = min(data_in.shape) - 1
     block_radius = block_radius_max if block_radius > block_radius_max else block_radius
 
-    sigma = estimate_sigma(data_in)
-    denoised = nlmeans(data_in, sigma, patch_radius=patch_radius, block_radius=block_radius)
+    if sigma is None:
+        sigma = estimate_sigma(data_in)
+    denoised = nlmeans_blockwise(data_in, sigma, patch_radius=patch_radius, block_radius=block_radius,
+                                 nb_proc=nb_proc, roi=roi)
 
     return denoised
 
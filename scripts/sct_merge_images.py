@@ -18,14 +18,15 @@ from __future__ import absolute_import
 # Python imports
 import sys
 import os
-import shutil
 import numpy as np
+from scipy.ndimage import map_coordinates
 # SCT imports
 from msct_parser import Parser
 import sct_utils as sct
 import sct_apply_transfo
 import spinalcordtoolbox.image as msct_image
 import sct_maths
+from spinalcordtoolbox.warp import DICT_ORDER, DICT_INTERP_ANTS, is_displacement_field, get_sampling_coordinates
 
 
 class Param:
@@ -101,6 +102,9 @@ def merge_images(list_fname_src, fname_dest, list_fname_warp, param):
     resulting value will be: dest(i,j,k) = (0.5*0.5 + 0.5*0.5) / (0.5+0.5) = 0.5. So this function acts like a weighted
     average operator, only in destination voxels that share multiple source voxels.
 
+    The data and the partial volume of each source are accumulated one source at a time, so that the memory used does
+    not depend on the number of sources.
+
     Parameters
     ----------
     list_fname_src
@@ -113,51 +117,33 @@ def merge_images(list_fname_src, fname_dest, list_fname_warp, param):
 
     """
 
-    # create temporary folder
-    path_tmp = sct.tmp_create()
-
     # get dimensions of destination file
     nii_dest = msct_image.Image(fname_dest)
-
-    # initialize variables
-    data = np.zeros([nii_dest.dim[0], nii_dest.dim[1], nii_dest.dim[2], len(list_fname_src)])
-    partial_volume = np.zeros([nii_dest.dim[0], nii_dest.dim[1], nii_dest.dim[2], len(list_fname_src)])
-    data_merge = np.zeros([nii_dest.dim[0], nii_dest.dim[1], nii_dest.dim[2]])
-
-    # loop across files
-    i_file = 0
-    for fname_src in list_fname_src:
-
-        # apply transformation src --> dest
-        sct_apply_transfo.main(args=[
-            '-i', fname_src,
-            '-d', fname_dest,
-            '-w', list_fname_warp[i_file],
-            '-x', param.interp,
-            '-o', 'src_' + str(i_file) + '_template.nii.gz',
-            '-v', param.verbose])
-
-        # create binary mask from input file by assigning one to all non-null voxels
-        sct_maths.main(args=[
-            '-i', fname_src,
-            '-bin', str(param.almost_zero),
-            '-o', 'src_' + str(i_file) + 'native_bin.nii.gz'])
-
-        # apply transformation to binary mask to compute partial volume
-        sct_apply_transfo.main(args=[
-            '-i', 'src_' + str(i_file) + 'native_bin.nii.gz',
-            '-d', fname_dest,
-            '-w', list_fname_warp[i_file],
-            '-x', param.interp,
-            '-o', 'src_' + str(i_file) + '_template_partialVolume.nii.gz'])
-
-        # open data
-        data[:, :, :, i_file] = msct_image.Image('src_' + str(i_file) + '_template.nii.gz').data
-        partial_volume[:, :, :, i_file] = msct_image.Image('src_' + str(i_file) + '_template_partialVolume.nii.gz').data
-        i_file += 1
+    shape_dest = nii_dest.data.shape[:3]
+
+    # initialize variables: weighted sum of the data, and sum of the partial volumes
+    sum_data = np.zeros(shape_dest)
+    sum_partial_volume = np.zeros(shape_dest)
+
+    path_tmp = None
+    for i_file, (fname_src, fname_warp) in enumerate(zip(list_fname_src, list_fname_warp)):
+        im_warp = None
+        if sct.extract_fname(fname_warp)[2] in ['.nii', '.nii.gz']:
+            im_warp = msct_image.Image(fname_warp)
+        if im_warp is not None and is_displacement_field(im_warp):
+            data, partial_volume = warp_with_partial_volume(msct_image.Image(fname_src), im_warp, nii_dest, param)
+        else:
+            # e.g. affine transformation: warp the data and the mask with sct_apply_transfo
+            if path_tmp is None:
+                path_tmp = sct.tmp_create()
+            data, partial_volume = apply_transfo_with_partial_volume(fname_src, fname_warp, fname_dest,
+                                                                     os.path.join(path_tmp, 'src_' + str(i_file)),
+                                                                     param)
+        sum_data += data * partial_volume
+        sum_partial_volume += partial_volume
 
     # merge files using partial volume information (and convert nan resulting from division by zero to zeros)
-    data_merge = np.divide(np.sum(data * partial_volume, axis=3), np.sum(partial_volume, axis=3))
+    data_merge = np.divide(sum_data, sum_partial_volume)
     data_merge = np.nan_to_num(data_merge)
 
     # write result in file
@@ -165,10 +151,62 @@ def merge_images(list_fname_src, fname_dest, list_fname_warp, param):
     nii_dest.save(param.fname_out)
 
     # remove temporary folder
-    if param.rm_tmp:
+    if param.rm_tmp and path_tmp is not None:
         sct.rmtree(path_tmp)
 
 
+def warp_with_partial_volume(im_src, im_warp, im_dest, param):
+    """
+    Warp a source image and its binary mask (non-null voxels) to the destination space in-process, with the same
+    sampling coordinates.
+    :param im_src: Image: source image
+    :param im_warp: Image: ITK displacement field from the destination to the source space
+    :param im_dest: Image: destination image
+    :param param: Param
+    :return: tuple (data, partial_volume): 3d arrays in the destination space
+    """
+    coordinates = get_sampling_coordinates(im_warp, im_dest.data.shape[:3], im_dest.hdr.get_best_affine(),
+                                           im_src.hdr.get_best_affine())
+    order = DICT_ORDER[DICT_INTERP_ANTS[param.interp]]
+    data = map_coordinates(im_src.data, coordinates, order=order, mode='constant', cval=0.)
+    # create binary mask from input file by assigning one to all non-null voxels
+    mask = sct_maths.binarise(im_src.data, bin_thr=param.almost_zero).astype(np.float64)
+    partial_volume = map_coordinates(mask, coordinates, order=order, mode='constant', cval=0.)
+    return data, partial_volume
+
+
+def apply_transfo_with_partial_volume(fname_src, fname_warp, fname_dest, prefix_tmp, param):
+    """
+    Same as warp_with_partial_volume(), for any transformation supported by sct_apply_transfo.
+    :param prefix_tmp: str: prefix of the temporary files
+    :return: tuple (data, partial_volume): 3d arrays in the destination space
+    """
+    # apply transformation src --> dest
+    sct_apply_transfo.main(args=[
+        '-i', fname_src,
+        '-d', fname_dest,
+        '-w', fname_warp,
+        '-x', param.interp,
+        '-o', prefix_tmp + '_template.nii.gz',
+        '-v', param.verbose])
+
+    # create binary mask from input file by assigning one to all non-null voxels
+    im_bin = msct_image.Image(fname_src)
+    im_bin.data = sct_maths.binarise(im_bin.data, bin_thr=param.almost_zero).astype(np.uint8)
+    im_bin.save(prefix_tmp + '_native_bin.nii.gz', dtype='uint8')
+
+    # apply transformation to binary mask to compute partial volume
+    sct_apply_transfo.main(args=[
+        '-i', prefix_tmp + '_native_bin.nii.gz',
+        '-d', fname_dest,
+        '-w', fname_warp,
+        '-x', param.interp,
+        '-o', prefix_tmp + '_template_partialVolume.nii.gz'])
+
+    return msct_image.Image(prefix_tmp + '_template.nii.gz').data, \
+        msct_image.Image(prefix_tmp + '_template_partialVolume.nii.gz').data
+
+
 # MAIN
 # ==========================================================================================
 def main(args=None):
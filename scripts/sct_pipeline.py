@@ -45,7 +45,7 @@ usage:
 
 from __future__ import print_function, absolute_import
 
-import sys, io, os, types, copy, copy_reg, time, itertools, glob, importlib, pickle
+import sys, io, os, types, copy, copy_reg, time, itertools, glob, importlib, pickle, json, hashlib, shutil
 import platform
 import signal
 
@@ -53,7 +53,6 @@ path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 path_script = os.path.dirname(__file__)
 sys.path.append(os.path.join(path_sct, 'testing'))
 
-import concurrent.futures
 if "SCT_MPI_MODE" in os.environ:
     from mpi4py.futures import MPIPoolExecutor as PoolExecutor
     __MPI__ = True
@@ -71,6 +70,12 @@ import pandas as pd
 import sct_utils as sct
 import msct_parser
 import sct_testing
+from spinalcordtoolbox.scheduler import JobTable, run_jobs
+from spinalcordtoolbox import resources
+from spinalcordtoolbox import trace
+
+# environment variable holding the folder of the traces of the batch (see -trace)
+ENV_PIPELINE_TRACE = 'SCT_PIPELINE_TRACE'
 
 def _pickle_method(method):
     """
@@ -242,7 +247,39 @@ def read_database(folder_dataset, specifications=None, fname_database='', verbos
 #         sct.log.exception(e)
 #         raise
 
+def get_trace_folder(trace_root, job):
+    """
+    :return: str: folder in which the processes of a job write their trace
+    """
+    return os.path.join(trace_root, '{}_{}'.format(os.path.basename(job[1]),
+                                                   hashlib.md5(json.dumps(list(job)).encode()).hexdigest()[:8]))
+
+
 def function_launcher(args):
+    # apply the thread budget exported by run_function to the libraries already loaded in the worker
+    resources.limit_threads()
+    trace_root = os.environ.get(ENV_PIPELINE_TRACE)
+    trace_saved = os.environ.get(trace.ENV_TRACE)
+    if trace_root:
+        # the worker and the commands it runs write their trace in the folder of the job (atexit does not run in
+        # the worker, so its trace is exported explicitly)
+        folder_trace = get_trace_folder(trace_root, args)
+        if os.path.isdir(folder_trace):
+            shutil.rmtree(folder_trace)  # previous attempt
+        os.environ[trace.ENV_TRACE] = folder_trace
+        trace.reset()
+    try:
+        return _run_test(args)
+    finally:
+        if trace_root:
+            trace.export(os.path.join(folder_trace, 'trace_job.json'))
+            if trace_saved is None:
+                del os.environ[trace.ENV_TRACE]
+            else:
+                os.environ[trace.ENV_TRACE] = trace_saved
+
+
+def _run_test(args):
     # append local script to PYTHONPATH for import
     path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
     sys.path.append(os.path.join(path_sct, "testing"))
@@ -312,64 +349,136 @@ def get_list_subj(folder_dataset, data_specifications=None, fname_database=''):
     return list_subj
 
 
-def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None, verbose=1, test_integrity=0):
+def get_qc_folders(list_args):
+    """
+    Retrieve the QC folders passed with the "-qc" flag
+    :param list_args: list of str: arguments of the function to test
+    :return: list of str: QC folders, in the order of appearance
+    """
+    import shlex
+    list_path_qc = []
+    for args in list_args:
+        list_tokens = shlex.split(args)
+        for i, token in enumerate(list_tokens[:-1]):
+            if token == '-qc' and list_tokens[i + 1] not in list_path_qc:
+                list_path_qc.append(list_tokens[i + 1])
+    return list_path_qc
+
+
+def is_crashed(result):
+    """Test function crashed (see function_launcher)"""
+    return bool((result['status'] == 1).all())
+
+
+def dataframe_to_json(results):
+    """Convert the results of a job to a JSON serializable object, to record them in the job table"""
+    return json.loads(results.to_json(orient='split'))
+
+
+def dataframe_from_json(obj):
+    return pd.DataFrame(data=obj['data'], index=obj['index'], columns=obj['columns'])
+
+
+def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None, verbose=1, test_integrity=0,
+                 fname_job_table=None, max_retries=1, nb_threads=None, trace_folder=None):
     """
     Run a test function on the dataset using multiprocessing and save the results
+    :param nb_cpu: int: number of CPU cores shared by the jobs. Default: all available cores.
+    :param nb_threads: int: number of threads per job. Default: depends on the function, see
+      spinalcordtoolbox.resources.get_budget
+    :param fname_job_table: str: file in which the status, duration and results of each job are recorded as soon as
+      the job is finished. If the file exists, only the jobs which are not done are run. See spinalcordtoolbox.scheduler
+    :param max_retries: int: number of times a crashed job is run again
+    :param trace_folder: str: if set, the stages of each job are traced (see spinalcordtoolbox.trace), and merged into
+      trace_folder/trace.json with one row per job
     :return: results
     # results are organized as the following: tuple of (status, output, DataFrame with results)
     """
 
     # add full path to each subject
     list_subj_path = [os.path.join(folder_dataset, subject) for subject in list_subj]
-
-    # All scripts that are using multithreading with ITK must not use it when using multiprocessing
-    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = "1"
+    job_table = JobTable(fname_job_table)
+
+    # Split the cores between concurrent jobs, and export the number of threads per job to ITK, OpenMP, BLAS and
+    # TensorFlow, to avoid oversubscription. The variables are inherited by the workers, which apply the budget to
+    # their own libraries (see function_launcher): the libraries of the current process are left as is.
+    nb_jobs, nb_threads = resources.get_budget(nb_cpu if nb_cpu is not None else cpu_count(), function=function,
+                                               nb_threads=nb_threads)
+    env_threads = resources.get_thread_env(nb_threads)
+    # the environment variables set for the jobs are restored at the end (e.g. when called from another script)
+    env_saved = dict([(var, os.environ.get(var)) for var in
+                      list(env_threads) + ["SCT_QC_DEFER_INDEX", ENV_PIPELINE_TRACE]])
+    sct.log.info('Running {} concurrent job(s) with {} thread(s) each'.format(nb_jobs, nb_threads))
+
+    # If all jobs write to shared QC folders, only append entries during the run, and generate each html index once at
+    # the end. Relative QC folders are created in the output folder of each job, so they are left as is.
+    list_path_qc = get_qc_folders(list_args)
+    os.environ.update(env_threads)
+    defer_qc_index = len(list_path_qc) > 0 and all([os.path.isabs(path_qc) for path_qc in list_path_qc])
+    if defer_qc_index:
+        os.environ["SCT_QC_DEFER_INDEX"] = "1"
 
     # create list that finds all the combinations for function + subject path + arguments. Example of one list element:
     # ('sct_propseg', os.path.join(path_sct, 'data', 'sct_test_function', '200_005_s2''), '-i ' + os.path.join("t2", "t2.nii.gz") + ' -c t2', 1)
     list_func_subj_args = list(itertools.product(*[[function], list_subj_path, list_args, [test_integrity]]))
         # data_and_params = itertools.izip(itertools.repeat(function), data_subjects, itertools.repeat(parameters))
 
-    sct.log.debug("stating pool with {} thread(s)".format(nb_cpu))
-    pool = PoolExecutor(nb_cpu)
+    if trace_folder is not None:
+        trace_folder = os.path.abspath(trace_folder)
+        os.environ[ENV_PIPELINE_TRACE] = trace_folder
+
+    sct.log.debug("stating pool with {} process(es)".format(nb_jobs))
     compute_time = None
+    results_dataframe = None
     try:
         compute_time = time.time()
-        count = 0
-        all_results = []
-
-        # sct.log.info('Waiting for results, be patient')
-        future_dirs = {pool.submit(function_launcher, subject_arg): subject_arg
-                         for subject_arg in list_func_subj_args}
-
-        for future in concurrent.futures.as_completed(future_dirs):
-            count += 1
-            subject = os.path.basename(future_dirs[future][1])
-            arguments = future_dirs[future][2]
-            try:
-                result = future.result()
-                sct.no_new_line_log('Processing subjects... {}/{}'.format(count, len(list_func_subj_args)))
-                all_results.append(result)
-            except Exception as exc:
-                sct.log.error('{} {} generated an exception: {}'.format(subject, arguments, exc))
+        count = [0]
+
+        def display_progress(job, result, record):
+            count[0] += 1
+            if record['error'] is not None:
+                sct.log.error('{} {} generated an exception: {}'.format(os.path.basename(job[1]), job[2],
+                                                                          record['error']))
+            sct.no_new_line_log('Processing subjects... {}/{}'.format(count[0], len(list_func_subj_args)))
+
+        all_results = run_jobs(function_launcher, list_func_subj_args, lambda: PoolExecutor(nb_jobs),
+                               job_table=job_table, max_retries=max_retries, is_failed=is_crashed,
+                               serialize=dataframe_to_json, deserialize=dataframe_from_json, group_key=1,
+                               callback=display_progress)
 
         compute_time = time.time() - compute_time
 
         # concatenate all_results into single Panda structure
-        results_dataframe = pd.concat(all_results)
+        results_dataframe = pd.concat([result for result in all_results if result is not None])
 
     except KeyboardInterrupt:
         sct.log.warning("\nCaught KeyboardInterrupt, terminating workers")
-        for job in future_dirs:
-            job.cancel()
+        if fname_job_table:
+            sct.log.warning("Finished jobs are saved in {}: run the same command to resume".format(fname_job_table))
     except Exception as e:
         sct.log.error('Error on line {}'.format(sys.exc_info()[-1].tb_lineno))
         sct.log.exception(e)
-        for job in future_dirs:
-            job.cancel()
         raise
     finally:
-        pool.shutdown()
+        for var, value in env_saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        if defer_qc_index:
+            from spinalcordtoolbox.reports.store import generate_index
+            for path_qc in list_path_qc:
+                if os.path.isdir(path_qc):
+                    generate_index(path_qc)
+        if trace_folder is not None:
+            groups = []
+            for job in list_func_subj_args:
+                list_fname = sorted(glob.glob(os.path.join(get_trace_folder(trace_folder, job), 'trace_*.json')))
+                if list_fname:
+                    groups.append(('{} {}'.format(os.path.basename(job[1]), job[2]), list_fname))
+            fname_trace = os.path.join(trace_folder, 'trace.json')
+            trace.merge_traces(groups, fname_trace)
+            sct.log.info('Trace of the jobs: {} (open with chrome://tracing)'.format(fname_trace))
 
     return {'results': results_dataframe, "compute_time": compute_time}
 
@@ -417,12 +526,20 @@ def get_parser():
 
     parser.add_option(name="-j",
                       type_value="int",
-                      description="Number of threads for parallel computing (one subject per thread)."
-                                  " By default, all available CPU cores will be used. Set to 0 for"
-                                  " no multiprocessing.",
+                      description="Number of CPU cores used for parallel computing. They are split between concurrent"
+                                  " jobs (one subject per job) according to -threads-per-job."
+                                  " By default, all available CPU cores will be used.",
                       mandatory=False,
                       example='42')
 
+    parser.add_option(name="-threads-per-job",
+                      type_value="int",
+                      description="Number of threads used by each job (ITK, OpenMP, BLAS, TensorFlow). The number of "
+                                  "concurrent jobs is the number of cores divided by this value. By default, 4 for "
+                                  "functions dominated by ITK (registration, straightening, warping), 1 otherwise.",
+                      mandatory=False,
+                      example='4')
+
     parser.add_option(name="-test-integrity",
                       type_value="multiple_choice",
                       description="Run (=1) or not (=0) integrity testing which is defined in test_integrity() function of the test_ script. See example here: https://github.com/neuropoly/spinalcordtoolbox/blob/master/testing/test_sct_propseg.py",
@@ -430,6 +547,28 @@ def get_parser():
                       example=['0', '1'],
                       default_value='0')  # TODO: this should have values True/False as defined in sct_testing, not 0/1
 
+    parser.add_option(name="-job-table",
+                      type_value="str",
+                      description="File in which the status, duration and results of each job are recorded as soon as "
+                                  "the job is finished. If the file already exists (e.g. run interrupted or pre-empted), "
+                                  "only the jobs which are not done are run, and the longest jobs are started first.",
+                      mandatory=False,
+                      example="jobs_sct_propseg.jsonl")
+
+    parser.add_option(name="-retry",
+                      type_value="int",
+                      description="Number of times a crashed job is run again (with an increasing delay).",
+                      mandatory=False,
+                      default_value=1)
+
+    parser.add_option(name="-trace",
+                      type_value="folder_creation",
+                      description="Record the duration of the processing stages, commands and image I/O of each job "
+                                  "in this folder, and merge them into a single trace (trace.json, which can be "
+                                  "opened with chrome://tracing).",
+                      mandatory=False,
+                      example="trace_sct_propseg")
+
     parser.usage.addSection("\nOUTPUT")
 
     parser.add_option(name="-log",
@@ -501,6 +640,10 @@ if __name__ == "__main__":
     else:
         jobs = cpu_count()  # uses maximum number of available CPUs
     test_integrity = int(arguments['-test-integrity'])
+    nb_threads = arguments['-threads-per-job'] if '-threads-per-job' in arguments else None
+    fname_job_table = os.path.abspath(arguments['-job-table']) if '-job-table' in arguments else None
+    max_retries = int(arguments['-retry'])
+    trace_folder = arguments['-trace'] if '-trace' in arguments else None
     create_log = int(arguments['-log'])
     output_pickle = int(arguments['-pickle'])
 
@@ -585,7 +728,9 @@ if __name__ == "__main__":
             sct.remove_handler(file_handler)
         # run function
         sct.log.debug("enter test fct")
-        tests_ret = run_function(function_to_test, path_data, list_subj, list_args=list_args, nb_cpu=jobs, verbose=1, test_integrity=test_integrity)
+        tests_ret = run_function(function_to_test, path_data, list_subj, list_args=list_args, nb_cpu=jobs, verbose=1,
+                                 test_integrity=test_integrity, fname_job_table=fname_job_table,
+                                 max_retries=max_retries, nb_threads=nb_threads, trace_folder=trace_folder)
         sct.log.debug("exit test fct")
         results = tests_ret['results']
         compute_time = tests_ret['compute_time']
@@ -42,6 +42,7 @@ from msct_parser import Parser
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.reports.qc import generate_qc
+from spinalcordtoolbox import trace
 
 
 def get_parser(paramreg=None):
@@ -499,24 +500,28 @@ def main(args=None):
                      sct.add_suffix(src, '_reg'), '-x', interp_step], verbose)
             src = sct.add_suffix(src, '_reg')
         # register src --> dest
-        warp_forward_out, warp_inverse_out = register(src, dest, paramreg, param, str(i_step))
+        with trace.stage('register: step ' + str(i_step), type=paramreg.steps[str(i_step)].type,
+                         algo=paramreg.steps[str(i_step)].algo):
+            warp_forward_out, warp_inverse_out = register(src, dest, paramreg, param, str(i_step))
         warp_forward.append(warp_forward_out)
         warp_inverse.insert(0, warp_inverse_out)
 
     # Concatenate transformations
     sct.printv('\nConcatenate transformations...', verbose)
-    sct.run(['sct_concat_transfo', '-w', ','.join(warp_forward), '-d', 'dest.nii', '-o', 'warp_src2dest.nii.gz'],
-            verbose)
-    sct.run(['sct_concat_transfo', '-w', ','.join(warp_inverse), '-d', 'src.nii', '-o', 'warp_dest2src.nii.gz'],
-            verbose)
+    with trace.stage('register: concatenate transformations'):
+        sct.run(['sct_concat_transfo', '-w', ','.join(warp_forward), '-d', 'dest.nii', '-o', 'warp_src2dest.nii.gz'],
+                verbose)
+        sct.run(['sct_concat_transfo', '-w', ','.join(warp_inverse), '-d', 'src.nii', '-o', 'warp_dest2src.nii.gz'],
+                verbose)
 
     # Apply warping field to src data
-    sct.printv('\nApply transfo source --> dest...', verbose)
-    sct.run(['sct_apply_transfo', '-i', 'src.nii', '-o', 'src_reg.nii', '-d', 'dest.nii', '-w', 'warp_src2dest.nii.gz',
-             '-x', interp], verbose)
-    sct.printv('\nApply transfo dest --> source...', verbose)
-    sct.run(['sct_apply_transfo', '-i', 'dest.nii', '-o', 'dest_reg.nii', '-d', 'src.nii', '-w', 'warp_dest2src.nii.gz',
-             '-x', interp], verbose)
+    with trace.stage('register: apply transformations'):
+        sct.printv('\nApply transfo source --> dest...', verbose)
+        sct.run(['sct_apply_transfo', '-i', 'src.nii', '-o', 'src_reg.nii', '-d', 'dest.nii', '-w',
+                 'warp_src2dest.nii.gz', '-x', interp], verbose)
+        sct.printv('\nApply transfo dest --> source...', verbose)
+        sct.run(['sct_apply_transfo', '-i', 'dest.nii', '-o', 'dest_reg.nii', '-d', 'src.nii', '-w',
+                 'warp_dest2src.nii.gz', '-x', interp], verbose)
 
     # come back
     os.chdir(curdir)
@@ -23,6 +23,7 @@ import tqdm
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.centerline.core import get_centerline
+from spinalcordtoolbox import trace
 from msct_parser import Parser
 from msct_types import Centerline
 from sct_apply_transfo import Transform
@@ -67,6 +68,85 @@ def _get_centerline(img, algo_fitting, verbose):
                       x_centerline_deriv.tolist(), y_centerline_deriv.tolist(), z_centerline_deriv.tolist())
 
 
+def trim_lookup_table(lookup):
+    """
+    Set to 0 the entries at both ends of a lookup table between centerlines which are equal to their neighbour (i.e.
+    consecutive centerline points mapped on the same point), so that the corresponding voxels are excluded from the
+    warping fields.
+    :param lookup: 1d array of int: index of the corresponding point on the other centerline
+    :return: 1d array of int
+    """
+    lookup = np.array(lookup)
+    n = len(lookup)
+    half = n // 2
+    # beginning of the table: [0, half[ (each entry is compared with the next one)
+    same_head = lookup[:half] == lookup[1:half + 1]
+    first_diff_head = half if same_head.all() else np.argmin(same_head)
+    # end of the table: ]half, n[ (each entry is compared with the previous one)
+    diff_tail = np.flatnonzero(lookup[half + 1:] != lookup[half:n - 1])
+    last_diff_tail = half + 1 + diff_tail[-1] if len(diff_tail) else half
+    lookup[:first_diff_head] = 0
+    lookup[last_diff_tail + 1:] = 0
+    return lookup
+
+
+def compute_warping_field(shape, affine, centerline_src, centerline_dest, lookup, threshold_distance, rotate=True,
+                          nb_voxels_slab=2 ** 20, verbose=1):
+    """
+    Compute a warping field (ITK convention) on the grid of an image. Each voxel is associated to the nearest plane of
+    the source centerline, expressed in the coordinate system of this plane, and moved to the corresponding plane of
+    the destination centerline. The grid is processed by slabs of slices, and only the voxels within threshold_distance
+    of their plane are evaluated.
+    :param shape: (nx, ny, nz) shape of the grid on which the warping field is defined
+    :param affine: 4x4 voxel-to-physical matrix of this grid
+    :param centerline_src: Centerline in the space of the grid
+    :param centerline_dest: Centerline in the destination space
+    :param lookup: 1d array of int: index of the point of centerline_dest which corresponds to each point of
+      centerline_src. Points with index 0 are excluded.
+    :param threshold_distance: float: maximum distance (mm) between a voxel and its plane
+    :param rotate: bool: if True, in-plane coordinates are expressed in the coordinate system of the destination plane.
+      Otherwise (straight destination centerline), the in-plane coordinates and the distance to the plane are added to
+      the destination point.
+    :param nb_voxels_slab: int: approximate number of voxels processed at once (bounds memory usage)
+    :param verbose:
+    :return: float32 ndarray of shape (nx, ny, nz, 1, 3). Voxels outside of the band are set to -100000.
+    """
+    nx, ny, nz = shape
+    data_warp = np.empty((nx, ny, nz, 1, 3), dtype=np.float32)
+    nb_slices = int(max(1, nb_voxels_slab // (nx * ny)))
+    for z0 in tqdm.tqdm(range(0, nz, nb_slices), disable=not verbose):
+        z1 = min(nz, z0 + nb_slices)
+        indexes = np.mgrid[0:nx, 0:ny, z0:z1].reshape(3, -1)
+        physical_coordinates = (np.dot(affine[:3, :3], indexes) + affine[:3, 3:]).T
+        nearest_indexes = centerline_src.find_nearest_indexes(physical_coordinates)
+        distances = centerline_src.get_distances_from_planes(physical_coordinates, nearest_indexes)
+        lookup_nearest = lookup[nearest_indexes]
+        inside = ~((distances > threshold_distance) | (distances < -threshold_distance) | (lookup_nearest == 0))
+
+        # only voxels in the band around the centerline are projected
+        physical_coordinates, nearest_indexes = physical_coordinates[inside], nearest_indexes[inside]
+        distances, lookup_nearest = distances[inside], lookup_nearest[inside]
+        projected_points = centerline_src.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+        coord_in_planes = centerline_src.get_in_plans_coordinates(projected_points, nearest_indexes)
+        if rotate:
+            coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup_nearest)
+        else:
+            coord_dest = centerline_dest.points[lookup_nearest]
+            coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+            coord_dest[:, 2] += distances
+        displacements = coord_dest - physical_coordinates
+        # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
+        # while ours is LPI-
+        # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
+        #  https://www.slicer.org/wiki/Coordinate_systems
+        displacements[:, 2] = -displacements[:, 2]
+
+        data_slab = np.full((len(inside), 3), -100000.0, dtype=np.float32)
+        data_slab[inside] = -displacements
+        data_warp[:, :, z0:z1, 0, :] = data_slab.reshape(nx, ny, z1 - z0, 3)
+    return data_warp
+
+
 class SpinalCordStraightener(object):
 
     def __init__(self, input_filename, centerline_filename, debug=0, deg_poly=10,
@@ -218,7 +298,10 @@ class SpinalCordStraightener(object):
             else:
                 number_of_points = nz
 
+            trace.add_event('straighten: prepare centerline', start_time, time.time() - start_time)
+
             # 2. extract bspline fitting of the centerline, and its derivatives
+            time_fitting = time.time()
             img_ctl = Image('centerline_rpi.nii.gz')
             centerline = _get_centerline(img_ctl, algo_fitting, verbose)
             number_of_points = centerline.number_of_points
@@ -456,17 +539,7 @@ class SpinalCordStraightener(object):
                         lookup_curved2straight[index] = idx_closest
                     else:
                         lookup_curved2straight[index] = 0
-            for p in range(0, len(lookup_curved2straight)//2):
-                if lookup_curved2straight[p] == lookup_curved2straight[p + 1]:
-                    lookup_curved2straight[p] = 0
-                else:
-                    break
-            for p in range(len(lookup_curved2straight)-1, len(lookup_curved2straight)//2, -1):
-                if lookup_curved2straight[p] == lookup_curved2straight[p - 1]:
-                    lookup_curved2straight[p] = 0
-                else:
-                    break
-            lookup_curved2straight = np.array(lookup_curved2straight)
+            lookup_curved2straight = trim_lookup_table(lookup_curved2straight)
 
             lookup_straight2curved = list(range(centerline_straight.number_of_points))
             if self.discs_input_filename != "":
@@ -479,81 +552,30 @@ class SpinalCordStraightener(object):
                     idx_closest = centerline.get_closest_to_absolute_position(disc_label, relative_position, backup_index=index, backup_centerline=centerline_straight, mode=alignment_mode)
                     if idx_closest is not None:
                         lookup_straight2curved[index] = idx_closest
-            for p in range(0, len(lookup_straight2curved)//2):
-                if lookup_straight2curved[p] == lookup_straight2curved[p + 1]:
-                    lookup_straight2curved[p] = 0
-                else:
-                    break
-            for p in range(len(lookup_straight2curved)-1, len(lookup_straight2curved)//2, -1):
-                if lookup_straight2curved[p] == lookup_straight2curved[p - 1]:
-                    lookup_straight2curved[p] = 0
-                else:
-                    break
-            lookup_straight2curved = np.array(lookup_straight2curved)
+            lookup_straight2curved = trim_lookup_table(lookup_straight2curved)
 
-            # Create volumes containing curved and straight warping fields
-            time_generation_volumes = time.time()
-            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
+            trace.add_event('straighten: fit centerline and straight space', time_fitting, time.time() - time_fitting)
 
             # 5. compute transformations
-            # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
-            # b. determine which plane of spinal cord centreline it is included
-            # sct.printv(nx * ny * nz, nx_s * ny_s * nz_s)
-
+            # Create volumes containing curved and straight warping fields
+            time_generation_volumes = time.time()
             if self.curved2straight:
-                for u in tqdm.tqdm(range(nz_s)):
-                    x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u + 1]
-                    indexes_straight = np.array(list(zip(x_s.ravel(), y_s.ravel(), z_s.ravel())))
-                    physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                    nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                    distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    lookup = lookup_straight2curved[nearest_indexes_straight]
-                    indexes_out_distance_straight = np.logical_or(np.logical_or(distances_straight > self.threshold_distance, distances_straight < -self.threshold_distance), lookup == 0)
-                    projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight, nearest_indexes_straight)
-
-                    coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup)
-                    displacements_straight = coord_straight2curved - physical_coordinates_straight
-                    # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
-                    # while ours is LPI-
-                    # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
-                    #  https://www.slicer.org/wiki/Coordinate_systems
-                    displacements_straight[:, 2] = -displacements_straight[:, 2]
-                    displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :] = -displacements_straight
-
+                data_warp_curved2straight = compute_warping_field(
+                    (nx_s, ny_s, nz_s), image_centerline_straight.hdr.get_best_affine(), centerline_straight,
+                    centerline, lookup_straight2curved, self.threshold_distance, rotate=True, verbose=verbose)
             if self.straight2curved:
-                for u in tqdm.tqdm(range(nz)):
-                    x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
-                    indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
-                    physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                    nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                    distances_curved = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes_curved)
-                    lookup = lookup_curved2straight[nearest_indexes_curved]
-                    indexes_out_distance_curved = np.logical_or(np.logical_or(distances_curved > self.threshold_distance, distances_curved < -self.threshold_distance), lookup == 0)
-                    projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes_curved)
-                    coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved, nearest_indexes_curved)
-
-                    coord_curved2straight = centerline_straight.points[lookup]
-                    coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                    coord_curved2straight[:, 2] += distances_curved
-
-                    displacements_curved = coord_curved2straight - physical_coordinates
-
-                    displacements_curved[:, 2] = -displacements_curved[:, 2]
-                    displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+                data_warp_straight2curved = compute_warping_field(
+                    (nx, ny, nz), image_centerline_pad.hdr.get_best_affine(), centerline, centerline_straight,
+                    lookup_curved2straight, self.threshold_distance, rotate=False, verbose=verbose)
 
             # Creation of the safe zone based on pre-calculated safe boundaries
             coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
             coord_bound_straight_inf, coord_bound_straight_sup = image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
 
-            if radius_safe > 0:
+            if radius_safe > 0 and self.curved2straight:
                 data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
                 data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
+            if radius_safe > 0 and self.straight2curved:
                 data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
                 data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
 
@@ -572,6 +594,9 @@ class SpinalCordStraightener(object):
                 save(img, 'tmp.straight2curve.nii.gz')
                 sct.printv('\nDONE ! Warping field generated: tmp.straight2curve.nii.gz', verbose)
 
+            trace.add_event('straighten: compute warping fields', time_generation_volumes,
+                            time.time() - time_generation_volumes)
+
             image_centerline_straight.save(fname_ref)
             if self.curved2straight:
                 sct.printv('\nApply transformation to input image...', verbose)
@@ -623,6 +648,7 @@ class SpinalCordStraightener(object):
                 self.mse_straightening = np.sqrt(self.mse_straightening / float(count_mean))
 
                 self.elapsed_time_accuracy = time.time() - time_accuracy_results
+                trace.add_event('straighten: accuracy results', time_accuracy_results, self.elapsed_time_accuracy)
 
         except Exception as e:
             sct.printv('WARNING: Exception during Straightening:', 1, 'warning')
@@ -16,12 +16,14 @@
 from __future__ import print_function, division, absolute_import
 
 import sys, io, os, re, time, datetime
+import collections
 import errno
 import logging
 import logging.config
 import shutil
 import subprocess
 import tempfile
+import threading
 
 import numpy as np
 
@@ -29,15 +31,20 @@ if os.getenv('SENTRY_DSN', None):
     # do no import if Sentry is not set (i.e., if variable SENTRY_DSN is not defined)
     import raven
 
+import shlex
 if sys.hexversion < 0x03030000:
     import pipes
     def list2cmdline(lst):
         return " ".join(pipes.quote(x) for x in lst)
 else:
-    import shlex
     def list2cmdline(lst):
         return " ".join(shlex.quote(x) for x in lst)
 
+if sys.hexversion < 0x03000000:
+    from StringIO import StringIO
+else:
+    from io import StringIO
+
 
 
 
@@ -177,7 +184,15 @@ def start_stream_logger():
 
     formatter = logging.Formatter(LOG_FORMAT)
     stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(get_stream_log_level())
+    log.addHandler(stream_handler)
 
+
+def get_stream_log_level():
+    """ Level of the terminal log, set with SCT_LOG_LEVEL
+
+    :return: logging level
+    """
     if LOG_LEVEL == "DISABLE":
         level = sys.maxsize
     elif LOG_LEVEL is None:
@@ -187,8 +202,7 @@ def start_stream_logger():
         if level is None:
             logging.warn("SCT_LOG_LEVEL set to invalid value -> using default")
             level = logging.INFO
-    stream_handler.setLevel(level)
-    log.addHandler(stream_handler)
+    return level
 
 
 def init_error_client():
@@ -431,7 +445,27 @@ def run_old(cmd, verbose=1):
         return status, output
 
 
-def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None):
+def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None, timeout=None, capture_output=True,
+        output_file=None, max_output_lines=None):
+    """
+    Run a command, and return its status and output (stdout and stderr merged).
+
+    The wall time, CPU time and peak memory of the command are kept in last_run_stats, and appended to the file
+    given by the environment variable SCT_RUN_STATS (one JSON object per line), if it is set.
+
+    :param cmd: command (list, or string, which is run in a shell)
+    :param verbose: 0: nothing, 1: display the command, 2: also display the output of the command as it is produced
+    :param raise_exception: raise RunError if the status is not 0
+    :param cwd: working directory of the command
+    :param env: environment of the command
+    :param timeout: float: the command is killed after this number of seconds
+    :param capture_output: bool: if False, the output is not read by Python (it is discarded, unless output_file is
+      set), and an empty output is returned
+    :param output_file: str: write the output to this file. It goes directly from the command to the file, unless
+      verbose == 2.
+    :param max_output_lines: int: only keep the last lines of the output (ring buffer). Default: all lines.
+    :return: tuple (status, output)
+    """
     # if verbose == 2:
     #     printv(sys._getframe().f_back.f_code.co_name, 1, 'process')
 
@@ -452,26 +486,80 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None):
     if verbose:
         printv("%s # in %s" % (cmdline, cwd), 1, 'code')
 
-    shell = isinstance(cmd, str)
-
-    process = subprocess.Popen(cmd, shell=shell, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
-    output_final = ''
-    while True:
-        # Watch out for deadlock!!!
-        output = process.stdout.readline().decode("utf-8")
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            if verbose == 2:
-                printv(output.strip())
-            output_final += output.strip() + '\n'
+    # a timeout or an output file require a separate process
+    args = _get_in_process_args(cmd, env) if timeout is None and output_file is None else None
+    if args is not None:
+        time_start, cpu_start = time.time(), sum(os.times()[:2])
+        status, output = _run_in_process(args, verbose, cwd)
+        _record_run_stats(cmdline, cwd, status, time.time() - time_start, sum(os.times()[:2]) - cpu_start,
+                          _get_max_rss(_getrusage_self()), in_process=True)
+        if max_output_lines is not None:
+            output = '\n'.join(output.split('\n')[-max_output_lines:])
+        if status != 0 and raise_exception:
+            raise RunError(output)
+        return status, output
 
-    status = process.returncode
-    output = output_final.rstrip()
+    shell = isinstance(cmd, str)
+    # the output goes through a pipe only if Python needs to read it
+    use_pipe = verbose == 2 or (capture_output and output_file is None)
+    file_output = open(output_file, 'wb') if output_file is not None else None
+    if use_pipe:
+        stdout = subprocess.PIPE
+    elif file_output is not None:
+        stdout = file_output
+    else:
+        stdout = open(os.devnull, 'wb')
+
+    time_start = time.time()
+    # with a timeout, the command runs in its own process group, so that the children of a shell are also killed
+    new_group = timeout is not None and hasattr(os, 'killpg')
+    process = subprocess.Popen(cmd, shell=shell, cwd=cwd, stdin=subprocess.PIPE, stdout=stdout,
+                               stderr=subprocess.STDOUT, env=env, preexec_fn=os.setsid if new_group else None)
+    timed_out = threading.Event()
+    if timeout is not None:
+        def kill():
+            timed_out.set()
+            try:
+                if new_group:
+                    os.killpg(process.pid, 9)
+                else:
+                    process.kill()
+            except OSError:  # already terminated
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
 
-    # process.stdin.close()
-    # process.stdout.close()
-    # process.terminate()
+    try:
+        lines = collections.deque(maxlen=max_output_lines)
+        if use_pipe:
+            # blocks until a line is available: no polling
+            for line in iter(process.stdout.readline, b''):
+                if file_output is not None:
+                    file_output.write(line)
+                line = line.decode("utf-8", "replace").strip()
+                if verbose == 2:
+                    printv(line)
+                if capture_output:
+                    lines.append(line)
+            process.stdout.close()
+        status, rusage = _wait_process(process)
+    finally:
+        if timeout is not None:
+            timer.cancel()
+        if file_output is not None:
+            file_output.close()
+        elif not use_pipe:
+            stdout.close()
+
+    if capture_output and output_file is not None and not use_pipe:
+        with io.open(output_file, 'r', encoding='utf-8', errors='replace') as f:
+            lines.extend([line.strip() for line in f])
+    output = '\n'.join(lines).rstrip()
+    if timed_out.is_set():
+        output = (output + '\n' if output else '') + 'Command timed out after {}s'.format(timeout)
+
+    _record_run_stats(cmdline, cwd, status, time.time() - time_start,
+                      rusage.ru_utime + rusage.ru_stime if rusage is not None else None, _get_max_rss(rusage))
 
     if status != 0 and raise_exception:
         raise RunError(output)
@@ -479,6 +567,167 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None):
     return status, output
 
 
+def _wait_process(process):
+    """
+    Wait for a child process to terminate.
+    :return: tuple (status, resource usage of the child and its descendants, or None if not available)
+    """
+    if not hasattr(os, 'wait4'):  # Windows
+        return process.wait(), None
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+def _getrusage_self():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF)
+
+
+def _get_max_rss(rusage):
+    """
+    :return: peak resident memory in MB, from a resource usage structure (or None)
+    """
+    if rusage is None:
+        return None
+    # ru_maxrss is in bytes on macOS, in kB on Linux
+    return rusage.ru_maxrss / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+
+
+# statistics of the last command run with run(): dict with keys cmd, cwd, status, wall_time (s), cpu_time (s),
+# max_rss (MB), in_process
+last_run_stats = None
+
+
+def _record_run_stats(cmdline, cwd, status, wall_time, cpu_time, max_rss, in_process=False):
+    global last_run_stats
+    last_run_stats = {
+        'cmd': cmdline,
+        'cwd': cwd,
+        'status': status,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'max_rss': max_rss,
+        'in_process': in_process,
+        'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    log.debug('Command stats: %s', last_run_stats)
+    from spinalcordtoolbox import trace
+    trace.add_event(os.path.basename(cmdline.split(' ', 1)[0]), time.time() - wall_time, wall_time, category='run',
+                    args=last_run_stats)
+    fname_stats = os.environ.get('SCT_RUN_STATS')
+    if fname_stats:
+        import json
+        with open(fname_stats, 'a') as f:
+            f.write(json.dumps(last_run_stats) + '\n')
+
+
+# sct_* commands that run() executes within the calling Python process instead of spawning a new interpreter, with
+# the name of their entry point. Only scripts whose entry point reads its arguments from sys.argv and which do not keep
+# state between calls (except for the module-level "param", which is re-initialized) should be listed here.
+# Set SCT_RUN_IN_PROCESS=0 to always use a subprocess.
+IN_PROCESS_COMMANDS = {
+    'sct_apply_transfo': 'main',
+    'sct_concat_transfo': 'main',
+    'sct_convert': 'main',
+    'sct_image': 'main',
+    'sct_label_utils': 'main',
+    'sct_maths': 'main',
+    'sct_resample': 'run_main',
+}
+
+
+def _get_in_process_args(cmd, env):
+    """
+    Check if a command can be dispatched in-process by run().
+    :param cmd: command (list or string)
+    :param env: environment requested for the command
+    :return: list of arguments (starting with the command name), or None if the command must run in a subprocess
+    """
+    if os.getenv('SCT_RUN_IN_PROCESS', '1') == '0':
+        return None
+    # a custom environment (e.g. number of ITK threads) can only be honoured by a new process
+    if env is not None and env is not os.environ and dict(env) != dict(os.environ):
+        return None
+    # sys.argv, sys.stdout and the current directory are process-wide: only the main thread can swap them
+    if threading.current_thread().name != 'MainThread':
+        return None
+    if isinstance(cmd, str):
+        # pipes, redirections, variables, globs etc. need a shell
+        if re.search(r'[|&;<>()$`*?~{}\[\]\n]', cmd):
+            return None
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            return None
+    else:
+        args = [str(arg) for arg in cmd]
+    if not args or args[0] not in IN_PROCESS_COMMANDS:
+        return None
+    return args
+
+
+def _run_in_process(args, verbose, cwd):
+    """
+    Run a sct_* command within the current process, as if it had been launched from the terminal: sys.argv, the
+    working directory and the module-level param are set for the call, and everything the script logs or prints is
+    captured instead of being sent to the terminal (unless verbose == 2).
+    :param args: list of arguments, starting with the command name
+    :param verbose:
+    :param cwd: working directory of the command
+    :return: status, output (same as run())
+    """
+    import importlib
+    import traceback
+
+    name = args[0]
+    buffer = StringIO()
+    capture_handler = logging.StreamHandler(buffer)
+    capture_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    capture_handler.setLevel(get_stream_log_level())
+
+    argv_orig, stdout_orig, stderr_orig = sys.argv, sys.stdout, sys.stderr
+    handlers_orig = log.handlers[:]
+    cwd_orig = os.getcwd()
+    try:
+        module = importlib.import_module(name)
+        entry_point = getattr(module, IN_PROCESS_COMMANDS[name])
+        # handlers of the caller (terminal, log file) only receive the output of the command if verbose == 2, like
+        # the output of a subprocess
+        log.handlers = [capture_handler] + (handlers_orig if verbose == 2 else [nh])
+        sys.stdout = sys.stderr = buffer
+        sys.argv = list(args)
+        os.chdir(cwd)
+        if hasattr(module, 'Param'):
+            module.param = module.Param()
+        entry_point()
+        status = 0
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            buffer.write('{}\n'.format(e.code))
+            status = 1
+    except Exception:
+        buffer.write(traceback.format_exc())
+        status = 1
+    finally:
+        os.chdir(cwd_orig)
+        sys.argv, sys.stdout, sys.stderr = argv_orig, stdout_orig, stderr_orig
+        log.handlers = handlers_orig
+
+    output = '\n'.join([line.strip() for line in buffer.getvalue().splitlines()]).rstrip()
+    return status, output
+
+
 def display_viewer_syntax(files, colormaps=[], minmax=[], opacities=[], mode='', verbose=1):
     """
     Print the syntax to open a viewer and display images for QC. To use default values, enter empty string: ''
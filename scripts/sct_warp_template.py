@@ -17,6 +17,8 @@ import sys, os
 
 import spinalcordtoolbox.metadata
 from spinalcordtoolbox.reports.qc import generate_qc
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.warp import is_displacement_field, warp_images
 from msct_parser import Parser
 import sct_utils as sct
 
@@ -38,6 +40,7 @@ class Param:
         self.list_labels_nn = ['_level.nii.gz', '_levels.nii.gz', '_csf.nii.gz', '_CSF.nii.gz', '_cord.nii.gz']  # list of files for which nn interpolation should be used. Default = linear.
         self.verbose = 1  # verbose
         self.path_qc = None
+        self.nb_workers = 4  # number of threads reading and writing the label files
 
 
 class WarpTemplate:
@@ -68,30 +71,46 @@ class WarpTemplate:
             os.makedirs(self.folder_out)
 
         # Warp template objects
-        sct.printv('\nWARP TEMPLATE:', self.verbose)
-        warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
-
+        list_folder = [self.folder_template]
         # Warp atlas
         if self.warp_atlas == 1:
-            sct.printv('\nWARP ATLAS OF WHITE MATTER TRACTS:', self.verbose)
-            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
-
+            list_folder.append(self.folder_atlas)
         # Warp spinal levels
         if self.warp_spinal_levels == 1:
-            sct.printv('\nWARP SPINAL LEVELS:', self.verbose)
-            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
-
-
-def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out):
+            list_folder.append(self.folder_spinal_levels)
+
+        list_fname_src, list_fname_out, list_interp = [], [], []
+        for folder_label in list_folder:
+            for fname_src_label, fname_out_label in get_label_files(self.path_template, folder_label,
+                                                                    param.file_info_label, self.folder_out):
+                list_fname_src.append(fname_src_label)
+                list_fname_out.append(fname_out_label)
+                list_interp.append(get_interp(fname_src_label))
+
+        sct.printv('\nWARP ' + ', '.join(list_folder).upper() + ':', self.verbose)
+        im_transfo = None
+        if sct.extract_fname(self.fname_transfo)[2] in ['.nii', '.nii.gz']:
+            im_transfo = Image(self.fname_transfo)
+        if im_transfo is not None and is_displacement_field(im_transfo):
+            # compute the sampling coordinates from the warping field once, and apply them to all the files
+            warp_images(list_fname_src, list_fname_out, list_interp, self.fname_src, im_transfo,
+                        nb_workers=param.nb_workers, verbose=self.verbose)
+        else:
+            # e.g. affine transformation: one call of isct_antsApplyTransforms per file
+            for fname_src_label, fname_out_label, interp in zip(list_fname_src, list_fname_out, list_interp):
+                sct.run('isct_antsApplyTransforms -d 3 -i %s -r %s -t %s -o %s -n %s' %
+                        (fname_src_label, self.fname_src, self.fname_transfo, fname_out_label, interp),
+                        verbose=param.verbose)
+
+
+def get_label_files(path_label, folder_label, file_label, path_out):
     """
-    Warp label files according to info_label.txt file
+    List the label files to warp according to info_label.txt file, create the output folder and copy info_label.txt
     :param path_label:
     :param folder_label:
     :param file_label:
-    :param fname_src:
-    :param fname_transfo:
     :param path_out:
-    :return:
+    :return: list of tuples (input file, output file)
     """
     try:
         # Read label file
@@ -105,19 +124,10 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
         # create output folder
         if not os.path.exists(os.path.join(path_out, folder_label)):
             os.makedirs(os.path.join(path_out, folder_label))
-        # Warp label
-        for i in range(0, len(template_label_file)):
-            fname_label = os.path.join(path_label, folder_label, template_label_file[i])
-            # apply transfo
-            sct.run('isct_antsApplyTransforms -d 3 -i %s -r %s -t %s -o %s -n %s' %
-                    (fname_label,
-                     fname_src,
-                     fname_transfo,
-                     os.path.join(path_out, folder_label, template_label_file[i]),
-                     get_interp(template_label_file[i])),
-                    verbose=param.verbose)
         # Copy list.txt
         sct.copy(os.path.join(path_label, folder_label, param.file_info_label), os.path.join(path_out, folder_label))
+        return [(os.path.join(path_label, folder_label, fname), os.path.join(path_out, folder_label, fname))
+                for fname in template_label_file]
 
 
 # Get interpolation method
@@ -17,6 +17,7 @@ import datetime
 import sct_utils as sct
 from spinalcordtoolbox.template import get_slices_from_vertebral_levels, get_vertebral_level_from_slice
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.atlas import PackedAtlas
 from spinalcordtoolbox.utils import parse_num_list_inv
 
 
@@ -49,7 +50,8 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
     """
     The aggregation will be performed along the last dimension of 'metric' ndarray.
     :param metric: Class Metric(): data to aggregate.
-    :param mask: Class Metric(): mask to use for aggregating the data. Optional.
+    :param mask: Class Metric(): mask to use for aggregating the data. Optional. Its data can be a PackedAtlas, in which
+      case only the voxels of the atlas are sampled.
     :param slices: List[int]: Slices to aggregate metric from. If empty, select all slices.
     :param levels: List[int]: Vertebral levels to aggregate metric from. It has priority over "slices".
     :param Bool perslice: Aggregate per slice (True) or across slices (False)
@@ -112,14 +114,24 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
         # Loop across functions (e.g.: MEAN, STD)
         for (name, func) in group_funcs:
             try:
-                data_slicegroup = metric.data[..., slicegroup]  # selection is done in the last dimension
-                if mask is not None:
-                    mask_slicegroup = mask.data[..., slicegroup, :]
+                if mask is not None and isinstance(mask.data, PackedAtlas):
+                    # only the voxels of the atlas are sampled: data (nb_voxels,) and weights (nb_voxels, nb_labels)
+                    data_slicegroup, mask_slicegroup = mask.data.get_samples(metric.data, slicegroup)
                     agg_metric[slicegroup]['Label'] = mask.label
-                    # Add volume fraction
-                    agg_metric[slicegroup]['Size [vox]'] = np.sum(mask_slicegroup.flatten())
+                    agg_metric[slicegroup]['Size [vox]'] = np.sum(mask_slicegroup)
+                    if func is func_max:
+                        # the maximum does not use the mask: it is computed on the whole slices
+                        data_slicegroup = metric.data[..., slicegroup]
+                        mask_slicegroup = np.ones(data_slicegroup.shape)
                 else:
-                    mask_slicegroup = np.ones(data_slicegroup.shape)
+                    data_slicegroup = metric.data[..., slicegroup]  # selection is done in the last dimension
+                    if mask is not None:
+                        mask_slicegroup = mask.data[..., slicegroup, :]
+                        agg_metric[slicegroup]['Label'] = mask.label
+                        # Add volume fraction
+                        agg_metric[slicegroup]['Size [vox]'] = np.sum(mask_slicegroup.flatten())
+                    else:
+                        mask_slicegroup = np.ones(data_slicegroup.shape)
                 # Ignore nonfinite values
                 i_nonfinite = np.where(np.isfinite(data_slicegroup) == False)
                 data_slicegroup[i_nonfinite] = 0.
@@ -184,7 +196,7 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
     """
     Extract metric within a data, using mask and a given method.
     :param data: Class Metric(): Data (a.k.a. metric) of n-dimension to extract aggregated value from
-    :param labels: Class Metric(): Labels of (n+1)dim. The last dim encloses the labels.
+    :param labels: Class Metric(): Labels of (n+1)dim. The last dim encloses the labels. Can also be a PackedAtlas.
     :param slices:
     :param levels:
     :param perslice:
@@ -201,16 +213,24 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
     # Initializations
     map_clusters = None
     func_methods = {'ml': ('ML', func_ml), 'map': ('MAP', func_map)}
+    # Packed atlas: select the labels without densifying the atlas
+    if isinstance(labels, PackedAtlas):
+        list_ids = [label_struc[id_label].id]
+        if method in ['ml', 'map']:
+            # the label asked by the user, followed by the remaining ones
+            list_ids += diff_between_list_or_int(indiv_labels_ids, label_struc[id_label].id)
+        labels_sum = labels.combine(list_ids)
     # If label_struc[id_label].id is a list, it means that it comes from a combined labels
-    if isinstance(label_struc[id_label].id, list):
+    elif isinstance(label_struc[id_label].id, list):
         # Sum across labels
         labels_sum = np.sum(labels[..., label_struc[id_label].id], axis=3)  # (nx, ny, nz, 1)
     else:
         # Simply extract
         labels_sum = labels[..., label_struc[id_label].id]
-    # expand dim: labels_sum=(..., 1)
-    ndim = labels_sum.ndim
-    labels_sum = np.expand_dims(labels_sum, axis=ndim)
+    if not isinstance(labels, PackedAtlas):
+        # expand dim: labels_sum=(..., 1)
+        ndim = labels_sum.ndim
+        labels_sum = np.expand_dims(labels_sum, axis=ndim)
 
     # Maximum Likelihood or Maximum a Posteriori
     if method in ['ml', 'map']:
@@ -221,7 +241,8 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
         # Then append the remaining cluster IDs
         map_clusters += [label_struc[i].map_cluster for i in id_label_compl]
         # Concatenate labels: the one asked by the user, followed by the remaining ones
-        labels_sum = np.concatenate([labels_sum, labels[..., id_label_compl]], axis=ndim)
+        if not isinstance(labels, PackedAtlas):
+            labels_sum = np.concatenate([labels_sum, labels[..., id_label_compl]], axis=ndim)
         mask = Metric(data=labels_sum, label=label_struc[id_label].name)
         group_funcs = (func_methods[method], ('STD', func_std))
     # Weighted average
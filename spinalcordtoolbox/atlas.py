@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Packed representation of an atlas (e.g. the white matter tracts of PAM50): the partial volume weights of all the
+# labels are stored sparsely in a single file, which is loaded in one read instead of one image per label.
+
+from __future__ import absolute_import, division
+
+import os
+import logging
+
+import numpy as np
+
+from spinalcordtoolbox.image import Image
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+# packed atlas of an atlas folder (see pack_atlas() and load_atlas())
+PACKED_ATLAS_FILE = 'atlas_packed.npz'
+
+
+class PackedAtlas(object):
+    """
+    Partial volume weights of several labels on a 3d grid. Only the voxels where at least one label is non-zero are
+    stored, sorted by slice: the voxels of slice z are the rows slice_ptr[z]:slice_ptr[z + 1] (CSR-like layout).
+    """
+
+    def __init__(self, shape, voxels, slice_ptr, weights, orientation='RPI'):
+        """
+        :param shape: (nx, ny, nz)
+        :param voxels: 1d array of int: in-slice index of each stored voxel (x * ny + y)
+        :param slice_ptr: 1d array of int of size nz + 1
+        :param weights: 2d array (nb_voxels, nb_labels)
+        :param orientation: str: orientation of the grid
+        """
+        self.shape = tuple([int(n) for n in shape])
+        self.voxels = voxels
+        self.slice_ptr = slice_ptr
+        self.weights = weights
+        self.orientation = orientation
+
+    @property
+    def nb_labels(self):
+        return self.weights.shape[1]
+
+    @classmethod
+    def from_arrays(cls, list_data, dtype=np.float16, orientation='RPI'):
+        """
+        :param list_data: list of 3d arrays (one per label, same shape)
+        :param dtype: type of the stored weights
+        :param orientation: str: orientation of the arrays
+        :return: PackedAtlas
+        """
+        shape = list_data[0].shape[:3]
+        nonzero = np.zeros(shape, dtype=bool)
+        for data in list_data:
+            if data.shape[:3] != shape:
+                raise ValueError('All the labels of an atlas must have the same dimensions')
+            nonzero |= (data.reshape(shape) != 0)
+        # voxels sorted by slice
+        z, x, y = np.nonzero(nonzero.transpose(2, 0, 1))
+        weights = np.empty((len(z), len(list_data)), dtype=dtype)
+        for i_label, data in enumerate(list_data):
+            weights[:, i_label] = data.reshape(shape)[x, y, z]
+        slice_ptr = np.searchsorted(z, np.arange(shape[2] + 1))
+        return cls(shape, (x * shape[1] + y).astype(np.int32), slice_ptr, weights, orientation)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        :param fname: str: file written by save()
+        :return: tuple (PackedAtlas, list of the label files it was built from)
+        """
+        with np.load(fname) as npz:
+            atlas = cls(npz['shape'], npz['voxels'], npz['slice_ptr'], npz['weights'], str(npz['orientation']))
+            return atlas, [str(fname_label) for fname_label in npz['files']]
+
+    def save(self, fname, list_fname=()):
+        """
+        :param fname: str: output file (.npz)
+        :param list_fname: list of str: label files the atlas was built from (stored to check if it is up to date)
+        """
+        # write to a temporary file first, so that concurrent runs never read a partial file
+        fname_tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        try:
+            with open(fname_tmp, 'wb') as f:
+                np.savez(f, shape=np.array(self.shape), voxels=self.voxels, slice_ptr=self.slice_ptr,
+                         weights=self.weights, orientation=np.array(self.orientation),
+                         files=np.array([str(fname_label) for fname_label in list_fname]))
+            os.rename(fname_tmp, fname)
+        finally:
+            if os.path.exists(fname_tmp):
+                os.remove(fname_tmp)
+
+    def combine(self, list_ids):
+        """
+        :param list_ids: list of int or list of int: labels of the output. A list of ids is combined into a single
+          label (sum of the weights).
+        :return: PackedAtlas with one label per item of list_ids (float32 weights)
+        """
+        weights = np.empty((len(self.voxels), len(list_ids)), dtype=np.float32)
+        for i_label, ids in enumerate(list_ids):
+            weights[:, i_label] = np.sum(self.weights[:, np.atleast_1d(ids)], axis=1, dtype=np.float32)
+        return PackedAtlas(self.shape, self.voxels, self.slice_ptr, weights, self.orientation)
+
+    def get_samples(self, data, slices):
+        """
+        :param data: 3d array with the same shape as the atlas
+        :param slices: list of int
+        :return: tuple (values, weights): 1d array of the values of data at the voxels of the atlas within the slices,
+          and 2d array (nb_voxels, nb_labels) of their weights
+        """
+        slices = np.asarray(slices, dtype=int)
+        starts, stops = self.slice_ptr[slices], self.slice_ptr[slices + 1]
+        counts = stops - starts
+        # rows of the voxels of the slices, without a loop on the slices
+        rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        voxels = self.voxels[rows]
+        values = data[voxels // self.shape[1], voxels % self.shape[1], np.repeat(slices, counts)]
+        return values, self.weights[rows].astype(np.float64)
+
+    def to_dense(self, dtype=np.float32):
+        """
+        :return: 4d array (nx, ny, nz, nb_labels)
+        """
+        nx, ny, nz = self.shape
+        data = np.zeros((nz, nx * ny, self.nb_labels), dtype=dtype)
+        z = np.repeat(np.arange(nz), np.diff(self.slice_ptr))
+        data[z, self.voxels] = self.weights
+        return data.reshape(nz, nx, ny, self.nb_labels).transpose(1, 2, 0, 3)
+
+
+def load_atlas(path_label, list_fname, orientation='RPI'):
+    """
+    Load the label files of an atlas folder. The packed atlas of the folder (PACKED_ATLAS_FILE, written by
+    pack_atlas()) is used if it is up to date, otherwise the label files are read. Nothing is written in the folder.
+    :param path_label: str: atlas folder
+    :param list_fname: list of str: label files, relative to path_label
+    :param orientation: str: orientation of the atlas
+    :return: PackedAtlas
+    """
+    fname_packed = os.path.join(path_label, PACKED_ATLAS_FILE)
+    list_path = [os.path.join(path_label, fname) for fname in list_fname]
+    if os.path.isfile(fname_packed) and \
+            os.path.getmtime(fname_packed) >= max([os.path.getmtime(path) for path in list_path]):
+        atlas, list_fname_packed = PackedAtlas.load(fname_packed)
+        if list_fname_packed == list(list_fname) and atlas.orientation == orientation:
+            logger.debug('Loaded packed atlas %s', fname_packed)
+            return atlas
+        logger.debug('Packed atlas %s does not match the label files: ignored', fname_packed)
+
+    return PackedAtlas.from_arrays([Image(path).change_orientation(orientation).data for path in list_path],
+                                   orientation=orientation)
+
+
+def pack_atlas(path_label, list_fname, orientation='RPI'):
+    """
+    Read the label files of an atlas folder, and write the packed atlas of the folder (PACKED_ATLAS_FILE), so that
+    the next calls to load_atlas() read all the labels at once.
+    :param path_label: str: atlas folder (must be writable)
+    :param list_fname: list of str: label files, relative to path_label
+    :param orientation: str: orientation of the atlas
+    :return: PackedAtlas
+    """
+    atlas = PackedAtlas.from_arrays([Image(os.path.join(path_label, fname)).change_orientation(orientation).data
+                                     for fname in list_fname], orientation=orientation)
+    atlas.save(os.path.join(path_label, PACKED_ATLAS_FILE), list_fname)
+    return atlas
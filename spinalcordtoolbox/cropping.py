@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Crop images in memory (see sct_crop_image): the cropping region is a bounding box defined by voxel indices, by the
+# non-null voxels of a mask or of the image itself, or by the field of view of a reference image. The header of the
+# cropped image is updated so that the physical position of the voxels does not change.
+
+from __future__ import absolute_import, division
+
+import logging
+
+import numpy as np
+
+import spinalcordtoolbox.image as msct_image
+from spinalcordtoolbox.roi import get_bounding_box
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+
+def get_bbox_from_index(shape, start, end, dim=None):
+    """
+    Bounding box from start and end slices, with the conventions of isct_crop_image.
+    :param shape: shape of the image
+    :param start: list of float: start slices. ]0,1[: fraction of the size, 0 & >=1: slice number
+    :param end: list of float: end slices (included). ]0,1[: fraction of the size, 0: last slice, >=1: slice number,
+      <0: last slice - value
+    :param dim: list of int: dimension of each start/end value. Default: [1], as isct_crop_image
+    :return: tuple of slices, one per dimension of the image
+    """
+    if dim is None:
+        dim = [1]
+    if len(start) != len(dim) or len(end) != len(dim):
+        raise ValueError('Start and end slices must have the same number of elements than dimensions (-dim)')
+    bbox = [slice(0, n) for n in shape]
+    for d, s, e in zip(dim, start, end):
+        n = shape[d]
+        if 0 < s < 1:
+            s = n * s
+        if 0 < e < 1:
+            e = n * e
+        elif e < 0:
+            e = n + e - 1
+        elif e == 0:
+            e = n - 1
+        s, e = int(s), int(e)
+        if not 0 <= s <= e < n:
+            raise ValueError('Invalid cropping region [{}, {}] along dimension {} of size {}'.format(s, e, d, n))
+        bbox[d] = slice(s, e + 1)
+    return tuple(bbox)
+
+
+def get_bbox_from_mask(data_mask, shift=None):
+    """
+    Bounding box of the non-null voxels of a mask.
+    :param data_mask: ndarray
+    :param shift: list of int: number of voxels added on each side of the bounding box, for each dimension (clipped to
+      the image)
+    :return: tuple of slices, one per dimension of the mask
+    """
+    bbox = get_bounding_box(data_mask, pad=shift if shift is not None else 0)
+    if bbox is None:
+        raise ValueError('Cannot crop around an empty mask')
+    return bbox
+
+
+def get_bbox_from_max(data, dim=None):
+    """
+    Smallest bounding box containing all the non-null voxels of the image, along the specified dimensions.
+    :param data: ndarray
+    :param dim: list of int. Default: all the dimensions
+    :return: tuple of slices, one per dimension of the image
+    """
+    bbox_mask = get_bbox_from_mask(data)
+    if dim is None:
+        return bbox_mask
+    return tuple([bbox_mask[d] if d in dim else slice(0, n) for d, n in enumerate(data.shape)])
+
+
+def get_bbox_from_ref(im, hdr_ref):
+    """
+    Bounding box of the voxels of an image that are within the field of view of a reference image (first three
+    dimensions).
+    :param im: Image
+    :param hdr_ref: Nifti1Header of the reference image (e.g. a warping field: its data does not need to be loaded)
+    :return: tuple of slices, one per dimension of the image
+    """
+    shape_ref = hdr_ref.get_data_shape()[:3]
+    # corners of the reference image, in the voxel coordinates of the image
+    corners = np.array(np.meshgrid(*[[0, n - 1] for n in shape_ref], indexing='ij')).reshape(3, -1)
+    affine = np.dot(np.linalg.inv(im.hdr.get_best_affine()), hdr_ref.get_best_affine())
+    coordinates = np.round(np.dot(affine[:3, :3], corners) + affine[:3, 3:])
+    bbox = [slice(0, n) for n in im.data.shape]
+    for d in range(3):
+        lo, hi = max(0, int(coordinates[d].min())), min(im.data.shape[d] - 1, int(coordinates[d].max()))
+        if lo > hi:
+            raise ValueError('The reference image does not overlap with the image')
+        bbox[d] = slice(lo, hi + 1)
+    return tuple(bbox)
+
+
+def crop_image(im, bbox, background=None, copy=True):
+    """
+    Crop an image to a bounding box.
+    :param im: Image
+    :param bbox: tuple of slices (see get_bbox_*()). Only the spatial dimensions change the header.
+    :param background: if not None, the voxels outside of the bounding box are set to this value instead, and the
+      dimensions of the image are not changed
+    :param copy: bool: if False, the data of the cropped image is a view on the data of the input image (when
+      background is None)
+    :return: Image
+    """
+    if background is not None:
+        data = np.full_like(im.data, background)
+        data[bbox] = im.data[bbox]
+        im_out = msct_image.Image(data, hdr=im.hdr.copy())
+        im_out._path = im._path
+        return im_out
+
+    im_out = msct_image.spatial_crop(im, dict([(d, (s.start, s.stop - 1)) for d, s in enumerate(bbox)]))
+    if copy:
+        im_out.data = im_out.data.copy()
+    return im_out
+
@@ -10,7 +10,6 @@
 from __future__ import absolute_import, print_function
 
 import warnings
-import json
 import os
 import sys
 import io
@@ -20,22 +19,8 @@ import nibabel as nib
 from nipy.io.nifti_ref import nipy2nifti, nifti2nipy
 import numpy as np
 
-# Avoid Keras logging
-original_stderr = sys.stderr
-if sys.hexversion < 0x03000000:
-    sys.stderr = io.BytesIO()
-else:
-    sys.stderr = io.TextIOWrapper(io.BytesIO(), sys.stderr.encoding)
-try:
-    from keras import backend as K
-except Exception as e:
-    sys.stderr = original_stderr
-    raise
-else:
-    sys.stderr = original_stderr
-
 from spinalcordtoolbox import resampling
-from . import model
+from spinalcordtoolbox import inference
 
 
 # Suppress warnings and TensorFlow logging
@@ -43,11 +28,24 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 SMALL_INPUT_SIZE = 200
 BATCH_SIZE = 4
+CHUNK_SIZE = 32
+TTA_SAMPLES = 8
 
 
 def check_backend():
     """This function will check for the current backend and
     then it will warn the user if the backend is theano."""
+    # Avoid Keras logging
+    original_stderr = sys.stderr
+    if sys.hexversion < 0x03000000:
+        sys.stderr = io.BytesIO()
+    else:
+        sys.stderr = io.TextIOWrapper(io.BytesIO(), sys.stderr.encoding)
+    try:
+        from keras import backend as K
+    finally:
+        sys.stderr = original_stderr
+
     if K.backend() != 'tensorflow':
         print("\nWARNING: you're using a Keras backend different than\n"
               "Tensorflow, which is not recommended. Please verify\n"
@@ -202,8 +200,94 @@ def threshold_predictions(predictions, thr=0.999):
     return thresholded_preds
 
 
+def get_crop_starts(volume_shape, crop_size, mask=None):
+    """Compute the beginning of the crop of each axial slice. The crops
+    are centered on the slice center, or on the center of mass of the
+    mask when one is given (slices without mask use the center of the
+    closest slices), and are kept within the slice.
+
+    :param volume_shape: the volume shape (x, y, z).
+    :param crop_size: the crop size (x, y).
+    :param mask: cord mask or centerline (same shape as the volume).
+    :return: array (z, 2) with the crop beginnings (x, y).
+    """
+    nz = volume_shape[2]
+    slice_shape = np.array(volume_shape[:2])
+    crop_size = np.array(crop_size)
+    centers = np.tile(slice_shape // 2, (nz, 1)).astype(np.float64)
+
+    if mask is not None:
+        mask = np.asarray(mask) > 0
+        counts = mask.sum(axis=(0, 1))
+        has_mask = counts > 0
+        if has_mask.any():
+            index_x = np.arange(mask.shape[0])
+            index_y = np.arange(mask.shape[1])
+            mass_x = np.tensordot(index_x, mask.sum(axis=1), axes=(0, 0))
+            mass_y = np.tensordot(index_y, mask.sum(axis=0), axes=(0, 0))
+            slices = np.arange(nz)
+            for axis, mass in enumerate((mass_x, mass_y)):
+                center = mass[has_mask] / counts[has_mask]
+                centers[:, axis] = np.interp(slices, slices[has_mask], center)
+
+    starts = np.round(centers).astype(int) - crop_size // 2
+    return np.clip(starts, 0, slice_shape - crop_size)
+
+
+def crop_slices(volume_data, starts, crop_size):
+    """Crop all the axial slices at once.
+
+    :param volume_data: the volume (x, y, z).
+    :param starts: array (z, 2) with the crop beginnings (x, y).
+    :param crop_size: the crop size (x, y).
+    :return: cropped slices (z, x, y).
+    """
+    index_x = starts[:, 0, None, None] + np.arange(crop_size[0])[None, :, None]
+    index_y = starts[:, 1, None, None] + np.arange(crop_size[1])[None, None, :]
+    index_z = np.arange(len(starts))[:, None, None]
+    return volume_data[index_x, index_y, index_z]
+
+
+def uncrop_slices(slices, starts, volume_shape, dtype=np.uint8):
+    """Put the cropped slices back in a volume filled with zeros
+    (inverse of crop_slices).
+
+    :param slices: the cropped slices (z, x, y).
+    :param starts: array (z, 2) with the crop beginnings (x, y).
+    :param volume_shape: the volume shape (x, y, z).
+    :param dtype: the output type.
+    :return: the volume (x, y, z).
+    """
+    volume = np.zeros(volume_shape, dtype=dtype)
+    _, crop_x, crop_y = slices.shape
+    index_x = starts[:, 0, None, None] + np.arange(crop_x)[None, :, None]
+    index_y = starts[:, 1, None, None] + np.arange(crop_y)[None, None, :]
+    index_z = np.arange(len(starts))[:, None, None]
+    volume[index_x, index_y, index_z] = slices
+    return volume
+
+
+def predict_tta(model, axial_slices, nb_samples=TTA_SAMPLES):
+    """Predict with test-time augmentation: the slices shifted by random
+    intensity offsets and the original slices are stacked and predicted
+    in a single pass, and the predictions are averaged.
+
+    :param model: the model.
+    :param axial_slices: the (standardized) slices (z, x, y, 1).
+    :param nb_samples: the number of augmented copies.
+    :return: averaged predictions.
+    """
+    offsets = np.append(np.random.uniform(high=2.0, size=nb_samples), 0)
+    offsets = offsets.astype(axial_slices.dtype)
+    stacked = axial_slices[None] + offsets[:, None, None, None, None]
+    preds = model.predict(stacked.reshape((-1,) + axial_slices.shape[1:]),
+                          batch_size=BATCH_SIZE, verbose=False)
+    return preds.reshape((len(offsets), -1) + preds.shape[1:]).mean(axis=0)
+
+
 def segment_volume(ninput_volume, model_name,
-                   threshold=0.999, use_tta=False):
+                   threshold=0.999, use_tta=False,
+                   mask=None, chunk_size=CHUNK_SIZE):
     """Segment a nifti volume.
 
     :param ninput_volume: the input volume.
@@ -211,16 +295,13 @@ def segment_volume(ninput_volume, model_name,
     :param threshold: threshold to be applied in predictions.
     :param use_tta: whether TTA (test-time augmentation)
                     should be used or not.
+    :param mask: cord mask or centerline (same shape as the volume),
+                 used to center the crops on the cord.
+    :param chunk_size: number of slices predicted at once.
     :return: segmented slices.
     """
-    gmseg_model_challenge = DataResource('deepseg_gm_models')
-    model_path, metadata_path = model.MODELS[model_name]
-
-    metadata_abs_path = gmseg_model_challenge.get_file_path(metadata_path)
-    with open(metadata_abs_path) as fp:
-        metadata = json.load(fp)
-
-    volume_size = np.array(ninput_volume.shape[0:2])
+    volume_shape = ninput_volume.shape[0:3]
+    volume_size = np.array(volume_shape[0:2])
     small_input = (volume_size <= SMALL_INPUT_SIZE).any()
 
     if small_input:
@@ -228,73 +309,40 @@ def segment_volume(ninput_volume, model_name,
         net_input_size = volume_size
     else:
         # larger sizer, crop at 200x200
-        net_input_size = (SMALL_INPUT_SIZE, SMALL_INPUT_SIZE)
+        net_input_size = np.array((SMALL_INPUT_SIZE, SMALL_INPUT_SIZE))
 
-    deepgmseg_model = model.create_model(metadata['filters'],
-                                         net_input_size)
-
-    model_abs_path = gmseg_model_challenge.get_file_path(model_path)
-    deepgmseg_model.load_weights(model_abs_path)
+    # load model (or use the one of the inference server)
+    deepgmseg_model = inference.get_model('deepseg_gm', model_name=model_name,
+                                          input_size=[int(size) for size in net_input_size])
 
     volume_data = ninput_volume.get_data()
-    axial_slices = []
-    crops = []
-
-    for slice_num in range(volume_data.shape[2]):
-        data = volume_data[..., slice_num]
-
-        if not small_input:
-            data, cropreg = crop_center(data, SMALL_INPUT_SIZE,
-                                        SMALL_INPUT_SIZE)
-            crops.append(cropreg)
-
-        axial_slices.append(data)
-
-    axial_slices = np.asarray(axial_slices, dtype=np.float32)
+    starts = get_crop_starts(volume_shape, net_input_size, mask)
+    axial_slices = crop_slices(volume_data, starts, net_input_size).astype(np.float32)
     axial_slices = np.expand_dims(axial_slices, axis=3)
 
     normalization = VolumeStandardizationTransform()
     axial_slices = normalization(axial_slices)
 
-    if use_tta:
-        pred_sampled = []
-        for i in range(8):
-            sampled_value = np.random.uniform(high=2.0)
-            sampled_axial_slices = axial_slices + sampled_value
-            preds = deepgmseg_model.predict(sampled_axial_slices,
-                                            batch_size=BATCH_SIZE,
-                                            verbose=True)
-            pred_sampled.append(preds)
-
-        preds = deepgmseg_model.predict(axial_slices, batch_size=BATCH_SIZE,
-                                        verbose=True)
-        pred_sampled.append(preds)
-        pred_sampled = np.asarray(pred_sampled)
-        pred_sampled = np.mean(pred_sampled, axis=0)
-        preds = threshold_predictions(pred_sampled, threshold)
-    else:
-        preds = deepgmseg_model.predict(axial_slices, batch_size=BATCH_SIZE,
-                                        verbose=True)
-        preds = threshold_predictions(preds, threshold)
-
-    pred_slices = []
+    # predict the slices by chunks, to bound the memory used by the
+    # predictions (and the augmented copies of the slices with TTA)
+    preds = np.zeros(axial_slices.shape[:3], dtype=np.uint8)
+    for chunk_start in range(0, len(axial_slices), chunk_size):
+        chunk = axial_slices[chunk_start:chunk_start + chunk_size]
+        if use_tta:
+            chunk_preds = predict_tta(deepgmseg_model, chunk)
+        else:
+            chunk_preds = deepgmseg_model.predict(chunk, batch_size=BATCH_SIZE,
+                                                  verbose=False)
+        chunk_preds = threshold_predictions(chunk_preds, threshold)
+        preds[chunk_start:chunk_start + chunk_size] = chunk_preds[..., 0]
 
     # Un-cropping
-    for slice_num in range(preds.shape[0]):
-        pred_slice = preds[slice_num][..., 0]
-        if not small_input:
-            pred_slice = crops[slice_num].pad(pred_slice)
-        pred_slices.append(pred_slice)
-
-    pred_slices = np.asarray(pred_slices, dtype=np.uint8)
-    pred_slices = np.transpose(pred_slices, (1, 2, 0))
-
-    return pred_slices
+    return uncrop_slices(preds, starts, volume_shape)
 
 
 def segment_file(input_filename, output_filename,
                  model_name, threshold, verbosity,
-                 use_tta):
+                 use_tta, mask_filename=None):
     """Segment a volume file.
 
     :param input_filename: the input filename.
@@ -305,6 +353,8 @@ def segment_file(input_filename, output_filename,
     :param verbosity: the verbosity level.
     :param use_tta: whether it should use TTA (test-time augmentation)
                     or not.
+    :param mask_filename: cord mask or centerline (same space as the
+                          input), used to center the crops on the cord.
     :return: the output filename.
     """
     nii_original = nipy.load_image(input_filename)
@@ -314,8 +364,20 @@ def segment_file(input_filename, output_filename,
     nii_resampled = resampling.resample_nipy(nii_original, new_size=target_resample, new_size_type='mm',
                                              interpolation='linear', verbose=verbosity)
     nii_resampled = nipy2nifti(nii_resampled)
+
+    mask = None
+    if mask_filename is not None:
+        nii_mask = resampling.resample_nipy(nipy.load_image(mask_filename), new_size=target_resample,
+                                            new_size_type='mm', interpolation='linear', verbose=verbosity)
+        if nii_mask.shape != nii_resampled.shape:
+            raise RuntimeError("The mask must be in the same space as the input image.")
+        mask = nii_mask.get_data() > 0.5
+        if not mask.any():
+            # e.g. a centerline lost by the interpolation
+            mask = nii_mask.get_data() > 0
+
     pred_slices = segment_volume(nii_resampled, model_name, threshold,
-                                 use_tta)
+                                 use_tta, mask)
 
     original_res = "{:.5f}x{:.5f}x{:.5f}".format(
         nii_original.header["pixdim"][1],
@@ -17,7 +17,7 @@ from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.centerline import optic
 from spinalcordtoolbox.deepseg_sc.core import find_centerline, crop_image_around_centerline, uncrop_image, _normalize_data
 from spinalcordtoolbox import resampling
-from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_ctr
+from spinalcordtoolbox import inference
 
 BATCH_SIZE = 4
 MODEL_LST = ['t2', 't2_ax', 't2s']
@@ -76,43 +76,78 @@ def apply_intensity_normalization(img, contrast):
     return img_normalized
 
 
+def get_patch_starts(nz, z_patch_size, z_step):
+    """
+    Get the beginning of the patches covering the z axis. Consecutive patches overlap when z_step < z_patch_size, and
+    the last patch ends at the last slice (unless the volume is smaller than a patch).
+    :param nz: int: number of slices
+    :param z_patch_size: int
+    :param z_step: int: distance between the beginning of two consecutive patches
+    :return: list of int
+    """
+    if nz <= z_patch_size:
+        return [0]
+    z_starts = list(range(0, nz - z_patch_size + 1, z_step))
+    if z_starts[-1] != nz - z_patch_size:
+        z_starts.append(nz - z_patch_size)
+    return z_starts
+
+
+def predict_patches(seg_model, data, z_patch_size, z_step, mean, std):
+    """
+    Predict overlapping patches along z in batches, and blend the predictions by averaging them where patches overlap.
+    Empty patches (e.g. after a brain detection) are not predicted, and count as a prediction of zero.
+    :param seg_model: model
+    :param data: 3d array
+    :param z_patch_size: int
+    :param z_step: int: see get_patch_starts()
+    :param mean: float: mean used to normalize the patches
+    :param std: float: std used to normalize the patches
+    :return: 3d array: probabilities, same shape as data
+    """
+    nz = data.shape[2]
+    z_starts = get_patch_starts(nz, z_patch_size, z_step)
+    if nz < z_patch_size:
+        # zero-pad the volume to the patch size
+        data_pad = np.zeros(data.shape[:2] + (z_patch_size,), dtype=np.float32)
+        data_pad[:, :, :nz] = data
+        data = data_pad
+
+    # gather the patches, with the channel axis first
+    patches = np.stack([data[:, :, zz:zz + z_patch_size] for zz in z_starts]).astype(np.float32)
+    not_empty = np.array([np.any(patch) for patch in patches])
+
+    sum_proba = np.zeros(data.shape, dtype=np.float32)
+    count = np.zeros(data.shape[2], dtype=np.float32)
+    if np.any(not_empty):
+        patches_norm = _normalize_data(patches[not_empty], mean, std)
+        preds = seg_model.predict(np.expand_dims(patches_norm, 1), batch_size=BATCH_SIZE)[:, 0]
+        for zz, pred in zip(np.array(z_starts)[not_empty], preds):
+            sum_proba[:, :, zz:zz + z_patch_size] += pred
+    for zz in z_starts:
+        count[zz:zz + z_patch_size] += 1
+
+    return (sum_proba / count)[:, :, :nz]
+
+
 def segment_3d(model_fname, contrast_type, im):
     """Perform segmentation with 3D convolutions."""
-    from spinalcordtoolbox.deepseg_sc.cnn_models_3d import load_trained_model
     dct_patch_3d = {'t2': {'size': (48, 48, 48), 'mean': 871.309, 'std': 557.916},
                     't2_ax': {'size': (48, 48, 48), 'mean': 835.592, 'std': 528.386},
                     't2s': {'size': (48, 48, 48), 'mean': 1011.31, 'std': 678.985}}
 
     # load 3d model
-    seg_model = load_trained_model(model_fname)
+    seg_model = inference.get_model('deepseg_sc_3d', fname=os.path.abspath(model_fname))
 
-    out_data = np.zeros(im.data.shape)
-
-    # segment the spinal cord
+    # segment the lesions, with patches overlapping by half along z
     z_patch_size = dct_patch_3d[contrast_type]['size'][2]
-    z_step_keep = list(range(0, im.data.shape[2], z_patch_size))
-    for zz in z_step_keep:
-        if zz == z_step_keep[-1]:  # deal with instances where the im.data.shape[2] % patch_size_z != 0
-            patch_im = np.zeros(dct_patch_3d[contrast_type]['size'])
-            z_patch_extracted = im.data.shape[2] - zz
-            patch_im[:, :, :z_patch_extracted] = im.data[:, :, zz:]
-        else:
-            z_patch_extracted = z_patch_size
-            patch_im = im.data[:, :, zz:z_patch_size + zz]
-
-        if np.any(patch_im):  # Check if the patch is (not) empty, which could occur after a brain detection.
-            patch_norm = _normalize_data(patch_im, dct_patch_3d[contrast_type]['mean'], dct_patch_3d[contrast_type]['std'])
-            patch_pred_proba = seg_model.predict(np.expand_dims(np.expand_dims(patch_norm, 0), 0), batch_size=BATCH_SIZE)
-            pred_seg_th = (patch_pred_proba > 0.1).astype(int)[0, 0, :, :, :]
-            if zz == z_step_keep[-1]:
-                out_data[:, :, zz:] = pred_seg_th[:, :, :z_patch_extracted]
-            else:
-                out_data[:, :, zz:z_patch_size + zz] = pred_seg_th
+    proba = predict_patches(seg_model, im.data, z_patch_size, z_patch_size // 2,
+                            dct_patch_3d[contrast_type]['mean'], dct_patch_3d[contrast_type]['std'])
 
     out = msct_image.zeros_like(im, dtype=np.uint8)
-    out.data = out_data
+    out.data = (proba > 0.1).astype(np.uint8)
 
-    return out.copy()
+    return out
 
 
 def deep_segmentation_MSlesion(im_image, contrast_type, ctr_algo='svm', ctr_file=None, brain_bool=True,
@@ -127,7 +162,6 @@ def deep_segmentation_MSlesion(im_image, contrast_type, ctr_algo='svm', ctr_file
     :param remove_temp_files:
     :return:
     """
-
     # create temporary folder with intermediate results
     sct.log.info("\nCreating temporary folder...")
     tmp_folder = sct.TempFolder()
@@ -141,7 +175,6 @@ def deep_segmentation_MSlesion(im_image, contrast_type, ctr_algo='svm', ctr_file
 
     # orientation of the image, should be RPI
     sct.log.info("\nReorient the image to RPI, if necessary...")
-    fname_in = im_image.absolutepath
     original_orientation = im_image.orientation
     fname_orient = 'image_in_RPI.nii'
     im_image.change_orientation('RPI').save(fname_orient)
@@ -174,46 +207,33 @@ def deep_segmentation_MSlesion(im_image, contrast_type, ctr_algo='svm', ctr_file
     del im_crop_nii
 
     # resample to 0.5mm isotropic
-    fname_norm = sct.add_suffix(fname_orient, '_norm')
-    im_norm_in.save(fname_norm)
-    fname_res3d = sct.add_suffix(fname_norm, '_resampled3d')
-    resampling.resample_file(fname_norm, fname_res3d, '0.5x0.5x0.5', 'mm', 'linear',
-                             verbose=0)
+    im_res3d = resampling.resample_image(im_norm_in, '0.5x0.5x0.5', 'mm', 'linear', verbose=0)
+    del im_norm_in
 
     # segment data using 3D convolutions
     sct.log.info("\nSegmenting the MS lesions using deep learning on 3D patches...")
     segmentation_model_fname = os.path.join(sct.__sct_dir__, 'data', 'deepseg_lesion_models',
                                             '{}_lesion.h5'.format(contrast_type))
-    fname_seg_crop_res = sct.add_suffix(fname_res3d, '_lesionseg')
-    im_res3d = Image(fname_res3d)
     seg_im = segment_3d(model_fname=segmentation_model_fname,
                         contrast_type=contrast_type,
-                        im=im_res3d.copy())
-    seg_im.save(fname_seg_crop_res)
-    del im_res3d, seg_im
+                        im=im_res3d)
+    del im_res3d
 
     # resample to the initial pz resolution
-    fname_seg_res2d = sct.add_suffix(fname_seg_crop_res, '_resampled2d')
     initial_2d_resolution = 'x'.join(['0.5', '0.5', str(input_resolution[2])])
-    resampling.resample_file(fname_seg_crop_res, fname_seg_res2d, initial_2d_resolution,
-                                                           'mm', 'linear', verbose=0)
-    seg_crop = Image(fname_seg_res2d)
+    seg_crop = resampling.resample_image(seg_im, initial_2d_resolution, 'mm', 'linear', verbose=0)
+    del seg_im
 
     # reconstruct the segmentation from the crop data
     sct.log.info("\nReassembling the image...")
-    seg_uncrop_nii = uncrop_image(ref_in=im_nii, data_crop=seg_crop.copy().data, x_crop_lst=X_CROP_LST,
+    seg_uncrop_nii = uncrop_image(ref_in=im_nii, data_crop=seg_crop.data, x_crop_lst=X_CROP_LST,
                                   y_crop_lst=Y_CROP_LST)
-    fname_seg_res_RPI = sct.add_suffix(fname_in, '_res_RPI_seg')
-    seg_uncrop_nii.save(fname_seg_res_RPI)
     del seg_crop
 
     # resample to initial resolution
     sct.log.info("Resampling the segmentation to the original image resolution...")
     initial_resolution = 'x'.join([str(input_resolution[0]), str(input_resolution[1]), str(input_resolution[2])])
-    fname_seg_RPI = sct.add_suffix(fname_in, '_RPI_seg')
-    resampling.resample_file(fname_seg_res_RPI, fname_seg_RPI, initial_resolution,
-                                                           'mm', 'linear', verbose=0)
-    seg_initres_nii = Image(fname_seg_RPI)
+    seg_initres_nii = resampling.resample_image(seg_uncrop_nii, initial_resolution, 'mm', 'linear', verbose=0)
 
     # binarize the resampled image to remove interpolation effects
     sct.log.info("\nBinarizing the segmentation to avoid interpolation effects...")
@@ -11,7 +11,8 @@ from skimage.exposure import rescale_intensity
 from scipy.ndimage import distance_transform_edt
 
 from spinalcordtoolbox import resampling
-from cnn_models import nn_architecture_seg, nn_architecture_ctr
+from spinalcordtoolbox import inference
+from spinalcordtoolbox import trace
 from spinalcordtoolbox.image import Image, empty_like, change_type, zeros_like
 from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline, _call_viewer_centerline
 
@@ -21,6 +22,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 BATCH_SIZE = 4
 
 
+@trace.traced('deepseg_sc: find centerline')
 def find_centerline(algo, image_fname, contrast_type, brain_bool, folder_output, remove_temp_files, centerline_fname):
     """
     Assumes RPI orientation
@@ -65,9 +67,10 @@ def find_centerline(algo, image_fname, contrast_type, brain_bool, folder_output,
                             't1': {'features': 24, 'dilation_layers': 3},
                             'dwi': {'features': 8, 'dilation_layers': 2}}
 
-        # load model
+        # load model (or use the one of the inference server)
         ctr_model_fname = os.path.join(sct.__sct_dir__, 'data', 'deepseg_sc_models', '{}_ctr.h5'.format(contrast_type))
-        ctr_model = nn_architecture_ctr(height=dct_patch_ctr[contrast_type]['size'][0],
+        ctr_model = inference.get_model('deepseg_sc_ctr', fname=os.path.abspath(ctr_model_fname),
+                                        height=dct_patch_ctr[contrast_type]['size'][0],
                                         width=dct_patch_ctr[contrast_type]['size'][1],
                                         channels=1,
                                         classes=1,
@@ -78,7 +81,6 @@ def find_centerline(algo, image_fname, contrast_type, brain_bool, folder_output,
                                         batchnorm=True,
                                         dropout=0.0,
                                         dilation_layers=dct_params_ctr[contrast_type]['dilation_layers'])
-        ctr_model.load_weights(ctr_model_fname)
 
         sct.log.info("Resample the image to 0.5 mm isotropic resolution...")
         fname_res = sct.add_suffix(image_fname, '_resampled')
@@ -464,15 +466,16 @@ def _normalize_data(data, mean, std):
     return data
 
 
+@trace.traced('deepseg_sc: segment 2d')
 def segment_2d(model_fname, contrast_type, input_size, im_in):
     """Segment data using 2D convolutions."""
-    seg_model = nn_architecture_seg(height=input_size[0],
-    				width=input_size[1],
-    				depth=2 if contrast_type != 't2' else 3,
-					features=32,
-                    batchnorm=False,
-                    dropout=0.0)
-    seg_model.load_weights(model_fname)
+    seg_model = inference.get_model('deepseg_sc_seg', fname=os.path.abspath(model_fname),
+                                    height=input_size[0],
+                                    width=input_size[1],
+                                    depth=2 if contrast_type != 't2' else 3,
+                                    features=32,
+                                    batchnorm=False,
+                                    dropout=0.0)
 
     seg_crop = zeros_like(im_in, dtype=np.uint8)
 
@@ -524,14 +527,14 @@ def post_processing_slice_wise(z_slice, x_cOm, y_cOm):
     return binary_fill_holes(z_slice, structure=np.ones((3, 3))).astype(np.int)
 
 
+@trace.traced('deepseg_sc: segment 3d')
 def segment_3d(model_fname, contrast_type, im_in):
     """Perform segmentation with 3D convolutions."""
-    from spinalcordtoolbox.deepseg_sc.cnn_models_3d import load_trained_model
     dct_patch_sc_3d = {'t2': {'size': (64, 64, 48), 'mean': 65.8562, 'std': 59.7999},
                         't2s': {'size': (96, 96, 48), 'mean': 87.0212, 'std': 64.425},
                         't1': {'size': (64, 64, 48), 'mean': 88.5001, 'std': 66.275}}
     # load 3d model
-    seg_model = load_trained_model(model_fname)
+    seg_model = inference.get_model('deepseg_sc_3d', fname=os.path.abspath(model_fname))
 
     out = zeros_like(im_in, dtype=np.uint8)
 
@@ -567,6 +570,7 @@ def segment_3d(model_fname, contrast_type, im_in):
     return out
 
 
+@trace.traced('deepseg_sc')
 def deep_segmentation_spinalcord(im_image, contrast_type, ctr_algo='cnn', ctr_file=None, brain_bool=True,
                                  kernel_size='2d', remove_temp_files=1, verbose=1):
     """Pipeline"""
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Blockwise (slab-based) non-local means denoising, which can be distributed over several processes
+
+from __future__ import absolute_import, division
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from spinalcordtoolbox.roi import get_bounding_box
+
+
+def get_slabs(nz, nb_slabs, pad):
+    """
+    Split the range [0, nz) into contiguous slabs, and extend each slab by pad voxels on both sides.
+    :param nz: int: number of slices along the split axis
+    :param nb_slabs: int: number of slabs
+    :param pad: int: number of overlapping slices added on each side of a slab (clipped to the volume)
+    :return: list of tuples (z0_pad, z1_pad, z0, z1): bounds of the padded slab, and bounds of the core of the slab
+    """
+    nb_slabs = max(1, min(nb_slabs, nz))
+    bounds = np.linspace(0, nz, nb_slabs + 1).round().astype(int)
+    return [(max(0, z0 - pad), min(nz, z1 + pad), z0, z1) for z0, z1 in zip(bounds[:-1], bounds[1:])]
+
+
+def _nlmeans_slab(args):
+    """
+    Denoise one padded slab and return its core. Defined at the module level so that it can be sent to worker
+    processes.
+    """
+    from dipy.denoise.nlmeans import nlmeans
+    data, sigma, mask, patch_radius, block_radius, rician, num_threads, core = args
+    if num_threads is None:
+        den = nlmeans(data, sigma, mask=mask, patch_radius=patch_radius, block_radius=block_radius, rician=rician)
+    else:
+        den = nlmeans(data, sigma, mask=mask, patch_radius=patch_radius, block_radius=block_radius, rician=rician,
+                      num_threads=num_threads)
+    return den[:, :, core[0]:core[1], ...]
+
+
+def nlmeans_blockwise(data, sigma, mask=None, patch_radius=1, block_radius=5, rician=True, nb_proc=1, nb_slabs=None,
+                      roi=None):
+    """
+    Non-local means denoising (dipy) applied on overlapping slabs along the third axis. Each slab is padded by
+    block_radius + patch_radius slices, so that the stitched result equals the one obtained on the whole volume.
+    :param data: 3d or 4d ndarray to denoise
+    :param sigma: float, or array of noise standard deviation (one value per volume, or 3d array with the shape of data)
+    :param mask: 3d ndarray: only voxels inside the mask are denoised (passed to dipy)
+    :param patch_radius: int: patch size is 2 * patch_radius + 1
+    :param block_radius: int: block size is 2 * block_radius + 1
+    :param rician: bool: Rician (True) or Gaussian (False) noise
+    :param nb_proc: int: number of worker processes. 0 or 1: slabs are processed sequentially in the current process.
+    :param nb_slabs: int: number of slabs. By default, one slab per process.
+    :param roi: 3d ndarray: if provided, denoising is restricted to the bounding box of the non-zero voxels of roi.
+      The bounding box is padded by block_radius + patch_radius voxels for the computation, and voxels outside of
+      the (unpadded) bounding box are returned unchanged.
+    :return: denoised ndarray, with the same shape and type as data
+    """
+    data = np.asarray(data)
+    pad = block_radius + patch_radius
+    sigma_is_map = np.ndim(sigma) >= 3
+
+    # restrict processing to the region of interest
+    bbox = bbox_core = tuple([slice(0, n) for n in data.shape[:3]])
+    if roi is not None:
+        bbox_core = get_bounding_box(roi)
+        if bbox_core is None:
+            return data.copy()
+        bbox = get_bounding_box(roi, pad=pad)
+    data_roi = data[bbox]
+    sigma_roi = sigma[bbox] if sigma_is_map else sigma
+    mask_roi = mask[bbox] if mask is not None else None
+
+    # build the list of slabs
+    nb_proc = max(1, nb_proc)
+    if nb_slabs is None:
+        nb_slabs = nb_proc
+    num_threads = 1 if nb_proc > 1 else None  # avoid oversubscription when dipy is built with OpenMP
+    list_args = []
+    for z0_pad, z1_pad, z0, z1 in get_slabs(data_roi.shape[2], nb_slabs, pad):
+        list_args.append((
+            np.ascontiguousarray(data_roi[:, :, z0_pad:z1_pad, ...]),
+            sigma_roi[:, :, z0_pad:z1_pad, ...] if sigma_is_map else sigma_roi,
+            np.ascontiguousarray(mask_roi[:, :, z0_pad:z1_pad]) if mask_roi is not None else None,
+            patch_radius, block_radius, rician, num_threads,
+            (z0 - z0_pad, z1 - z0_pad)))
+
+    # denoise slabs
+    if nb_proc > 1 and len(list_args) > 1:
+        pool = Pool(min(nb_proc, len(list_args)))
+        try:
+            list_den = pool.map(_nlmeans_slab, list_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        list_den = [_nlmeans_slab(args) for args in list_args]
+
+    # stitch slabs back together, and only keep the region of interest
+    den_roi = np.concatenate(list_den, axis=2)
+    denoised = data.copy()
+    denoised[bbox_core] = den_roi[tuple([slice(c.start - b.start, c.stop - b.start) for c, b in zip(bbox_core, bbox)])]
+    return denoised
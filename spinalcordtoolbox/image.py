@@ -26,6 +26,8 @@ import transforms3d.affines as affines
 from msct_types import Coordinate
 import sct_utils as sct
 
+from spinalcordtoolbox import trace
+
 
 def _get_permutations(im_src_orientation, im_dst_orientation):
     """
@@ -314,12 +316,16 @@ class Image(object):
         :return:
         """
 
-        try:
-            self.im_file = nibabel.load(path)
-        except nibabel.spatialimages.ImageFileError:
-            sct.printv('Error: make sure ' + path + ' is an image.', 1, 'error')
-        self.data = self.im_file.get_data()
-        self.hdr = self.im_file.get_header()
+        with trace.stage('Image.load', category='io', path=path) as trace_args:
+            try:
+                self.im_file = nibabel.load(path)
+            except nibabel.spatialimages.ImageFileError:
+                sct.printv('Error: make sure ' + path + ' is an image.', 1, 'error')
+            self.data = self.im_file.get_data()
+            self.hdr = self.im_file.get_header()
+            if trace_args is not None:
+                trace_args['bytes'] = os.path.getsize(path)
+                trace.add_bytes(read=trace_args['bytes'])
         self.absolutepath = path
         if path != self.absolutepath:
             sct.log.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, self.data.shape)
@@ -455,7 +461,11 @@ class Image(object):
             sct.log.debug("Saving image to %s (%s) orientation %s shape %s",
              path, os.path.abspath(path), self.orientation, data.shape)
 
-        nibabel.save(img, path)
+        with trace.stage('Image.save', category='io', path=path) as trace_args:
+            nibabel.save(img, path)
+            if trace_args is not None:
+                trace_args['bytes'] = os.path.getsize(path)
+                trace.add_bytes(written=trace_args['bytes'])
 
         if mutable:
             self.absolutepath = path
@@ -578,10 +588,7 @@ class Image(object):
         m_p2f = self.hdr.get_best_affine()
         m_f2p = np.linalg.inv(m_p2f)
         aug = np.hstack((np.asarray(coordi), np.ones((len(coordi), 1))))
-        ret = np.empty_like(coordi, dtype=np.float64)
-        for idx_coord, coord in enumerate(aug):
-            phys = np.matmul(m_f2p, coord)
-            ret[idx_coord] = phys[:3]
+        ret = np.dot(aug, m_f2p.T)[:, :3]
         if real:
             return np.int32(np.round(ret))
         else:
@@ -1150,12 +1157,16 @@ def spatial_crop(im_src, spec, im_dst=None):
 
     aff = im_src.header.get_best_affine()
     new_aff = aff.copy()
-    new_aff[:, [3]] = aff.dot(np.vstack((bounds[:, [0]], [1])))
+    start = np.zeros((3, 1))
+    start[:min(3, len(bounds))] = bounds[:3, [0]]  # only spatial dimensions matter for 4d images
+    new_aff[:, [3]] = aff.dot(np.vstack((start, [1])))
 
     new_img = nibabel.Nifti1Image(new_data, new_aff, im_src.header)
 
     if im_dst is None:
-        im_dst = im_src.copy()
+        # do not deep-copy the source data, which would be discarded anyway
+        im_dst = Image(new_data, hdr=new_img.header)
+        im_dst._path = im_src._path
 
     im_dst.header = new_img.header
     im_dst.data = new_data
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Inference with the CNN models of deepseg_sc, deepseg_gm and deepseg_lesion, either in the current process or through
+# a local inference server (see sct_inference_server) which keeps the models loaded between runs.
+#
+# Models are identified by a spec: the name of a loader (see LOADERS) and its parameters (JSON serializable). The
+# server listens on a Unix socket. Each request holds a spec and an array of samples, and the response holds the
+# predictions. Requests received at the same time for the same model are predicted in a single batch.
+
+from __future__ import absolute_import, division
+
+import os
+import json
+import time
+import socket
+import struct
+import logging
+import tempfile
+import threading
+
+try:
+    from queue import Queue, Empty
+except ImportError:  # Python 2
+    from Queue import Queue, Empty
+
+import numpy as np
+
+from spinalcordtoolbox.resources import configure_keras_session
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+# environment variable holding the socket of the inference server. Default: see get_socket_path()
+ENV_SOCKET = 'SCT_INFERENCE_SOCKET'
+
+
+def _load_deepseg_sc_ctr(fname, **params):
+    from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_ctr
+    model = nn_architecture_ctr(**params)
+    model.load_weights(fname)
+    return model
+
+
+def _load_deepseg_sc_seg(fname, **params):
+    from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_seg
+    model = nn_architecture_seg(**params)
+    model.load_weights(fname)
+    return model
+
+
+def _load_deepseg_sc_3d(fname):
+    from spinalcordtoolbox.deepseg_sc.cnn_models_3d import load_trained_model
+    return load_trained_model(fname)
+
+
+def _load_deepseg_gm(model_name, input_size):
+    from spinalcordtoolbox.deepseg_gm import model
+    from spinalcordtoolbox.deepseg_gm.deepseg_gm import DataResource, check_backend
+    check_backend()
+    resource = DataResource('deepseg_gm_models')
+    model_path, metadata_path = model.MODELS[model_name]
+    with open(resource.get_file_path(metadata_path)) as fp:
+        metadata = json.load(fp)
+    deepgmseg_model = model.create_model(metadata['filters'], tuple(input_size))
+    deepgmseg_model.load_weights(resource.get_file_path(model_path))
+    return deepgmseg_model
+
+
+# functions building a model, indexed by loader name. Keras is only imported when a model is loaded.
+LOADERS = {
+    'deepseg_sc_ctr': _load_deepseg_sc_ctr,
+    'deepseg_sc_seg': _load_deepseg_sc_seg,
+    'deepseg_sc_3d': _load_deepseg_sc_3d,
+    'deepseg_gm': _load_deepseg_gm,
+}
+
+# models loaded in the current process, indexed by spec key
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_key(spec):
+    return json.dumps(spec, sort_keys=True)
+
+
+def load_model(spec):
+    """
+    Load a model in the current process. Models are cached, so each one is only loaded once per process.
+    :param spec: dict with keys 'loader' (see LOADERS) and 'params'
+    :return: Keras model
+    """
+    key = get_key(spec)
+    with _models_lock:
+        if key not in _models:
+            if not _models:
+                # limit the number of TensorFlow threads when running within a batch (see sct_pipeline)
+                configure_keras_session()
+            logger.debug('Load model %s', key)
+            _models[key] = LOADERS[spec['loader']](**spec['params'])
+        return _models[key]
+
+
+def get_socket_path():
+    """
+    :return: str: socket of the inference server (environment variable SCT_INFERENCE_SOCKET, or a socket of the
+      current user in the temporary folder)
+    """
+    return os.environ.get(ENV_SOCKET) or \
+        os.path.join(tempfile.gettempdir(), 'sct_inference_{}.sock'.format(os.getuid()))
+
+
+def connect(socket_path=None):
+    """
+    :param socket_path: str. Default: get_socket_path()
+    :return: socket connected to the inference server, or None if no server is running
+    """
+    socket_path = socket_path or get_socket_path()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        # stale socket file
+        sock.close()
+        return None
+    return sock
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        nbytes = sock.recv_into(view[pos:], size - pos)
+        if nbytes == 0:
+            raise EOFError('Connection closed')
+        pos += nbytes
+    return buf
+
+
+def send_message(sock, header, array=None):
+    """
+    Send a message: a JSON header, and optionally an array (sent as raw bytes, its dtype and shape are added to the
+    header).
+    """
+    header = dict(header)
+    data = b''
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header['dtype'] = array.dtype.str
+        header['shape'] = list(array.shape)
+        data = array.tobytes()
+    header_bytes = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('!QQ', len(header_bytes), len(data)) + header_bytes)
+    if data:
+        sock.sendall(data)
+
+
+def recv_message(sock):
+    """
+    :return: tuple (header, array). array is None if the message has no array.
+    :raise EOFError: if the connection was closed
+    """
+    header_size, data_size = struct.unpack('!QQ', bytes(_recv_exactly(sock, 16)))
+    header = json.loads(bytes(_recv_exactly(sock, header_size)).decode('utf-8'))
+    array = None
+    if 'dtype' in header:
+        array = np.frombuffer(_recv_exactly(sock, data_size), dtype=np.dtype(str(header['dtype'])))
+        array = array.reshape(header['shape'])
+    return header, array
+
+
+class RemoteModel(object):
+    """
+    Model run by the inference server, with the same predict() method as a Keras model. If the connection to the server
+    is lost, the model is loaded in the current process.
+    """
+
+    def __init__(self, spec, sock):
+        self.spec = spec
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def predict(self, x, batch_size=None, verbose=0):
+        if self.sock is not None:
+            try:
+                send_message(self.sock, {'type': 'predict', 'model': self.spec}, x)
+                header, preds = recv_message(self.sock)
+            except (socket.error, EOFError) as e:
+                logger.warning('Lost connection to the inference server (%s): running the model in-process', e)
+                self.close()
+            else:
+                if header['status'] != 'ok':
+                    raise RuntimeError('Inference server: {}'.format(header['error']))
+                return preds
+        kwargs = {'batch_size': batch_size} if batch_size is not None else {}
+        return load_model(self.spec).predict(x, verbose=verbose, **kwargs)
+
+
+def get_model(loader, **params):
+    """
+    Get a model to run predictions with: the model of the inference server if one is running, otherwise the model
+    loaded in the current process.
+    :param loader: str: see LOADERS
+    :param params: parameters of the loader (JSON serializable, file names must be absolute)
+    :return: object with a predict(x, batch_size=None, verbose=0) method
+    """
+    spec = {'loader': loader, 'params': params}
+    sock = connect()
+    if sock is None:
+        return load_model(spec)
+    logger.debug('Use the inference server for model %s', get_key(spec))
+    return RemoteModel(spec, sock)
+
+
+class _Request(object):
+    def __init__(self, spec, data):
+        self.spec = spec
+        self.data = data
+        # requests with the same batch key can be concatenated
+        self.batch_key = (get_key(spec), data.dtype.str, data.shape[1:])
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceServer(object):
+    """
+    Server keeping the models loaded. Connections are handled by one thread each, while all the models are loaded and
+    run by the thread calling serve_forever() (TensorFlow sessions are bound to the thread that creates the graph).
+    """
+
+    def __init__(self, socket_path=None, batch_size=32, batch_delay=0.01):
+        """
+        :param socket_path: str. Default: get_socket_path()
+        :param batch_size: int: batch size of the predictions
+        :param batch_delay: float: time to wait for requests of other clients before running a batch, in s
+        """
+        self.socket_path = socket_path or get_socket_path()
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = Queue()
+        self.sock = None
+        self.stopped = threading.Event()
+        self.ready = threading.Event()
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            sock = connect(self.socket_path)
+            if sock is not None:
+                sock.close()
+                raise RuntimeError('An inference server is already running on {}'.format(self.socket_path))
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            self.sock.listen(64)
+            thread = threading.Thread(target=self._accept_loop)
+            thread.daemon = True
+            thread.start()
+            logger.info('Inference server listening on %s', self.socket_path)
+            self.ready.set()
+            self._inference_loop()
+        finally:
+            self.stopped.set()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)  # wake up the accept loop
+            except socket.error:
+                pass
+            self.sock.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        self.stopped.set()
+
+    def _accept_loop(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                break  # socket closed
+            thread = threading.Thread(target=self._handle_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle_connection(self, conn):
+        try:
+            while True:
+                try:
+                    header, data = recv_message(conn)
+                except EOFError:
+                    break
+                if header['type'] == 'ping':
+                    send_message(conn, {'status': 'ok', 'models': sorted(_models)})
+                elif header['type'] == 'predict':
+                    request = _Request(header['model'], data)
+                    self.queue.put(request)
+                    while not request.done.wait(0.5) and not self.stopped.is_set():
+                        pass
+                    if not request.done.is_set():
+                        # server stopped: closing the connection makes the client run the model in-process
+                        break
+                    if request.error is not None:
+                        send_message(conn, {'status': 'error', 'error': request.error})
+                    else:
+                        send_message(conn, {'status': 'ok'}, request.result)
+                else:
+                    send_message(conn, {'status': 'error', 'error': 'Unknown request {}'.format(header['type'])})
+        except socket.error as e:
+            logger.debug('Connection error: %s', e)
+        finally:
+            conn.close()
+
+    def _inference_loop(self):
+        pending = []
+        while not self.stopped.is_set():
+            if not pending:
+                try:
+                    pending.append(self.queue.get(timeout=0.5))
+                except Empty:
+                    continue
+            # wait a little for the requests of other clients, to run them in the same batch
+            deadline = time.time() + self.batch_delay
+            while True:
+                try:
+                    pending.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except Empty:
+                    break
+            batch_key = pending[0].batch_key
+            batch = [r for r in pending if r.batch_key == batch_key]
+            pending = [r for r in pending if r.batch_key != batch_key]
+            self._predict(batch)
+
+    def _predict(self, batch):
+        try:
+            model = load_model(batch[0].spec)
+            data = np.concatenate([r.data for r in batch]) if len(batch) > 1 else batch[0].data
+            preds = model.predict(data, batch_size=self.batch_size)
+            start = 0
+            for request in batch:
+                request.result = preds[start:start + len(request.data)]
+                start += len(request.data)
+            logger.debug('Predicted %d sample(s) from %d request(s)', len(data), len(batch))
+        except Exception as e:
+            logger.exception(e)
+            for request in batch:
+                request.error = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            for request in batch:
+                request.done.set()
@@ -10,6 +10,7 @@ import numpy as np
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
+from spinalcordtoolbox import trace
 from spinalcordtoolbox.aggregate_slicewise import Metric
 # TODO don't import SCT stuff outside of spinalcordtoolbox/
 from spinalcordtoolbox.centerline.core import get_centerline
@@ -23,6 +24,7 @@ OUTPUT_CSA_VOLUME = 0
 OUTPUT_ANGLE_VOLUME = 0
 
 
+@trace.traced('process_seg: compute csa')
 def compute_csa(segmentation, algo_fitting='bspline', angle_correction=True,
                 use_phys_coord=True, remove_temp_files=1, verbose=1):
     """
@@ -128,6 +130,7 @@ def compute_csa(segmentation, algo_fitting='bspline', angle_correction=True,
     return metrics
 
 
+@trace.traced('process_seg: compute shape')
 def compute_shape(segmentation, algo_fitting='bspline', window_length=50, remove_temp_files=1, verbose=1):
     """
     This function characterizes the shape of the spinal cord, based on the segmentation
@@ -5,12 +5,9 @@ from __future__ import print_function, absolute_import, division
 
 import sys
 import os
-import json
 import logging
 import warnings
 import datetime
-import io
-from string import Template
 
 warnings.filterwarnings("ignore")
 
@@ -20,13 +17,13 @@ import skimage
 import skimage.io
 import skimage.exposure
 
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
 import matplotlib.colors as color
 
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
 import spinalcordtoolbox.reports.slice as qcslice
+import spinalcordtoolbox.reports.render as qcrender
+import spinalcordtoolbox.reports.store as qcstore
 
 logger = logging.getLogger("sct.{}".format(__file__))
 
@@ -64,10 +61,10 @@ class QcImage(object):
                      "#9f89b0", "#e08e08", "#3d2b54",
                      "#7d0434", "#fb1849", "#14aab4",
                      "#a22abd", "#d58240", "#ac2aff"]
-    # _seg_colormap = plt.cm.autumn
+    _seg_colormap = 'autumn'
 
     def __init__(self, qc_report, interpolation, action_list, stretch_contrast=True,
-                 stretch_contrast_method='contrast_stretching'):
+                 stretch_contrast_method='contrast_stretching', update_description=True):
         """
 
         Parameters
@@ -75,17 +72,22 @@ class QcImage(object):
         qc_report : QcReport
             The QC report object
         interpolation : str
-            Type of interpolation used in matplotlib
+            Type of interpolation. Kept for compatibility: images are always rendered with nearest-neighbour
+            interpolation
         action_list : list of functions
             List of functions that generates a specific type of images
         stretch_contrast : adjust image so as to improve contrast
         stretch_contrast_method: {'contrast_stretching', 'equalized'}: Method for stretching contrast
+        update_description : bool
+            If False, the entry is not added to the description file (the caller is in charge of it, see
+            generate_qc_batch)
         """
         self.qc_report = qc_report
         self.interpolation = interpolation
         self.action_list = action_list
         self._stretch_contrast = stretch_contrast
         self._stretch_contrast_method = stretch_contrast_method
+        self.update_description = update_description
 
     """
     action_list contain the list of images that has to be generated.
@@ -93,19 +95,12 @@ class QcImage(object):
     Ex: if 'colorbar' is in the list, the process will generate a color bar in the "img" folder
     """
 
-    def listed_seg(self, mask, ax):
+    def listed_seg(self, mask, canvas):
         """Create figure with red segmentation. Common scenario."""
         img = np.rint(np.ma.masked_where(mask < 1, mask))
-        ax.imshow(img,
-                  cmap=color.ListedColormap(self._color_bin_red),
-                  norm=color.Normalize(vmin=0, vmax=1),
-                  interpolation=self.interpolation,
-                  alpha=1,
-                  aspect=float(self.aspect_mask))
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-
-    def template(self, mask, ax):
+        canvas.imshow(color.ListedColormap(self._color_bin_red)(color.Normalize(vmin=0, vmax=1)(img)))
+
+    def template(self, mask, canvas):
         """Show template statistical atlas"""
         values = mask
         values[values < 0.5] = 0
@@ -114,68 +109,42 @@ class QcImage(object):
         color_cyan = color.colorConverter.to_rgba('cyan', alpha=0.8)
         cmap = color.LinearSegmentedColormap.from_list('cmap_atlas',
                                                        [color_white, color_blue, color_cyan], N=256)
-        ax.imshow(values,
-                  cmap=cmap,
-                  interpolation=self.interpolation,
-                  aspect=self.aspect_mask)
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-
-    def no_seg_seg(self, mask, ax):
+        canvas.imshow(cmap(color.Normalize()(values)))
+
+    def no_seg_seg(self, mask, canvas):
         """Create figure with image overlay. Notably used by sct_registration_to_template"""
-        ax.imshow(mask, cmap='gray', interpolation=self.interpolation, aspect=self.aspect_mask)
-        self._add_orientation_label(ax)
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
+        canvas.imshow(qcrender.gray_to_rgba(mask))
+        self._add_orientation_label(canvas)
 
-    def sequential_seg(self, mask, ax):
+    def sequential_seg(self, mask, canvas):
+        from matplotlib import cm
         values = np.ma.masked_equal(np.rint(mask), 0)
-        ax.imshow(values,
-                  cmap=self._seg_colormap,
-                  interpolation=self.interpolation,
-                  aspect=self.aspect_mask)
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-
-    def label_vertebrae(self, mask, ax):
+        canvas.imshow(cm.get_cmap(self._seg_colormap)(color.Normalize()(values)))
+
+    def label_vertebrae(self, mask, canvas):
         """Draw vertebrae areas, then add text showing the vertebrae names"""
-        from matplotlib import colors
         import scipy.ndimage
         img = np.rint(np.ma.masked_where(mask < 1, mask))
-        ax.imshow(img,
-                  cmap=colors.ListedColormap(self._labels_color),
-                  norm=colors.Normalize(vmin=0, vmax=len(self._labels_color)),
-                  interpolation=self.interpolation,
-                  alpha=1,
-                  aspect=float(self.aspect_mask))
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        a = [0.0]
+        canvas.imshow(color.ListedColormap(self._labels_color)(
+            color.Normalize(vmin=0, vmax=len(self._labels_color))(img)))
         data = mask
-        for index, val in np.ndenumerate(data):
-            if val not in a:
-                a.append(val)
-                index = int(val)
-                if index in self._labels_regions.values():
-                    color = self._labels_color[index]
-                    y, x = scipy.ndimage.measurements.center_of_mass(np.where(data == val, data, 0))
-                    # Draw text with a shadow
-                    x += 10
-                    label = list(self._labels_regions.keys())[list(self._labels_regions.values()).index(index)]
-                    ax.text(x, y, label, color='black', clip_on=True)
-                    x -= 0.5
-                    y -= 0.5
-                    ax.text(x, y, label, color=color, clip_on=True)
-
-    def highlight_pmj(self, mask, ax):
+        for val in np.unique(data[data != 0]):
+            index = int(val)
+            if index in self._labels_regions.values():
+                color_label = self._labels_color[index]
+                y, x = scipy.ndimage.measurements.center_of_mass(np.where(data == val, data, 0))
+                # Draw text with a shadow
+                x += 10
+                label = list(self._labels_regions.keys())[list(self._labels_regions.values()).index(index)]
+                canvas.text(x, y, label, color='black', dpi=self.qc_report.qc_params.dpi)
+                x -= 0.5
+                y -= 0.5
+                canvas.text(x, y, label, color=color_label, dpi=self.qc_report.qc_params.dpi)
+
+    def highlight_pmj(self, mask, canvas):
         """Hook to show a rectangle where PMJ is on the slice"""
-        import matplotlib.patches as patches
-        y, x = np.where(mask == 50)
-        img = np.full_like(mask, np.nan)
-        ax.imshow(img, cmap='gray', alpha=0, aspect=float(self.aspect_mask))
-        ax.text(x, y, 'X', color='lime', clip_on=True)
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
+        for y, x in zip(*np.where(mask == 50)):
+            canvas.text(x, y, 'X', color='lime', dpi=self.qc_report.qc_params.dpi)
 
     # def colorbar(self):
     #     fig = plt.figure(figsize=(9, 1.5))
@@ -204,7 +173,7 @@ class QcImage(object):
 
             Returns
             -------
-
+            dict: description of the QC entry
             """
             self.qc_report.slice_name = sct_slice.get_name()
 
@@ -252,61 +221,62 @@ class QcImage(object):
 
                 img = func_stretch_contrast[self._stretch_contrast_method](img)
 
-            fig = Figure()
-            FigureCanvas(fig)
-            ax = fig.add_subplot(111)
-            ax.imshow(img, cmap='gray', interpolation=self.interpolation, aspect=float(aspect_img))
-            self._add_orientation_label(ax)
-            ax.get_xaxis().set_visible(False)
-            ax.get_yaxis().set_visible(False)
-            self._save(fig, self.qc_report.qc_params.abs_bkg_img_path(), dpi=self.qc_report.qc_params.dpi)
+            canvas = self._new_canvas(img.shape, aspect_img)
+            canvas.imshow(qcrender.gray_to_rgba(img))
+            self._add_orientation_label(canvas)
+            logger.debug('Save image %s', self.qc_report.qc_params.abs_bkg_img_path())
+            canvas.save(self.qc_report.qc_params.abs_bkg_img_path())
 
             for action in self.action_list:
                 logger.debug('Action List %s', action.__name__)
                 if self._stretch_contrast and action.__name__ in ("no_seg_seg",):
                     print("Mask type %s" % mask.dtype)
                     mask = func_stretch_contrast[self._stretch_contrast_method](mask)
-                fig = Figure()
-                FigureCanvas(fig)
-                ax = fig.add_subplot(111)
-                action(self, mask, ax)
-                self._save(fig, self.qc_report.qc_params.abs_overlay_img_path(), dpi=self.qc_report.qc_params.dpi)
+                canvas = self._new_canvas(mask.shape, self.aspect_mask)
+                action(self, mask, canvas)
+                logger.debug('Save image %s', self.qc_report.qc_params.abs_overlay_img_path())
+                canvas.save(self.qc_report.qc_params.abs_overlay_img_path())
 
-            self.qc_report.update_description_file(img.shape)
+            description = self.qc_report.get_description(img.shape)
+            if self.update_description:
+                self.qc_report.add_descriptions([description])
+            return description
 
         return wrapped_f
 
-    def _add_orientation_label(self, ax):
+    def _new_canvas(self, shape, aspect):
+        """
+        Create the canvas on which an image of a given shape is drawn. The zoom factor reproduces the size that the
+        image would have in a default matplotlib figure saved at the requested dpi, so that font sizes (in points)
+        remain consistent with the image.
+        :param shape: (rows, columns) of the image
+        :param aspect: float: height/width ratio of the pixels
+        :return: spinalcordtoolbox.reports.render.Canvas
+        """
+        import matplotlib
+        aspect = float(aspect)
+        fig_width, fig_height = matplotlib.rcParams['figure.figsize']
+        box_width = fig_width * (matplotlib.rcParams['figure.subplot.right'] -
+                                 matplotlib.rcParams['figure.subplot.left'])
+        box_height = fig_height * (matplotlib.rcParams['figure.subplot.top'] -
+                                   matplotlib.rcParams['figure.subplot.bottom'])
+        dpi = self.qc_report.qc_params.dpi
+        zoom = min(box_width * dpi / shape[1], box_height * dpi / (shape[0] * aspect))
+        return qcrender.Canvas(shape, aspect=aspect, zoom=zoom)
+
+    def _add_orientation_label(self, canvas):
         """
         Add orientation labels on the figure
-        :param fig: MPL figure handler
+        :param canvas: spinalcordtoolbox.reports.render.Canvas
         :return:
         """
         if self.qc_report.qc_params.orientation == 'Axial':
             # If mosaic of axial slices, display orientation labels
-            ax.text(12, 6, 'A', color='yellow', size=6)
-            ax.text(12, 28, 'P', color='yellow', size=6)
-            ax.text(0, 18, 'L', color='yellow', size=6)
-            ax.text(24, 18, 'R', color='yellow', size=6)
-
-    def _save(self, fig, img_path, format='png', bbox_inches='tight', pad_inches=0.00, dpi=300):
-        """
-        Save the current figure into an image.
-        :param fig: Figure handler
-        :param img_path: str: path of the folder where the image is saved
-        :param format: str: image format
-        :param bbox_inches: str
-        :param pad_inches: float
-        :param dpi: int: Output resolution of the image
-        :return:
-        """
-        logger.debug('Save image %s', img_path)
-        fig.savefig(img_path,
-                    format=format,
-                    bbox_inches=bbox_inches,
-                    pad_inches=pad_inches,
-                    transparent=True,
-                    dpi=dpi)
+            dpi = self.qc_report.qc_params.dpi
+            canvas.text(12, 6, 'A', color='yellow', size=6, dpi=dpi)
+            canvas.text(12, 28, 'P', color='yellow', size=6, dpi=dpi)
+            canvas.text(0, 18, 'L', color='yellow', size=6, dpi=dpi)
+            canvas.text(24, 18, 'R', color='yellow', size=6, dpi=dpi)
 
 
 class Params(object):
@@ -395,13 +365,13 @@ class QcReport(object):
             if not os.path.isdir(target_img_folder):
                 raise err
 
-    def update_description_file(self, dimension):
-        """Create the description file with a JSON structure
+    def get_description(self, dimension):
+        """Build the description of the QC entry
 
         :param: dimension 2-tuple, the dimension of the image frame (w, h)
+        :return: dict
         """
-
-        output = {
+        return {
             'python': sys.executable,
             'cwd': self.qc_params.cwd,
             'cmdline': "{} {}".format(self.qc_params.command, self.qc_params.args),
@@ -414,36 +384,29 @@ class QcReport(object):
             'orientation': self.qc_params.orientation,
             'background_img': self.qc_params.bkg_img_path,
             'overlay_img': self.qc_params.overlay_img_path,
-            'dimension': '%dx%d' % dimension,
+            'dimension': '%dx%d' % tuple(dimension),
             'moddate': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
-        logger.debug('Description file: %s', self.qc_params.qc_results)
-        results = []
-        if os.path.isfile(self.qc_params.qc_results):
-            results = json.load(open(self.qc_params.qc_results, 'r'))
-        results.append(output)
-        json.dump(results, open(self.qc_params.qc_results, "w"), indent=2)
-        self._update_html_assets(results)
-
-    def _update_html_assets(self, json_data):
-        """Update the html file and assets"""
-        assets_path = os.path.join(os.path.dirname(__file__), 'assets')
-        dest_path = self.qc_params.root_folder
-
-        with io.open(os.path.join(assets_path, 'index.html')) as template_index:
-            template = Template(template_index.read())
-            output = template.substitute(sct_json_data=json.dumps(json_data))
-            io.open(os.path.join(dest_path, 'index.html'), 'w').write(output)
-
-        for path in ['css', 'js', 'imgs', 'fonts']:
-            src_path = os.path.join(assets_path, '_assets', path)
-            dest_full_path = os.path.join(dest_path, '_assets', path)
-            if not os.path.exists(dest_full_path):
-                os.makedirs(dest_full_path)
-            for file_ in os.listdir(src_path):
-                if not os.path.isfile(os.path.join(dest_full_path, file_)):
-                    sct.copy(os.path.join(src_path, file_),
-                             dest_full_path)
+
+    def update_description_file(self, dimension):
+        """Create the description file with a JSON structure
+
+        :param: dimension 2-tuple, the dimension of the image frame (w, h)
+        """
+        self.add_descriptions([self.get_description(dimension)])
+
+    def add_descriptions(self, descriptions):
+        """Append QC entries to the entry store of the QC folder, and update the description file and html page
+        (unless SCT_QC_DEFER_INDEX=1, see spinalcordtoolbox.reports.store). Appending does not depend on the number of
+        entries already in the folder, but updating the index rewrites all of them: only the deferred mode is
+        constant-time per entry.
+
+        :param descriptions: list of dict, as returned by get_description()
+        """
+        store = qcstore.QcStore(self.qc_params.root_folder)
+        store.append(descriptions)
+        if not qcstore.is_index_deferred():
+            store.generate_index()
 
 
 def add_entry(src, process, args, path_qc, plane, background=None, foreground=None,
@@ -451,7 +414,8 @@ def add_entry(src, process, args, path_qc, plane, background=None, foreground=No
               qcslice_operations=[],
               qcslice_layout=None,
               dpi=300,
-              stretch_contrast_method='contrast_stretching'):
+              stretch_contrast_method='contrast_stretching',
+              update_description=True):
     """
     Starting point to QC report creation.
 
@@ -467,18 +431,21 @@ def add_entry(src, process, args, path_qc, plane, background=None, foreground=No
     :param qcslice_layout:
     :param dpi: int: Output resolution of the image
     :param stretch_contrast_method: Method for stretching contrast. See QcImage
-    :return:
+    :param update_description: bool: If False, only the images are generated, and the description of the entry is
+      returned without being added to the description file.
+    :return: dict: description of the QC entry
     """
 
     qc_param = Params(src, process, args, plane, path_qc, dpi)
     report = QcReport(qc_param, '')
 
     if qcslice is not None:
-        @QcImage(report, 'none', qcslice_operations, stretch_contrast_method=stretch_contrast_method)
+        @QcImage(report, 'none', qcslice_operations, stretch_contrast_method=stretch_contrast_method,
+                 update_description=update_description)
         def layout(qslice):
             return qcslice_layout(qslice)
 
-        layout(qcslice)
+        description = layout(qcslice)
     else:
         report.make_content_path()
 
@@ -492,9 +459,18 @@ def add_entry(src, process, args, path_qc, plane, background=None, foreground=No
         else:
             skimage.io.imsave(qc_param.abs_bkg_img_path(), normalized(background))
 
-        report.update_description_file(foreground.shape[:2])
+        description = report.get_description(foreground.shape[:2])
+        if update_description:
+            report.add_descriptions([description])
+
+    if update_description:
+        _print_qc_location(qc_param.qc_results, path_qc)
+    return description
 
-    sct.printv('Successfully generated the QC results in %s' % qc_param.qc_results)
+
+def _print_qc_location(fname_qc_results, path_qc):
+    """Tell the user where the QC report is, and how to open it"""
+    sct.printv('Successfully generated the QC results in %s' % fname_qc_results)
     sct.printv('Use the following command to see the results in a browser:')
     try:
         from sys import platform as _platform
@@ -508,7 +484,8 @@ def add_entry(src, process, args, path_qc, plane, background=None, foreground=No
         print("WARNING! Platform undetectable.")
 
 
-def generate_qc(fname_in1, fname_in2=None, fname_seg=None, args=None, path_qc=None, process=None):
+def generate_qc(fname_in1, fname_in2=None, fname_seg=None, args=None, path_qc=None, process=None,
+                update_description=True):
     """
     Generate a QC entry allowing to quickly review results. This function is called by SCT scripts (e.g. sct_propseg).
 
@@ -518,7 +495,8 @@ def generate_qc(fname_in1, fname_in2=None, fname_seg=None, args=None, path_qc=No
     :param args: args from parent function
     :param path_qc: str: Path to save QC report
     :param process: str: Name of SCT function. e.g., sct_propseg
-    :return: None
+    :param update_description: bool: If False, the entry is not added to the description file. See add_entry
+    :return: dict: description of the QC entry
     """
     dpi = 300
     # Get QC specifics based on SCT process
@@ -556,7 +534,7 @@ def generate_qc(fname_in1, fname_in2=None, fname_seg=None, args=None, path_qc=No
     else:
         sct.log.error('Unrecognised process.')
 
-    add_entry(
+    return add_entry(
         src=fname_in1,
         process=process,
         args=args,
@@ -567,4 +545,61 @@ def generate_qc(fname_in1, fname_in2=None, fname_seg=None, args=None, path_qc=No
         qcslice_operations=qcslice_operations,
         qcslice_layout=qcslice_layout,
         stretch_contrast_method='equalized',
+        update_description=update_description,
     )
+
+
+def _generate_qc_worker(kwargs):
+    """Generate the images of one QC entry. Defined at the module level so that it can be sent to worker processes."""
+    return generate_qc(update_description=False, **kwargs)
+
+
+def generate_qc_batch(list_kwargs, nb_proc=None):
+    """
+    Generate QC entries for many subjects at once. Images are rendered on a pool of worker processes, then entries
+    are added to the store of each QC folder, and the html page is generated once per folder (not at all if
+    SCT_QC_DEFER_INDEX=1).
+
+    Example:
+
+    .. code:: python
+
+       generate_qc_batch([dict(fname_in1=fname_t2, fname_seg=fname_seg, path_qc=path_qc, process='sct_deepseg_sc')
+                          for fname_t2, fname_seg in zip(list_t2, list_seg)])
+
+    :param list_kwargs: list of dict: keyword arguments of generate_qc(), one per entry
+    :param nb_proc: int: number of worker processes. Default: number of CPUs. 0 or 1: entries are generated
+      sequentially in the current process.
+    :return: list of dict: descriptions of the QC entries
+    """
+    from multiprocessing import Pool, cpu_count
+    if nb_proc is None:
+        nb_proc = cpu_count()
+    if nb_proc > 1 and len(list_kwargs) > 1:
+        pool = Pool(min(nb_proc, len(list_kwargs)))
+        try:
+            descriptions = pool.map(_generate_qc_worker, list_kwargs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        descriptions = [_generate_qc_worker(kwargs) for kwargs in list_kwargs]
+
+    # gather entries by QC folder, keeping the input order
+    list_path_qc = []
+    dict_entries = {}
+    for kwargs, description in zip(list_kwargs, descriptions):
+        path_qc = os.path.abspath(kwargs['path_qc'])
+        if path_qc not in dict_entries:
+            list_path_qc.append(path_qc)
+            dict_entries[path_qc] = []
+        dict_entries[path_qc].append(description)
+
+    for path_qc in list_path_qc:
+        store = qcstore.QcStore(path_qc)
+        store.append(dict_entries[path_qc])
+        if not qcstore.is_index_deferred():
+            store.generate_index()
+        _print_qc_location(store.fname_json, path_qc)
+
+    return descriptions
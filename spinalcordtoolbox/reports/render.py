@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Render QC images as RGBA arrays and write them as PNG files, without going through matplotlib figures
+
+from __future__ import absolute_import, division
+
+import struct
+import zlib
+
+import numpy as np
+
+
+def to_uint8(rgba):
+    """
+    Convert RGBA values in [0, 1] to uint8
+    """
+    return np.round(np.clip(rgba, 0, 1) * 255).astype(np.uint8)
+
+
+def gray_to_rgba(data, vmin=None, vmax=None):
+    """
+    Map a 2d array to opaque gray levels (linear scaling between vmin and vmax, as done by matplotlib's imshow).
+    :param data: 2d array
+    :param vmin: value displayed in black. Default: minimum of data.
+    :param vmax: value displayed in white. Default: maximum of data.
+    :return: float array (h, w, 4) in [0, 1]
+    """
+    data = np.asarray(data, dtype=np.float64)
+    vmin = np.nanmin(data) if vmin is None else vmin
+    vmax = np.nanmax(data) if vmax is None else vmax
+    if vmax > vmin:
+        gray = (data - vmin) / (vmax - vmin)
+    else:
+        gray = np.zeros_like(data)
+    rgba = np.empty(data.shape + (4,))
+    rgba[..., :3] = np.nan_to_num(gray)[..., np.newaxis]
+    rgba[..., 3] = 1
+    return rgba
+
+
+class Canvas(object):
+    """
+    RGBA image on which 2d arrays are drawn with nearest-neighbour zoom (the aspect ratio of the pixels is taken into
+    account along the rows), and text is written at positions given in array coordinates.
+    """
+
+    def __init__(self, shape, aspect=1., zoom=1.):
+        """
+        :param shape: (rows, columns) of the arrays that will be drawn
+        :param aspect: height/width ratio of the pixels
+        :param zoom: number of output pixels per column of the arrays
+        """
+        self.shape = shape
+        self.zoom_col = zoom
+        self.zoom_row = zoom * aspect
+        self.rows = np.minimum((np.arange(int(round(shape[0] * self.zoom_row))) / self.zoom_row).astype(int),
+                               shape[0] - 1)
+        self.cols = np.minimum((np.arange(int(round(shape[1] * self.zoom_col))) / self.zoom_col).astype(int),
+                               shape[1] - 1)
+        self.rgba = np.zeros((len(self.rows), len(self.cols), 4))
+
+    def imshow(self, rgba):
+        """
+        Draw an RGBA array (values in [0, 1]) over the current content of the canvas.
+        """
+        self._composite(np.asarray(rgba)[np.ix_(self.rows, self.cols)], 0, 0)
+
+    def text(self, x, y, string, color, size=10, dpi=100):
+        """
+        Write text with its baseline starting at position (x, y), given in array coordinates (x: column, y: row).
+        :param size: font size in points
+        :param dpi: resolution used to convert the font size into pixels
+        """
+        from matplotlib.colors import to_rgba
+        bitmap, descent = _rasterize_text(string, size, dpi)
+        row = int(round(y * self.zoom_row)) - (bitmap.shape[0] - descent)
+        col = int(round(x * self.zoom_col))
+        layer = np.empty(bitmap.shape + (4,))
+        layer[...] = to_rgba(color)
+        layer[..., 3] *= bitmap / 255
+        self._composite(layer, row, col)
+
+    def _composite(self, layer, row, col):
+        """
+        Alpha-composite a layer over the canvas, with its top-left corner at (row, col). The layer is clipped to the
+        canvas.
+        """
+        h, w = self.rgba.shape[:2]
+        r0, c0 = max(row, 0), max(col, 0)
+        r1, c1 = min(row + layer.shape[0], h), min(col + layer.shape[1], w)
+        if r0 >= r1 or c0 >= c1:
+            return
+        src = layer[r0 - row:r1 - row, c0 - col:c1 - col]
+        dst = self.rgba[r0:r1, c0:c1]
+        alpha_src = src[..., 3:]
+        alpha_out = alpha_src + dst[..., 3:] * (1 - alpha_src)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            color = (src[..., :3] * alpha_src + dst[..., :3] * dst[..., 3:] * (1 - alpha_src)) / alpha_out
+        dst[..., :3] = np.where(alpha_out > 0, color, 0)
+        dst[..., 3:] = alpha_out
+
+    def save(self, fname):
+        write_png(fname, to_uint8(self.rgba))
+
+
+_font_cache = {}
+
+
+def _rasterize_text(string, size, dpi):
+    """
+    Rasterize text with the default matplotlib font (FreeType, no figure involved).
+    :return: uint8 coverage bitmap, and number of rows below the baseline
+    """
+    from matplotlib.font_manager import findfont, FontProperties
+    from matplotlib.ft2font import FT2Font
+    fname = findfont(FontProperties())
+    if fname not in _font_cache:
+        _font_cache[fname] = FT2Font(fname)
+    font = _font_cache[fname]
+    font.clear()
+    font.set_size(size, dpi)
+    font.set_text(string, 0.0)
+    font.draw_glyphs_to_bitmap(antialiased=True)
+    return np.asarray(font.get_image()), int(round(font.get_descent() / 64))
+
+
+def write_png(fname, data):
+    """
+    Write an 8-bit grayscale, RGB or RGBA image as a PNG file.
+    :param fname: output file name
+    :param data: uint8 array of shape (h, w), (h, w, 3) or (h, w, 4)
+    """
+    data = np.ascontiguousarray(data, dtype=np.uint8)
+    if data.ndim == 2:
+        data = data[..., np.newaxis]
+    h, w, nb_channels = data.shape
+    color_type = {1: 0, 3: 2, 4: 6}[nb_channels]
+    # each row starts with its filter type (0: none)
+    raw = np.zeros((h, w * nb_channels + 1), dtype=np.uint8)
+    raw[:, 1:] = data.reshape(h, -1)
+
+    def chunk(tag, content):
+        return struct.pack('>I', len(content)) + tag + content + \
+            struct.pack('>I', zlib.crc32(tag + content) & 0xffffffff)
+
+    with open(fname, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, color_type, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
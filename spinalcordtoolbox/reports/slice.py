@@ -10,7 +10,6 @@ import logging
 import math
 
 import numpy as np
-from scipy import ndimage
 
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.resampling import resample_nipy
@@ -163,6 +162,34 @@ class Slice(object):
         matrix[start_row:end_row, start_col:end_col] = patch
         return matrix
 
+    @staticmethod
+    def crop_patches(slices, centers_x, centers_y, width, height):
+        """Crops a stack of slices around their centers, with the same rules as crop()
+
+        Patches are zero-padded at the end to the size (width * 2, height * 2), as done by add_slice() when the
+        cropped matrix is smaller than a mosaic square.
+
+        :param slices: 3d array: stack of 2d slices (along the first axis)
+        :param centers_x: centers of the crop areas in the x axis, one per slice
+        :param centers_y: centers of the crop areas in the y axis, one per slice
+        :param width: The width from the center
+        :param height: The height from the center
+        :returns: numpy.ndarray of shape (nb_slices, width * 2, height * 2)
+        """
+        nb_slices, nx, ny = slices.shape
+        width_crop, height_crop = min(width, nx // 2), min(height, ny // 2)
+        start_row = np.maximum(np.asarray(centers_x[:nb_slices]).astype(int), width_crop) - width_crop
+        start_col = np.maximum(np.asarray(centers_y[:nb_slices]).astype(int), height_crop) - height_crop
+        # pad with zeros so that crop areas going past the border are truncated, as with slicing
+        padded = np.zeros((nb_slices, nx + width_crop * 2, ny + height_crop * 2))
+        padded[:, :nx, :ny] = slices
+        rows = start_row[:, np.newaxis] + np.arange(width_crop * 2)
+        cols = start_col[:, np.newaxis] + np.arange(height_crop * 2)
+        patches = np.zeros((nb_slices, width * 2, height * 2))
+        patches[:, :width_crop * 2, :height_crop * 2] = \
+            padded[np.arange(nb_slices)[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+        return patches
+
     @staticmethod
     def nan_fill(A):
         """Interpolate NaN values with neighboring values in array (in-place)
@@ -211,12 +238,12 @@ class Slice(object):
         :returns: centers of mass in the x and y axis (tuple of numpy.ndarray of int)
             .
         """
-        axial_dim = self.axial_dim(image)
-        centers_x = np.zeros(axial_dim)
-        centers_y = np.zeros(axial_dim)
-        for i in range(axial_dim):
-            aslice = self.axial_slice(np.array(image.data), i)  # we cast np.array to overcome
-            centers_x[i], centers_y[i] = ndimage.measurements.center_of_mass(aslice)
+        data = np.asarray(image.data, dtype=np.float64)
+        # weighted sums over each axial slice (same as ndimage.measurements.center_of_mass, NaN for empty slices)
+        total = data.sum(axis=(1, 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centers_x = np.dot(data.sum(axis=2), np.arange(data.shape[1])) / total
+            centers_y = np.dot(data.sum(axis=1), np.arange(data.shape[2])) / total
         try:
             Slice.nan_fill(centers_x)
             Slice.nan_fill(centers_y)
@@ -252,13 +279,11 @@ class Slice(object):
 
         matrices = list()
         for image in self._images:
-            matrix = np.zeros(matrix_sz)
-            for i in range(dim):
-                x = int(centers_x[i])
-                y = int(centers_y[i])
-                # crop slice around center of mass and add slice to the matrix layout
-                self.add_slice(matrix, i, nb_column, size, self.crop(self.get_slice(image.data, i), x, y, size, size))
-
+            slices = np.stack([self.get_slice(image.data, i) for i in range(dim)])
+            # crop slices around center of mass and arrange them in the matrix layout
+            patches = np.zeros((nb_row * nb_column, size * 2, size * 2))
+            patches[:dim] = self.crop_patches(slices, centers_x, centers_y, size, size)
+            matrix = patches.reshape(nb_row, nb_column, size * 2, size * 2).swapaxes(1, 2).reshape(matrix_sz)
             matrices.append(matrix)
 
         return matrices
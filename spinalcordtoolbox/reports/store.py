@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Append-only store of the QC entries of a QC folder. Entries are appended to a JSON-lines log under a file lock, and
+# the html index (which inlines all entries) is only generated on demand.
+
+from __future__ import absolute_import
+
+import os
+import io
+import json
+import logging
+import contextlib
+from string import Template
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking
+    fcntl = None
+
+import sct_utils as sct
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+
+def is_index_deferred():
+    """
+    :return: bool: True if the html index should not be regenerated after each new QC entry (environment variable
+      SCT_QC_DEFER_INDEX=1). In that case, the caller is in charge of running generate_index() at the end of the batch.
+    """
+    return os.environ.get('SCT_QC_DEFER_INDEX', '0') == '1'
+
+
+@contextlib.contextmanager
+def file_lock(fname):
+    """
+    Exclusive lock shared between processes, held while the context is active.
+    :param fname: str: lock file (created if it does not exist)
+    """
+    with open(fname, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class QcStore(object):
+    """
+    Entries of a QC folder.
+
+    - qc_results.jsonl: append-only log of the entries (one JSON object per line), which is the reference
+    - qc_results.json and index.html: generated from the log by generate_index()
+    """
+
+    def __init__(self, root_folder):
+        """
+        :param root_folder: str: The absolute path of the QC root
+        """
+        self.root_folder = root_folder
+        self.fname_log = os.path.join(root_folder, 'qc_results.jsonl')
+        self.fname_json = os.path.join(root_folder, 'qc_results.json')
+        self.fname_lock = os.path.join(root_folder, '.qc_results.lock')
+
+    def _make_root_folder(self):
+        try:
+            os.makedirs(self.root_folder)
+        except OSError as err:
+            if not os.path.isdir(self.root_folder):
+                raise err
+
+    def _import_legacy_entries(self):
+        """
+        Folders created by previous versions only have qc_results.json: copy its entries to the log. Must be called
+        with the lock held.
+        """
+        if not os.path.isfile(self.fname_log) and os.path.isfile(self.fname_json):
+            logger.debug('Import entries from %s', self.fname_json)
+            with open(self.fname_json, 'r') as f:
+                self._write_entries(json.load(f))
+
+    def _write_entries(self, entries):
+        lines = ''.join([json.dumps(entry) + '\n' for entry in entries])
+        with open(self.fname_log, 'a') as f:
+            f.write(lines)
+
+    def append(self, entries):
+        """
+        Append entries to the log. The cost does not depend on the number of entries already in the folder.
+        :param entries: list of dict
+        """
+        self._make_root_folder()
+        with file_lock(self.fname_lock):
+            self._import_legacy_entries()
+            self._write_entries(entries)
+
+    def read(self):
+        """
+        :return: list of dict: all entries, in the order in which they were added
+        """
+        if not os.path.isfile(self.fname_log):
+            if os.path.isfile(self.fname_json):
+                with open(self.fname_json, 'r') as f:
+                    return json.load(f)
+            return []
+        entries = []
+        with open(self.fname_log, 'r') as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # e.g. process killed while writing: skip the entry instead of breaking the whole report
+                    logger.warning('Skip corrupted line %d of %s', i + 1, self.fname_log)
+        return entries
+
+    def generate_index(self):
+        """
+        Write qc_results.json and index.html from the log, and copy the assets of the html page if needed. Both files
+        contain all the entries, so the cost grows with the number of entries in the folder.
+        :return: list of dict: all entries
+        """
+        self._make_root_folder()
+        with file_lock(self.fname_lock):
+            self._import_legacy_entries()
+            entries = self.read()
+            logger.debug('Description file: %s', self.fname_json)
+            with open(self.fname_json, 'w') as f:
+                json.dump(entries, f, indent=2)
+            self._update_html_assets(entries)
+        return entries
+
+    def _update_html_assets(self, json_data):
+        """Update the html file and assets"""
+        assets_path = os.path.join(os.path.dirname(__file__), 'assets')
+        dest_path = self.root_folder
+
+        with io.open(os.path.join(assets_path, 'index.html')) as template_index:
+            template = Template(template_index.read())
+            output = template.substitute(sct_json_data=json.dumps(json_data))
+            io.open(os.path.join(dest_path, 'index.html'), 'w').write(output)
+
+        for path in ['css', 'js', 'imgs', 'fonts']:
+            src_path = os.path.join(assets_path, '_assets', path)
+            dest_full_path = os.path.join(dest_path, '_assets', path)
+            if not os.path.exists(dest_full_path):
+                os.makedirs(dest_full_path)
+            for file_ in os.listdir(src_path):
+                if not os.path.isfile(os.path.join(dest_full_path, file_)):
+                    sct.copy(os.path.join(src_path, file_),
+                             dest_full_path)
+
+
+def generate_index(path_qc):
+    """
+    Generate the html index of a QC folder (e.g. at the end of a batch run with SCT_QC_DEFER_INDEX=1).
+    :param path_qc: str: Path of the QC folder
+    :return: list of dict: all entries
+    """
+    return QcStore(os.path.abspath(path_qc)).generate_index()
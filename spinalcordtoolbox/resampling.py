@@ -12,14 +12,154 @@
 
 from __future__ import division, absolute_import
 
+import os
+
 import nipy
 import numpy as np
+from scipy.ndimage import affine_transform, spline_filter1d
 from nipy.algorithms.registration.resample import resample as n_resample
 
 import sct_utils as sct
 
 
-def resample_nipy(img, new_size=None, new_size_type=None, img_dest=None, interpolation='linear', verbose=1):
+# maximum number of output voxels resampled at once for 4d data (bounds the memory used by temporary arrays)
+MAX_VOXELS_CHUNK = 2 ** 25
+
+# padding of the data before computing spline coefficients
+SPLINE_PAD = 12
+
+# set interpolation method
+dict_interp = {'nn': 0, 'linear': 1, 'spline': 2}
+
+
+def get_reference(img, new_size, new_size_type, verbose=1):
+    """Compute the output grid of a resampling.
+    :param img: nipy Image.
+    :param new_size: see resample_nipy()
+    :param new_size_type: see resample_nipy()
+    :return: tuple (shape_r, affine_r, R): shape and 4x4 affine of the output grid, and 4x4 transformation from the
+      output to the input voxel coordinates
+    """
+    # Get dimensions of data
+    p = img.header.get_zooms()
+    shape = img.header.get_data_shape()
+
+    # parse input argument
+    new_size = new_size.split('x')
+
+    if img.ndim == 4:
+        new_size += ['1']  # needed because the code below is general, i.e., does not assume 3d input and uses img.shape
+
+    # assert len(shape) == len(new_size)
+
+    # compute new shape based on specific resampling method
+    if new_size_type == 'vox':
+        shape_r = tuple([int(new_size[i]) for i in range(img.ndim)])
+    elif new_size_type == 'factor':
+        if len(new_size) == 1:
+            # isotropic resampling
+            new_size = tuple([new_size[0] for i in range(img.ndim)])
+        # compute new shape as: shape_r = shape * f
+        shape_r = tuple([int(np.round(shape[i] * float(new_size[i]))) for i in range(img.ndim)])
+    elif new_size_type == 'mm':
+        if len(new_size) == 1:
+            # isotropic resampling
+            new_size = tuple([new_size[0] for i in range(img.ndim)])
+        # compute new shape as: shape_r = shape * (p_r / p)
+        shape_r = tuple([int(np.round(shape[i] * float(p[i]) / float(new_size[i]))) for i in range(img.ndim)])
+    else:
+        sct.log.error('new_size_type is not recognized.')
+
+    # Generate 3d affine transformation: R
+    affine = img.affine[:4, :4]
+    affine[3, :] = np.array([0, 0, 0, 1])  # satisfy to nifti convention. Otherwise it grabs the temporal
+    sct.log.debug('Affine matrix: \n' + str(affine))
+    R = np.eye(4)
+    for i in range(3):
+        R[i, i] = img.shape[i] / float(shape_r[i])
+    affine_r = np.dot(affine, R)
+
+    return shape_r, affine_r, R
+
+
+def iter_resample_4d(data, R, shape_r, interp_order, dtype=np.float64, chunk_size=None):
+    """Resample all the 3d volumes of a 4d array with the same transformation, by chunks of volumes along t.
+    With nn and linear interpolation, each chunk is resampled by a single call on the 4d chunk (the t coordinate is left
+    unchanged). With spline interpolation, the spline coefficients are computed along the spatial axes for the whole
+    chunk, and each volume is then interpolated without pre-filtering.
+    :param data: 4d array (or array-like that can be sliced along t, e.g. a nibabel array proxy).
+    :param R: 4x4 transformation from the output to the input voxel coordinates
+    :param shape_r: shape of the output volumes (only the first 3 values are used)
+    :param interp_order: int: spline order of the interpolation (see dict_interp)
+    :param dtype: type of the output
+    :param chunk_size: int: number of volumes resampled at once. Default: as many as MAX_VOXELS_CHUNK allows.
+    :return: generator of tuples (t, data_r): index of the first volume of the chunk, and 4d array of its resampled
+      volumes
+    """
+    shape_r = tuple([int(n) for n in shape_r[:3]])
+    if chunk_size is None:
+        chunk_size = max(1, MAX_VOXELS_CHUNK // int(np.prod(shape_r)))
+    # same transformation, extended to the t axis
+    matrix = np.eye(4)
+    matrix[:3, :3] = R[:3, :3]
+    offset = np.append(R[:3, 3], 0)
+    for t in range(0, data.shape[3], chunk_size):
+        chunk = np.asarray(data[..., t:t + chunk_size])
+        nt = chunk.shape[3]
+        if interp_order <= 1:
+            data_r = affine_transform(chunk, matrix, offset=offset, output_shape=shape_r + (nt,), output=dtype,
+                                      order=interp_order, mode='nearest')
+        else:
+            # pad with the edge values before computing the coefficients, as done by scipy.ndimage for mode='nearest'
+            coefs = np.pad(chunk.astype(np.float64), [(SPLINE_PAD, SPLINE_PAD)] * 3 + [(0, 0)], mode='edge')
+            for axis in range(3):
+                spline_filter1d(coefs, interp_order, axis=axis, output=coefs)
+            data_r = np.empty(shape_r + (nt,), dtype=dtype)
+            for it in range(nt):
+                data_r[..., it] = affine_transform(coefs[..., it], R[:3, :3], offset=R[:3, 3] + SPLINE_PAD,
+                                                   output_shape=shape_r, order=interp_order, mode='nearest',
+                                                   prefilter=False)
+        yield t, data_r
+
+
+def save_4d_chunks(chunks, fname_out, shape, affine, dtype=np.float64):
+    """Write a 4d NIfTI image chunk by chunk, without holding the whole data in memory. NIfTI data is stored in
+    Fortran order, so that the volumes of each chunk are contiguous in the file.
+    :param chunks: iterable of tuples (t, data), in increasing t (see iter_resample_4d())
+    :param fname_out: str: output file (.nii or .nii.gz)
+    :param shape: shape of the 4d image
+    :param affine: 4x4 affine of the image
+    :param dtype: type of the data
+    """
+    import gzip
+    import nibabel as nib
+
+    hdr = nib.Nifti1Image(np.zeros((1, 1, 1, 1), dtype=dtype), affine).header
+    hdr.set_data_shape(shape)
+    hdr.set_data_offset(hdr.single_vox_offset)
+    # write to a temporary file first, in case fname_out is also the input file
+    fname_tmp = '{}.{}.tmp'.format(fname_out, os.getpid())
+    opener = gzip.open if fname_out.endswith('.gz') else open
+    try:
+        with opener(fname_tmp, 'wb') as f:
+            hdr.write_to(f)
+            f.write(b'\0' * (hdr.get_data_offset() - f.tell()))
+            t_next = 0
+            for t, data in chunks:
+                if t != t_next or data.shape[:3] != tuple(shape[:3]):
+                    raise ValueError('Chunks must be contiguous volumes of shape {}'.format(shape[:3]))
+                f.write(np.asfortranarray(data, dtype=dtype).tobytes(order='F'))
+                t_next += data.shape[3]
+            if t_next != shape[3]:
+                raise ValueError('Expected {} volumes, got {}'.format(shape[3], t_next))
+        os.rename(fname_tmp, fname_out)
+    finally:
+        if os.path.exists(fname_tmp):
+            os.remove(fname_tmp)
+
+
+def resample_nipy(img, new_size=None, new_size_type=None, img_dest=None, interpolation='linear', dtype=np.float64,
+                  chunk_size=None, verbose=1):
     """Resample a nipy image object based on a specified resampling factor.
     Can deal with 2d, 3d or 4d image objects.
     :param img: nipy Image.
@@ -32,53 +172,12 @@ def resample_nipy(img, new_size=None, new_size_type=None, img_dest=None, interpo
     :param img_dest: Destination nipy Image to resample the input image to. In this case, new_size and new_size_type are
       ignored
     :param interpolation: {'nn', 'linear', 'spline'}. The interpolation type
+    :param dtype: type of the output data (e.g. np.float32 to halve the memory used by large 4d data)
+    :param chunk_size: int: for 4d data, number of volumes resampled at once (see iter_resample_4d())
     :return: The resampled nipy Image.
     """
-    # TODO: deal with 4d (and other dim) data
-
-    # set interpolation method
-    dict_interp = {'nn': 0, 'linear': 1, 'spline': 2}
-
     if img_dest is None:
-        # Get dimensions of data
-        p = img.header.get_zooms()
-        shape = img.header.get_data_shape()
-
-        # parse input argument
-        new_size = new_size.split('x')
-
-        if img.ndim == 4:
-            new_size += ['1']  # needed because the code below is general, i.e., does not assume 3d input and uses img.shape
-
-        # assert len(shape) == len(new_size)
-
-        # compute new shape based on specific resampling method
-        if new_size_type == 'vox':
-            shape_r = tuple([int(new_size[i]) for i in range(img.ndim)])
-        elif new_size_type == 'factor':
-            if len(new_size) == 1:
-                # isotropic resampling
-                new_size = tuple([new_size[0] for i in range(img.ndim)])
-            # compute new shape as: shape_r = shape * f
-            shape_r = tuple([int(np.round(shape[i] * float(new_size[i]))) for i in range(img.ndim)])
-        elif new_size_type == 'mm':
-            if len(new_size) == 1:
-                # isotropic resampling
-                new_size = tuple([new_size[0] for i in range(img.ndim)])
-            # compute new shape as: shape_r = shape * (p_r / p)
-            shape_r = tuple([int(np.round(shape[i] * float(p[i]) / float(new_size[i]))) for i in range(img.ndim)])
-        else:
-            sct.log.error('new_size_type is not recognized.')
-
-        # Generate 3d affine transformation: R
-        affine = img.affine[:4, :4]
-        affine[3, :] = np.array([0, 0, 0, 1])  # satisfy to nifti convention. Otherwise it grabs the temporal
-        sct.log.debug('Affine matrix: \n' + str(affine), verbose)
-        R = np.eye(4)
-        for i in range(3):
-            R[i, i] = img.shape[i] / float(shape_r[i])
-        affine_r = np.dot(affine, R)
-
+        shape_r, affine_r, R = get_reference(img, new_size, new_size_type, verbose)
         reference = (shape_r, affine_r)
 
     else:
@@ -88,59 +187,78 @@ def resample_nipy(img, new_size=None, new_size_type=None, img_dest=None, interpo
 
     if img.ndim == 3:
         img_r = n_resample(img, transform=R, reference=reference, mov_voxel_coords=True, ref_voxel_coords=True,
-                           dtype='double', interp_order=dict_interp[interpolation], mode='nearest')
+                           dtype=dtype, interp_order=dict_interp[interpolation], mode='nearest')
 
     elif img.ndim == 4:
         # TODO: Cover img_dest with 4D volumes
         # Import here instead of top of the file because this is an isolated case and nibabel takes time to import
         import nibabel as nib
-        from nipy.io.nifti_ref import nifti2nipy, nipy2nifti
-        data4d = np.zeros(shape_r)
-        # Loop across 4th dimension and resample each 3d volume
-        for it in range(img.shape[3]):
-            # Create dummy 3d nipy image
-            nii_tmp = nib.nifti1.Nifti1Image(img.get_data()[..., it], affine)
-            img3d_r = n_resample(nifti2nipy(nii_tmp), transform=R, reference=(shape_r[:-1], affine_r),
-                                 mov_voxel_coords=True, ref_voxel_coords=True, dtype='double',
-                                 interp_order=dict_interp[interpolation], mode='nearest')
-            data4d[..., it] = img3d_r.get_data()
+        from nipy.io.nifti_ref import nifti2nipy
+        data4d = np.empty(tuple(shape_r[:3]) + (img.shape[3],), dtype=dtype)
+        for t, data_r in iter_resample_4d(img.get_data(), R, shape_r, dict_interp[interpolation], dtype=dtype,
+                                          chunk_size=chunk_size):
+            data4d[..., t:t + data_r.shape[3]] = data_r
         # Create 4d nipy Image
         nii4d = nib.nifti1.Nifti1Image(data4d, affine_r)
         # Convert to nipy object
         img_r = nifti2nipy(nii4d)
 
-    # print "HOLA!!!"
-    # print img.coordmap
-    # print img_r.coordmap
     return img_r
 
 
-def resample_file(fname_data, fname_out, new_size, new_size_type, interpolation, verbose):
+def resample_image(im, new_size, new_size_type, interpolation='linear', verbose=1):
+    """Resample an Image object in memory (same as resample_file, without writing and reading files).
+    :param im: Image.
+    :param new_size: The target size, i.e. 0.25x0.25
+    :param new_size_type: Unit of resample (mm, vox, factor)
+    :param interpolation: The interpolation type
+    :param verbose: verbosity level
+    :return: The resampled Image.
+    """
+    import nibabel as nib
+    from nipy.io.nifti_ref import nifti2nipy, nipy2nifti
+    from spinalcordtoolbox.image import Image
+
+    nii = nib.Nifti1Image(im.data, im.hdr.get_best_affine(), im.hdr)
+    nii_r = nipy2nifti(resample_nipy(nifti2nipy(nii), new_size, new_size_type, img_dest=None,
+                                     interpolation=interpolation, verbose=verbose))
+    return Image(np.asanyarray(nii_r.dataobj), hdr=nii_r.header, dim=nii_r.header.get_data_shape())
+
+
+def resample_file(fname_data, fname_out, new_size, new_size_type, interpolation, verbose, dtype=np.float64):
     """This function will resample the specified input
     image file to the target size.
-    Can deal with 2d, 3d or 4d image objects.
+    Can deal with 2d, 3d or 4d image objects. 4d images are resampled and written by chunks of volumes, so that the
+    whole output is never held in memory.
     :param fname_data: The input image filename.
     :param fname_out: The output image filename.
     :param new_size: The target size, i.e. 0.25x0.25
     :param new_size_type: Unit of resample (mm, vox, factor)
     :param interpolation: The interpolation type
     :param verbose: verbosity level
+    :param dtype: type of the output data
     """
 
     # Load data
     sct.printv('\nLoad data...', verbose)
     nii = nipy.load_image(fname_data)
 
-    nii_r = resample_nipy(nii, new_size, new_size_type, img_dest=None, interpolation=interpolation, verbose=verbose)
-
     # build output file name
     if fname_out == '':
         fname_out = sct.add_suffix(fname_data, '_r')
     else:
         fname_out = fname_out
 
-    # save data
-    nipy.save_image(nii_r, fname_out)
+    if nii.ndim == 4:
+        shape_r, affine_r, R = get_reference(nii, new_size, new_size_type, verbose)
+        chunks = iter_resample_4d(nii.get_data(), R, shape_r, dict_interp[interpolation], dtype=dtype)
+        save_4d_chunks(chunks, fname_out, tuple(shape_r[:3]) + (nii.shape[3],), affine_r, dtype=dtype)
+        nii_r = nipy.load_image(fname_out)
+    else:
+        nii_r = resample_nipy(nii, new_size, new_size_type, img_dest=None, interpolation=interpolation, dtype=dtype,
+                              verbose=verbose)
+        # save data
+        nipy.save_image(nii_r, fname_out)
 
     # to view results
     sct.display_viewer_syntax([fname_out], verbose=verbose)
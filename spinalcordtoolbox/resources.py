@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Split the CPU cores between concurrent jobs, and make each library (ITK, OpenMP, BLAS, TensorFlow) use the number
+# of threads given to the job.
+
+from __future__ import absolute_import, division
+
+import os
+import logging
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+# environment variable holding the number of threads of the current job
+ENV_THREADS = 'SCT_NB_THREADS'
+
+# variables read by the libraries when they start (inherited by the commands run by a job)
+THREAD_ENV_VARS = [
+    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',  # ITK/ANTs (isct_antsRegistration, isct_antsApplyTransforms, ...)
+    'OMP_NUM_THREADS',  # OpenMP (dipy, ...)
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',  # Accelerate (macOS)
+    'NUMEXPR_NUM_THREADS',
+    'TF_NUM_INTRAOP_THREADS',
+]
+
+# functions dominated by multithreaded ITK filters: they scale well with threads, and use a lot of memory, so it is
+# better to run fewer jobs with more threads each
+ITK_HEAVY_FUNCTIONS = [
+    'sct_apply_transfo',
+    'sct_register_multimodal',
+    'sct_register_to_template',
+    'sct_straighten_spinalcord',
+    'sct_warp_template',
+]
+ITK_HEAVY_NB_THREADS = 4
+
+
+def get_budget(nb_cores, function=None, nb_threads=None):
+    """
+    Split cores between concurrent jobs.
+    :param nb_cores: int: number of cores available for the whole batch
+    :param function: str: name of the function run by the jobs, used to choose the number of threads per job if
+      nb_threads is None (ITK_HEAVY_NB_THREADS for ITK_HEAVY_FUNCTIONS, 1 otherwise)
+    :param nb_threads: int: number of threads per job
+    :return: tuple (nb_jobs, nb_threads): number of concurrent jobs, and number of threads per job
+    """
+    nb_cores = max(1, nb_cores)
+    if nb_threads is None:
+        nb_threads = ITK_HEAVY_NB_THREADS if function in ITK_HEAVY_FUNCTIONS else 1
+    nb_threads = max(1, min(nb_threads, nb_cores))
+    return nb_cores // nb_threads, nb_threads
+
+
+def get_thread_env(nb_threads):
+    """
+    :param nb_threads: int: number of threads of the job
+    :return: dict: environment variables limiting the number of threads of each library
+    """
+    env = dict([(var, str(nb_threads)) for var in THREAD_ENV_VARS])
+    env['TF_NUM_INTEROP_THREADS'] = '1'
+    env[ENV_THREADS] = str(nb_threads)
+    return env
+
+
+def get_thread_budget():
+    """
+    :return: int: number of threads of the current job, or None if no budget was set
+    """
+    value = os.environ.get(ENV_THREADS)
+    return int(value) if value else None
+
+
+def get_nb_processes(nb_proc=None):
+    """
+    Number of worker processes of a parallel step (e.g. -j of sct_dmri_compute_dti), within the thread budget of the
+    current job.
+    :param nb_proc: int: number of processes requested. None: default
+    :return: int: nb_proc, capped at the thread budget if one is set. Default: the thread budget, or the number of CPUs
+      if no budget is set.
+    """
+    from multiprocessing import cpu_count
+    nb_threads = get_thread_budget()
+    if nb_proc is None:
+        return nb_threads or cpu_count()
+    if nb_threads is not None and nb_proc > nb_threads:
+        logger.warning('%d processes requested, limited to the thread budget of the job (%d)', nb_proc, nb_threads)
+        return nb_threads
+    return nb_proc
+
+
+def set_thread_budget(nb_threads):
+    """
+    Export the thread budget to the environment (inherited by worker processes and by the commands they run), and
+    apply it to the libraries already loaded in the current process.
+    :param nb_threads: int: number of threads per job
+    """
+    os.environ.update(get_thread_env(nb_threads))
+    limit_threads()
+
+
+def limit_threads():
+    """
+    Apply the thread budget of the current job to the BLAS/OpenMP libraries already loaded in the current process.
+    Environment variables are only read when a library starts, so this matters for the commands run in-process (see
+    sct_utils.run). Requires threadpoolctl, otherwise only the commands run in a subprocess are limited.
+    """
+    nb_threads = get_thread_budget()
+    if nb_threads is None:
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logger.debug('threadpoolctl is not installed: thread budget only applies to new processes')
+        return
+    threadpool_limits(limits=nb_threads)
+
+
+def configure_keras_session():
+    """
+    Apply the thread budget of the current job to the TensorFlow session used by Keras. Nothing is done if no budget
+    was set. Must be called before the models are built.
+    """
+    nb_threads = get_thread_budget()
+    if nb_threads is None:
+        return
+    from keras import backend as K
+    if K.backend() != 'tensorflow':
+        return
+    import tensorflow as tf
+    config = tf.ConfigProto(intra_op_parallelism_threads=nb_threads, inter_op_parallelism_threads=1)
+    K.set_session(tf.Session(config=config))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Run voxelwise computations inside a padded bounding box around the spinal cord, and paste the results back into the
+# native grid.
+
+from __future__ import absolute_import, division
+
+import numpy as np
+
+import spinalcordtoolbox.image as msct_image
+
+
+def get_bounding_box(mask, pad=0):
+    """
+    :param mask: ndarray: 3d mask (non-zero values are inside the mask)
+    :param pad: int or list of int: number of voxels added on each side of the bounding box, for each axis (clipped to
+      the volume)
+    :return: tuple of slices, or None if the mask is empty
+    """
+    indices = np.nonzero(mask)
+    if len(indices[0]) == 0:
+        return None
+    if np.isscalar(pad):
+        pad = [pad] * len(indices)
+    return tuple([slice(max(0, int(np.min(idx)) - p), min(n, int(np.max(idx)) + p + 1))
+                  for idx, n, p in zip(indices, mask.shape, pad)])
+
+
+def crop_image(im, bbox):
+    """
+    Crop the first three dimensions of an image to a bounding box, updating the header so that the physical position
+    of the voxels is not changed.
+    :param im: Image
+    :param bbox: tuple of 3 slices, as returned by get_bounding_box()
+    :return: cropped Image (its data is a view on the input data)
+    """
+    return msct_image.spatial_crop(im, dict([(dim, (s.start, s.stop - 1)) for dim, s in enumerate(bbox)]))
+
+
+def paste_image(im_roi, im_ref, bbox, fill_value=0):
+    """
+    Paste an image computed inside a bounding box back into the native grid.
+    :param im_roi: Image defined on the cropped grid (can have more than three dimensions)
+    :param im_ref: Image defined on the native grid: its header is used for the output
+    :param bbox: tuple of 3 slices that was used for cropping
+    :param fill_value: value of the voxels outside of the bounding box
+    :return: Image on the native grid, with the data type of im_roi
+    """
+    data = np.full(im_ref.data.shape[:3] + im_roi.data.shape[3:], fill_value, dtype=im_roi.data.dtype)
+    data[bbox] = im_roi.data
+    hdr = im_ref.hdr.copy()
+    hdr.set_data_shape(data.shape)
+    hdr.set_data_dtype(data.dtype)
+    return msct_image.Image(data, hdr=hdr)
+
+
+def run_in_roi(function, images, im_roi, pad=0, fill_value=0):
+    """
+    Crop all input images to the padded bounding box of a region of interest (e.g. spinal cord segmentation or
+    centerline), run a computation on the cropped images, and paste the resulting image(s) back into the native grid.
+
+    Example:
+
+    .. code:: python
+
+       im_fa = run_in_roi(lambda im_dwi, im_seg: compute_fa(im_dwi, im_seg), [im_dwi, im_seg], im_seg, pad=5)
+
+    :param function: callable taking the cropped Images as positional arguments, and returning an Image or a list of
+      Images defined on the cropped grid
+    :param images: list of Images, all defined on the same grid as im_roi (they can have more than three dimensions)
+    :param im_roi: Image: region of interest. Non-zero voxels define the bounding box.
+    :param pad: int or list of int: number of voxels added on each side of the bounding box. For a centerline, the
+      padding should cover the cord and its surroundings.
+    :param fill_value: value of the output voxels outside of the bounding box
+    :return: Image or list of Images (same as function), on the native grid
+    """
+    for im in images:
+        if im.data.shape[:3] != im_roi.data.shape[:3]:
+            raise ValueError("Image {} does not have the same grid as the region of interest: {} != {}"
+                             .format(im.absolutepath, im.data.shape[:3], im_roi.data.shape[:3]))
+
+    bbox = get_bounding_box(im_roi.data[..., 0] if im_roi.data.ndim > 3 else im_roi.data, pad=pad)
+    if bbox is None:
+        raise ValueError("The region of interest is empty.")
+
+    im_ref = images[0] if images else im_roi
+    result = function(*[crop_image(im, bbox) for im in images])
+    if isinstance(result, (list, tuple)):
+        return [paste_image(im, im_ref, bbox, fill_value=fill_value) for im in result]
+    return paste_image(result, im_ref, bbox, fill_value=fill_value)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Run a list of jobs on a pool executor, recording the status, duration and result of each job in a persistent table
+# so that an interrupted run can be resumed.
+
+from __future__ import absolute_import, division
+
+import os
+import json
+import time
+import logging
+import concurrent.futures
+import concurrent.futures.process
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+# exception raised for all the pending futures when a worker process dies (e.g. killed by the OOM killer)
+BrokenExecutor = getattr(concurrent.futures, 'BrokenExecutor',
+                         getattr(concurrent.futures.process, 'BrokenProcessPool', RuntimeError))
+
+
+class JobTable(object):
+    """
+    Table of the jobs that were run, stored as a JSON-lines file: each line is the record of one attempt, with fields:
+
+    - job: list: arguments of the job
+    - status: 'done' or 'failed'
+    - attempt: int: attempt number (starting at 1) within the run
+    - duration: float: duration of the job in s (None if the job did not return)
+    - result: serialized result (None if the job did not return)
+    - error: str: exception raised by the job, if any
+    - date: str
+
+    Records are written as soon as a job completes, so a crash only loses the running jobs.
+    """
+
+    def __init__(self, fname=None):
+        """
+        :param fname: str: file of the table. If None, the table is only kept in memory.
+        """
+        self.fname = fname
+        self.records = {}
+        if fname is not None and os.path.isfile(fname):
+            self.load()
+
+    @staticmethod
+    def get_key(job):
+        return json.dumps(list(job))
+
+    def load(self):
+        with open(self.fname, 'r') as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # e.g. run killed while writing the record: the job will be run again
+                    logger.warning('Skip corrupted line %d of %s', i + 1, self.fname)
+                    continue
+                self.records.setdefault(self.get_key(record['job']), []).append(record)
+
+    def add(self, job, status, attempt, duration=None, result=None, error=None):
+        """
+        Record an attempt of a job.
+        """
+        record = {
+            'job': list(job),
+            'status': status,
+            'attempt': attempt,
+            'duration': duration,
+            'result': result,
+            'error': error,
+            'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.records.setdefault(self.get_key(job), []).append(record)
+        if self.fname is not None:
+            with open(self.fname, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        return record
+
+    def get_last(self, job):
+        """
+        :return: dict: last record of the job, or None if the job was never run
+        """
+        records = self.records.get(self.get_key(job))
+        return records[-1] if records else None
+
+    def is_done(self, job):
+        record = self.get_last(job)
+        return record is not None and record['status'] == 'done'
+
+    def get_durations(self):
+        """
+        :return: dict: last known duration of each job, indexed by job key
+        """
+        durations = {}
+        for key, records in self.records.items():
+            list_duration = [r['duration'] for r in records if r['duration'] is not None]
+            if list_duration:
+                durations[key] = list_duration[-1]
+        return durations
+
+    def estimate_durations(self, jobs, group_key=None):
+        """
+        Expected duration of each job: its own previous duration if any (e.g. failed or interrupted run), otherwise
+        the mean duration of the recorded jobs of the same group (e.g. the same subject processed with other
+        parameters), otherwise the mean of all recorded durations.
+        :param jobs: list of jobs
+        :param group_key: int: index of the job field that defines the group. None: no group.
+        :return: list of float (0 if nothing is recorded)
+        """
+        durations = self.get_durations()
+        if not durations:
+            return [0.] * len(jobs)
+        mean_all = sum(durations.values()) / len(durations)
+        durations_group = {}
+        if group_key is not None:
+            for key, duration in durations.items():
+                durations_group.setdefault(json.loads(key)[group_key], []).append(duration)
+        list_estimate = []
+        for job in jobs:
+            key = self.get_key(job)
+            if key in durations:
+                list_estimate.append(durations[key])
+            elif group_key is not None and job[group_key] in durations_group:
+                list_estimate.append(sum(durations_group[job[group_key]]) / len(durations_group[job[group_key]]))
+            else:
+                list_estimate.append(mean_all)
+        return list_estimate
+
+
+def _run_job(function, job):
+    """Run a job and measure its duration in the worker (excluding the time spent in the queue)."""
+    start = time.time()
+    result = function(job)
+    return result, time.time() - start
+
+
+def run_jobs(function, jobs, executor_factory, job_table=None, max_retries=1, backoff=10., is_failed=None,
+             serialize=None, deserialize=None, group_key=None, callback=None):
+    """
+    Run jobs on a pool executor, skipping the jobs that are already done in the job table.
+
+    - Jobs are submitted by decreasing expected duration (see JobTable.estimate_durations), so that long jobs do not
+      end up running alone at the end of the batch.
+    - Failed jobs (exception, or result for which is_failed returns True) are submitted again after a delay of
+      backoff * 2^(attempt - 1) seconds, up to max_retries times.
+    - If a worker process dies, the executor is replaced by a new one.
+
+    :param function: callable taking a job as single argument. Must be picklable (defined at the module level).
+    :param jobs: list of tuples: arguments of each job. Items must be JSON serializable.
+    :param executor_factory: callable returning a new concurrent.futures executor
+    :param job_table: JobTable. Default: in-memory table.
+    :param max_retries: int: maximum number of retries of a failed job
+    :param backoff: float: delay before the first retry, in s
+    :param is_failed: callable taking a result and returning True if the job failed
+    :param serialize: callable converting a result to a JSON serializable object, to store it in the table
+    :param deserialize: callable converting a stored result back
+    :param group_key: int: see JobTable.estimate_durations
+    :param callback: callable(job, result, record) called in the current process when a job is finished (done, or
+      failed after the last retry)
+    :return: list of results, in the order of jobs (None for jobs that did not return)
+    """
+    if job_table is None:
+        job_table = JobTable()
+    serialize = serialize or (lambda x: x)
+    deserialize = deserialize or (lambda x: x)
+
+    results = [None] * len(jobs)
+    list_index = []
+    for i, job in enumerate(jobs):
+        if job_table.is_done(job):
+            record = job_table.get_last(job)
+            if record['result'] is not None:
+                results[i] = deserialize(record['result'])
+        else:
+            list_index.append(i)
+    if len(list_index) < len(jobs):
+        logger.info('Resume: %d job(s) already done, %d job(s) to run', len(jobs) - len(list_index), len(list_index))
+    if not list_index:
+        return results
+
+    estimates = job_table.estimate_durations([jobs[i] for i in list_index], group_key=group_key)
+    list_index = [i for _, i in sorted(zip(estimates, list_index), key=lambda x: -x[0])]
+
+    attempts = dict([(i, 0) for i in list_index])
+    futures = {}
+    waiting = []  # list of (time at which the job can be submitted again, job index)
+    executor = executor_factory()
+    try:
+        for i in list_index:
+            futures[executor.submit(_run_job, function, jobs[i])] = (i, executor)
+
+        while futures or waiting:
+            now = time.time()
+            for ready, i in sorted(waiting):
+                if ready <= now:
+                    waiting.remove((ready, i))
+                    futures[executor.submit(_run_job, function, jobs[i])] = (i, executor)
+            timeout = max(0, min([ready for ready, _ in waiting]) - now) if waiting else None
+            if not futures:
+                time.sleep(timeout)
+                continue
+
+            done, _ = concurrent.futures.wait(list(futures), timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i, executor_job = futures.pop(future)
+                attempts[i] += 1
+                result, duration, error = None, None, None
+                try:
+                    result, duration = future.result()
+                except Exception as e:
+                    error = '{}: {}'.format(type(e).__name__, e)
+                    logger.error('Job %s failed (attempt %d): %s', jobs[i], attempts[i], error)
+                    if isinstance(e, BrokenExecutor) and executor_job is executor:
+                        logger.warning('Restarting the pool of workers')
+                        executor.shutdown(wait=False)
+                        executor = executor_factory()
+                failed = error is not None or (is_failed is not None and is_failed(result))
+                record = job_table.add(jobs[i], 'failed' if failed else 'done', attempts[i], duration=duration,
+                                       result=serialize(result) if result is not None else None, error=error)
+                if failed and attempts[i] <= max_retries:
+                    waiting.append((time.time() + backoff * 2 ** (attempts[i] - 1), i))
+                    continue
+                results[i] = result
+                if callback is not None:
+                    callback(jobs[i], result, record)
+    except BaseException:
+        # e.g. KeyboardInterrupt: finished jobs are in the table, cancel the others
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+    return results
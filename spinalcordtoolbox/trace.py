@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Record the duration of the processing stages of a run (nested stages, commands run by sct_utils.run, image I/O) and
+# export them as a Chrome trace (JSON file that can be opened with chrome://tracing or https://ui.perfetto.dev).
+#
+# Tracing is enabled by setting the environment variable SCT_TRACE to a folder: each process then writes its trace to
+# that folder when it exits. When it is not set, stages only cost a lookup in os.environ.
+#
+# This module must not import sct_utils (sct_utils uses it).
+
+from __future__ import absolute_import, division
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+import functools
+import contextlib
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+ENV_TRACE = 'SCT_TRACE'
+
+_events = []
+_bytes = {'read': 0, 'written': 0}
+_start_time = time.time()
+
+
+def is_enabled():
+    """
+    :return: bool: True if stages are recorded (environment variable SCT_TRACE is set)
+    """
+    return bool(os.environ.get(ENV_TRACE))
+
+
+def _get_command():
+    """Name of the current command (e.g. sct_propseg), used to name the process in the trace."""
+    if sys.argv and sys.argv[0]:
+        return os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    return 'python'
+
+
+def add_event(name, start, duration, category='stage', args=None):
+    """
+    Record a complete event.
+    :param name: str
+    :param start: float: start time, as returned by time.time()
+    :param duration: float: duration in s
+    :param category: str: e.g. 'stage', 'io', 'run'
+    :param args: dict: JSON serializable values displayed with the event
+    """
+    if not is_enabled():
+        return
+    _events.append({
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': int(duration * 1e6),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': args or {},
+    })
+
+
+def add_bytes(read=0, written=0):
+    """
+    Count bytes read/written by the current process. The totals are displayed as a counter in the trace.
+    :param read: int
+    :param written: int
+    """
+    if not is_enabled():
+        return
+    _bytes['read'] += read
+    _bytes['written'] += written
+    _events.append({
+        'name': 'io',
+        'ph': 'C',
+        'ts': int(time.time() * 1e6),
+        'pid': os.getpid(),
+        'args': {'bytes_read': _bytes['read'], 'bytes_written': _bytes['written']},
+    })
+
+
+@contextlib.contextmanager
+def stage(name, category='stage', **kwargs):
+    """
+    Record the duration of the enclosed block. Stages can be nested.
+
+    Example::
+
+        with trace.stage('compute warping field', nz=nz) as args:
+            ...
+            if args is not None:
+                args['nb_points'] = nb_points
+
+    :param name: str
+    :param category: str
+    :param kwargs: values displayed with the event
+    :return: dict of the values displayed with the event, which can be completed in the block. None if tracing is
+      disabled.
+    """
+    if not is_enabled():
+        yield None
+        return
+    args = dict(kwargs)
+    start = time.time()
+    try:
+        yield args
+    finally:
+        add_event(name, start, time.time() - start, category=category, args=args)
+
+
+def traced(name=None, category='stage'):
+    """
+    Decorator recording each call of a function as a stage.
+    :param name: str: name of the stage. Default: name of the function.
+    :param category: str
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__, category=category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    """
+    Discard the recorded events and restart the process clock (e.g. in a worker process that runs several jobs).
+    """
+    global _start_time
+    del _events[:]
+    _bytes['read'] = _bytes['written'] = 0
+    _start_time = time.time()
+
+
+def get_trace():
+    """
+    :return: dict: trace of the current process in the Chrome trace format. It includes one event covering the whole
+      process, with the CPU time and the bytes read/written.
+    """
+    pid = os.getpid()
+    command = _get_command()
+    times = os.times()
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': '{} ({})'.format(command, pid)}},
+        {
+            'name': command,
+            'cat': 'process',
+            'ph': 'X',
+            'ts': int(_start_time * 1e6),
+            'dur': int((time.time() - _start_time) * 1e6),
+            'pid': pid,
+            'tid': threading.current_thread().ident,
+            'args': {
+                'argv': sys.argv[1:],
+                'cpu_time': times[0] + times[1],
+                'bytes_read': _bytes['read'],
+                'bytes_written': _bytes['written'],
+            },
+        },
+    ]
+    return {
+        'traceEvents': events + list(_events),
+        'displayTimeUnit': 'ms',
+        'otherData': {'command': command, 'pid': pid},
+    }
+
+
+def export(fname=None):
+    """
+    Write the trace of the current process.
+    :param fname: str: output file. Default: <SCT_TRACE>/trace_<command>_<pid>.json
+    :return: str: output file, or None if tracing is disabled and no file was given
+    """
+    if fname is None:
+        if not is_enabled():
+            return None
+        fname = os.path.join(os.environ[ENV_TRACE], 'trace_{}_{}.json'.format(_get_command(), os.getpid()))
+    folder = os.path.dirname(os.path.abspath(fname))
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+    with open(fname, 'w') as f:
+        json.dump(get_trace(), f)
+    logger.debug('Trace written to %s', fname)
+    return fname
+
+
+def _export_at_exit():
+    try:
+        export()
+    except Exception as e:
+        # never make a run fail because of the trace
+        logger.warning('Could not write the trace: %s', e)
+
+
+atexit.register(_export_at_exit)
+
+
+def merge_traces(groups, fname_out):
+    """
+    Merge the traces of several processes into a single trace, with one row per group (e.g. per subject of a batch):
+    the processes of a group are displayed as threads of the same row.
+    :param groups: list of tuples (name, list of trace files)
+    :param fname_out: str: output file
+    :return: dict: merged trace
+    """
+    events = []
+    for i_group, (name, list_fname) in enumerate(groups):
+        pid = i_group + 1
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}})
+        events.append({'name': 'process_sort_index', 'ph': 'M', 'pid': pid, 'args': {'sort_index': i_group}})
+        for fname in list_fname:
+            try:
+                with open(fname, 'r') as f:
+                    trace = json.load(f)
+            except ValueError:
+                logger.warning('Skip corrupted trace %s', fname)
+                continue
+            for event in trace['traceEvents']:
+                event = dict(event)
+                tid = event['pid']
+                if event['ph'] == 'M':
+                    if event['name'] != 'process_name':
+                        continue
+                    event['name'] = 'thread_name'
+                elif event['ph'] == 'C':
+                    event['name'] = '{} {}'.format(event['name'], tid)
+                event['pid'], event['tid'] = pid, tid
+                events.append(event)
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    with open(fname_out, 'w') as f:
+        json.dump(trace, f)
+    return trace
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Apply an ITK/ANTs warping field to several images in a single in-process pass: the sampling coordinates (position in
+# the source image of each voxel of the destination image) are computed once from the warping field, and reused for all
+# the images that share the same grid (e.g. the template and atlas files of PAM50).
+
+from __future__ import absolute_import, division
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from spinalcordtoolbox.image import Image
+
+logger = logging.getLogger("sct.{}".format(__file__))
+
+# spline order of scipy.ndimage for each ANTs interpolation
+DICT_ORDER = {'NearestNeighbor': 0, 'Linear': 1, 'BSpline': 3}
+
+# ANTs interpolation of each SCT interpolation (see sct_utils.get_interpolation())
+DICT_INTERP_ANTS = {'nn': 'NearestNeighbor', 'linear': 'Linear', 'spline': 'BSpline'}
+
+
+def is_displacement_field(im):
+    """
+    :param im: Image
+    :return: bool: True if the image is a 3d ITK displacement field (5d image with 3 vector components)
+    """
+    return im.data.ndim == 5 and im.data.shape[3] == 1 and im.data.shape[4] == 3
+
+
+def get_sampling_coordinates(im_warp, shape_dest, affine_dest, affine_src):
+    """
+    Compute the position in the source image of each voxel of the destination image, as done by
+    isct_antsApplyTransforms: the destination voxel is moved by the displacement of the warping field at its physical
+    position (zero outside of the field).
+    :param im_warp: Image: ITK displacement field (see is_displacement_field()), in LPS coordinates
+    :param shape_dest: (nx, ny, nz) shape of the destination grid
+    :param affine_dest: 4x4 voxel-to-physical matrix of the destination grid
+    :param affine_src: 4x4 voxel-to-physical matrix of the source grid
+    :return: float ndarray of shape (3, nx, ny, nz): voxel coordinates in the source grid
+    """
+    shape_dest = tuple(shape_dest[:3])
+    indexes = np.indices(shape_dest, dtype=np.float64).reshape(3, -1)
+    physical = np.dot(affine_dest[:3, :3], indexes) + affine_dest[:3, 3:]
+    del indexes
+
+    data_warp = im_warp.data.reshape(im_warp.data.shape[:3] + (3,))
+    affine_warp = im_warp.hdr.get_best_affine()
+    if data_warp.shape[:3] == shape_dest and np.allclose(affine_warp, affine_dest):
+        # the warping field is defined on the destination grid (usual case): no need to interpolate it
+        displacement = data_warp.reshape(-1, 3).T.astype(np.float64)
+    else:
+        m_p2f = np.linalg.inv(affine_warp)
+        indexes_warp = np.dot(m_p2f[:3, :3], physical) + m_p2f[:3, 3:]
+        displacement = np.array([map_coordinates(data_warp[..., i], indexes_warp, order=1, mode='constant', cval=0.)
+                                 for i in range(3)])
+        del indexes_warp
+    # ITK displacements are expressed in LPS, while our physical coordinates are in RAS
+    displacement[0:2] *= -1
+    physical += displacement
+    del displacement
+
+    m_p2f = np.linalg.inv(affine_src)
+    coordinates = np.dot(m_p2f[:3, :3], physical) + m_p2f[:3, 3:]
+    return coordinates.reshape((3,) + shape_dest)
+
+
+def warp_images(list_fname_src, list_fname_out, list_interp, fname_dest, im_warp, nb_workers=4, verbose=1):
+    """
+    Warp several images to a destination image with the same warping field (equivalent to one call of
+    isct_antsApplyTransforms per image). Sampling coordinates are computed once per source grid, images are read ahead
+    and written by a pool of threads while the next image is interpolated.
+    :param list_fname_src: list of str: images to warp
+    :param list_fname_out: list of str: output images (same order)
+    :param list_interp: list of str: interpolation of each image, see DICT_ORDER
+    :param fname_dest: str: destination image
+    :param im_warp: Image: ITK displacement field, from the destination to the source space
+    :param nb_workers: int: number of threads reading and writing the images
+    :param verbose:
+    :return: list of str: output images
+    """
+    im_dest = Image(fname_dest)
+    shape_dest = im_dest.data.shape[:3]
+    affine_dest = im_dest.hdr.get_best_affine()
+    hdr_out = im_dest.hdr.copy()
+    hdr_out.set_data_dtype(np.float32)
+    del im_dest
+
+    if not is_displacement_field(im_warp):
+        raise ValueError('{} is not a displacement field'.format(im_warp.absolutepath))
+
+    # sampling coordinates, for each source grid
+    dict_coordinates = {}
+    pool = ThreadPool(nb_workers)
+    try:
+        results = []
+        for im_src, fname_out, interp in zip(pool.imap(Image, list_fname_src), list_fname_out, list_interp):
+            affine_src = im_src.hdr.get_best_affine()
+            key = (im_src.data.shape[:3], affine_src.round(6).tobytes())
+            if key not in dict_coordinates:
+                logger.debug('Compute sampling coordinates for source grid %s', im_src.data.shape[:3])
+                dict_coordinates[key] = get_sampling_coordinates(im_warp, shape_dest, affine_dest, affine_src)
+            data_out = map_coordinates(im_src.data, dict_coordinates[key], order=DICT_ORDER[interp], mode='constant',
+                                       cval=0., output=np.float32)
+            im_out = Image(data_out, hdr=hdr_out.copy())
+            results.append(pool.apply_async(im_out.save, (fname_out,), {'verbose': verbose}))
+        for result in results:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+    return list(list_fname_out)
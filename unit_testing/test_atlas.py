@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.atlas
+
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import atlas as atlas_module
+from spinalcordtoolbox.atlas import PackedAtlas, load_atlas, pack_atlas
+from spinalcordtoolbox import aggregate_slicewise
+from spinalcordtoolbox.aggregate_slicewise import Metric, LabelStruc
+
+
+@pytest.fixture(scope="module")
+def dummy_atlas():
+    """Three labels with partial volume, within a disk of each slice. Label weights sum to 1 within the disk."""
+    nx, ny, nz = 12, 10, 6
+    xx, yy = np.mgrid[:nx, :ny]
+    disk = ((xx - 6) ** 2 + (yy - 5) ** 2) < 12
+    rs = np.random.RandomState(0)
+    weights = rs.dirichlet([1, 1, 1], size=(nx, ny, nz)) * disk[..., None, None]
+    # round the weights to float16, as stored in the packed atlas
+    return weights.astype(np.float16).astype(np.float64)
+
+
+def test_pack(dummy_atlas, tmpdir):
+    atlas = PackedAtlas.from_arrays([dummy_atlas[..., i] for i in range(3)])
+    assert atlas.shape == (12, 10, 6)
+    assert atlas.nb_labels == 3
+    assert len(atlas.voxels) == np.count_nonzero(dummy_atlas[..., 0])
+    assert np.array_equal(atlas.to_dense(), dummy_atlas.astype(np.float32))
+    fname = str(tmpdir.join('atlas.npz'))
+    atlas.save(fname, ['a.nii.gz', 'b.nii.gz', 'c.nii.gz'])
+    atlas_loaded, list_fname = PackedAtlas.load(fname)
+    assert list_fname == ['a.nii.gz', 'b.nii.gz', 'c.nii.gz']
+    assert atlas_loaded.orientation == 'RPI'
+    assert np.array_equal(atlas_loaded.to_dense(), atlas.to_dense())
+
+
+def test_save_error(dummy_atlas, tmpdir, monkeypatch):
+    """A failed write leaves neither the packed atlas nor its temporary file"""
+    def savez(*args, **kwargs):
+        raise IOError('No space left on device')
+    monkeypatch.setattr(atlas_module.np, 'savez', savez)
+    with pytest.raises(IOError):
+        PackedAtlas.from_arrays([dummy_atlas[..., i] for i in range(3)]).save(str(tmpdir.join('atlas.npz')))
+    assert tmpdir.listdir() == []
+
+
+def test_load_atlas(dummy_atlas, tmpdir):
+    list_fname = ['label_{}.nii.gz'.format(i) for i in range(3)]
+    affine_rpi = np.diag([-1, 1, 1, 1])
+    for i, fname in enumerate(list_fname):
+        data = dummy_atlas[..., i].astype(np.float32)
+        Image(data, hdr=nib.Nifti1Image(data, affine_rpi).header).save(str(tmpdir.join(fname)), verbose=0)
+    path_label = str(tmpdir)
+    fname_packed = os.path.join(path_label, atlas_module.PACKED_ATLAS_FILE)
+    # the atlas folder is input data: loading the labels does not write in it
+    atlas = load_atlas(path_label, list_fname)
+    assert np.allclose(atlas.to_dense(), dummy_atlas)
+    assert not os.path.exists(fname_packed)
+    # the packed atlas is only written on request, and then used by the next loads
+    atlas_packed = pack_atlas(path_label, list_fname)
+    assert sorted(os.listdir(path_label)) == sorted(list_fname + [atlas_module.PACKED_ATLAS_FILE])
+    assert np.array_equal(load_atlas(path_label, list_fname).to_dense(), atlas_packed.to_dense())
+    # a packed atlas of other label files is ignored
+    assert np.allclose(load_atlas(path_label, list_fname[:2]).to_dense(), dummy_atlas[..., :2])
+
+
+def test_get_samples(dummy_atlas):
+    atlas = PackedAtlas.from_arrays([dummy_atlas[..., i] for i in range(3)])
+    data = np.random.RandomState(1).rand(12, 10, 6)
+    values, weights = atlas.get_samples(data, [4, 1])
+    inside = dummy_atlas[..., 0] != 0
+    assert np.allclose(np.sort(values), np.sort(np.concatenate([data[..., 4][inside[..., 4]],
+                                                                data[..., 1][inside[..., 1]]])))
+    assert weights.shape == (len(values), 3)
+    assert np.allclose(weights.sum(axis=1), 1, atol=1e-2)
+
+
+@pytest.mark.parametrize('method', ['wa', 'bin', 'ml', 'map', 'max'])
+def test_extract_metric_packed(dummy_atlas, method):
+    """The packed atlas gives the same results as the dense labels"""
+    data = Metric(data=np.random.RandomState(2).rand(12, 10, 6) * 10)
+    data.data[6, 5, 2] = np.nan
+    label_struc = {0: LabelStruc(id=0, name='label_0', map_cluster=0),
+                   1: LabelStruc(id=1, name='label_1', map_cluster=1),
+                   2: LabelStruc(id=2, name='label_2', map_cluster=1),
+                   3: LabelStruc(id=[0, 1], name='combined', map_cluster=0)}
+    atlas = PackedAtlas.from_arrays([dummy_atlas[..., i] for i in range(3)])
+    for id_label in [0, 3]:
+        kwargs = dict(slices=[1, 2, 4], levels=None, perslice=False, perlevel=False, method=method,
+                      label_struc=label_struc, id_label=id_label, indiv_labels_ids=[0, 1, 2])
+        agg_dense = aggregate_slicewise.extract_metric(Metric(data=data.data.copy()), labels=dummy_atlas, **kwargs)
+        agg_packed = aggregate_slicewise.extract_metric(Metric(data=data.data.copy()), labels=atlas, **kwargs)
+        assert sorted(agg_dense[(1, 2, 4)].keys()) == sorted(agg_packed[(1, 2, 4)].keys())
+        for key, value in agg_dense[(1, 2, 4)].items():
+            assert agg_packed[(1, 2, 4)][key] == pytest.approx(value, rel=1e-5)
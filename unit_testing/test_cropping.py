@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.cropping
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import cropping
+
+
+@pytest.fixture()
+def image():
+    affine = np.array([[0.5, 0, 0, -10], [0, 0.5, 0, 5], [0, 0, 2., 30], [0, 0, 0, 1]])
+    data = np.random.RandomState(0).rand(20, 22, 10)
+    return Image(data, hdr=nib.Nifti1Image(data, affine).header)
+
+
+def test_get_bbox_from_index():
+    shape = (20, 22, 10)
+    assert cropping.get_bbox_from_index(shape, [2], [5], [1]) == (slice(0, 20), slice(2, 6), slice(0, 10))
+    # fractions of the size, last slice (0) and last slice - value (<0)
+    assert cropping.get_bbox_from_index(shape, [0.25, 0], [0.5, 0], [0, 2]) == \
+        (slice(5, 11), slice(0, 22), slice(0, 10))
+    assert cropping.get_bbox_from_index(shape, [1], [-2], [2]) == (slice(0, 20), slice(0, 22), slice(1, 8))
+    # without -dim, the slices are along the second dimension
+    assert cropping.get_bbox_from_index(shape, [5], [8]) == (slice(0, 20), slice(5, 9), slice(0, 10))
+    with pytest.raises(ValueError):
+        cropping.get_bbox_from_index(shape, [5], [30], [1])
+    with pytest.raises(ValueError):
+        cropping.get_bbox_from_index(shape, [5, 2], [8], [1])
+
+
+def test_get_bbox_from_mask():
+    mask = np.zeros((10, 10, 10))
+    mask[2:4, 5, 6:9] = 1
+    assert cropping.get_bbox_from_mask(mask, [1, 0, 2]) == (slice(1, 5), slice(5, 6), slice(4, 10))
+    assert cropping.get_bbox_from_max(mask, [2]) == (slice(0, 10), slice(0, 10), slice(6, 9))
+    with pytest.raises(ValueError):
+        cropping.get_bbox_from_mask(np.zeros((3, 3, 3)))
+
+
+def test_get_bbox_from_ref(image):
+    # reference covering voxels [4, 9] x [0, 21] x [3, 12] of the image (partly outside of the image along z)
+    affine_ref = image.hdr.get_best_affine().dot(np.array([[2, 0, 0, 4], [0, 1, 0, -5], [0, 0, 1, 3], [0, 0, 0, 1]]))
+    hdr_ref = nib.Nifti1Image(np.zeros((3, 30, 10, 1, 3), dtype=np.float32), affine_ref).header
+    assert cropping.get_bbox_from_ref(image, hdr_ref) == (slice(4, 9), slice(0, 22), slice(3, 10))
+
+
+def test_crop_image(image):
+    bbox = (slice(2, 6), slice(0, 22), slice(3, 10))
+    im_crop = cropping.crop_image(image, bbox)
+    assert im_crop.data.shape == (4, 22, 7)
+    assert np.array_equal(im_crop.data, image.data[bbox])
+    assert not np.shares_memory(im_crop.data, image.data)
+    # the physical position of the voxels does not change
+    assert np.allclose(im_crop.hdr.get_best_affine().dot([0, 0, 0, 1]),
+                       image.hdr.get_best_affine().dot([2, 0, 3, 1]))
+    assert np.shares_memory(cropping.crop_image(image, bbox, copy=False).data, image.data)
+
+    im_bg = cropping.crop_image(image, bbox, background=-1)
+    assert im_bg.data.shape == image.data.shape
+    assert np.array_equal(im_bg.data[bbox], image.data[bbox])
+    assert np.all(im_bg.data[:2] == -1)
@@ -79,6 +79,30 @@ class TestCore(object):
         pad_image = cropped_region.pad(cropped_img)
         assert pad_image.shape == (203, 202)
 
+    def test_crop_slices(self):
+        """Test the cropping of all slices, which must match crop_center."""
+        dummy_volume = np.random.rand(203, 202, 3)
+        starts = gm_core.get_crop_starts(dummy_volume.shape, (200, 200))
+        cropped = gm_core.crop_slices(dummy_volume, starts, (200, 200))
+        assert cropped.shape == (3, 200, 200)
+        cropped_img, cropped_region = gm_core.crop_center(dummy_volume[..., 1], 200, 200)
+        assert np.array_equal(cropped[1], cropped_img)
+        preds = (cropped > 0.5).astype(np.uint8)
+        volume = gm_core.uncrop_slices(preds, starts, dummy_volume.shape)
+        assert volume.shape == (203, 202, 3)
+        assert np.array_equal(volume[..., 1], cropped_region.pad(preds[1]))
+
+    def test_crop_starts_mask(self):
+        """Test the crops centered on the cord mask, within the slices."""
+        mask = np.zeros((400, 400, 3))
+        mask[140:151, 200:211, 0] = 1
+        mask[389:400, 300:311, 2] = 1
+        starts = gm_core.get_crop_starts(mask.shape, (200, 200), mask)
+        assert starts[0].tolist() == [45, 105]
+        # slices without mask are interpolated, and crops are clipped
+        assert starts[1].tolist() == [170, 155]
+        assert starts[2].tolist() == [200, 200]
+
     def test_thresholding(self):
         """Test thresholding with above and below use cases."""
         dummy_preds = np.full((200, 200), 0.9)
@@ -48,3 +48,36 @@ def test_intensity_normalization():
     assert data_out.dtype == np.float32
     assert np.min(data_out) >= min_out
     assert np.max(data_out) <= max_out
+
+
+def test_get_patch_starts():
+    assert deepseg_lesion.get_patch_starts(30, 48, 24) == [0]
+    assert deepseg_lesion.get_patch_starts(96, 48, 24) == [0, 24, 48]
+    # the last patch ends at the last slice
+    assert deepseg_lesion.get_patch_starts(100, 48, 24) == [0, 24, 48, 52]
+
+
+class DummyModel(object):
+    """Model predicting the (normalized) input, recording the size of each batch"""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, x, batch_size=32):
+        self.batch_sizes.append(len(x))
+        return x
+
+
+def test_predict_patches():
+    data = np.zeros((8, 8, 100))
+    data[2:4, 2:4, 30:40] = 1.
+    model = DummyModel()
+    proba = deepseg_lesion.predict_patches(model, data, 48, 24, 0., 1.)
+    assert proba.shape == data.shape
+    # all the patches are predicted at once, empty patches are skipped
+    assert model.batch_sizes == [2]
+    assert np.allclose(proba, data)
+
+    proba = deepseg_lesion.predict_patches(model, data[:, :, :20], 48, 24, 0., 1.)
+    assert proba.shape == (8, 8, 20)
+    assert not np.any(proba)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.denoise
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+from dipy.denoise.nlmeans import nlmeans
+
+from spinalcordtoolbox import denoise
+
+
+@pytest.fixture(scope="session")
+def noisy_data():
+    """Create a random 3d volume."""
+    np.random.seed(0)
+    return np.random.rand(12, 14, 20) * 100
+
+
+def test_get_slabs():
+    slabs = denoise.get_slabs(10, 3, 2)
+    assert slabs == [(0, 5, 0, 3), (1, 9, 3, 7), (5, 10, 7, 10)]
+    # more slabs than slices
+    assert len(denoise.get_slabs(2, 5, 1)) == 2
+
+
+@pytest.mark.parametrize('nb_proc,nb_slabs', [(1, 3), (2, None), (2, 20)])
+def test_nlmeans_blockwise(noisy_data, nb_proc, nb_slabs):
+    """Slab-based denoising should give the same result as denoising the whole volume."""
+    data_ref = nlmeans(noisy_data, 10., patch_radius=1, block_radius=2)
+    data_den = denoise.nlmeans_blockwise(noisy_data, 10., patch_radius=1, block_radius=2, nb_proc=nb_proc,
+                                         nb_slabs=nb_slabs)
+    assert np.allclose(data_den, data_ref)
+
+
+def test_nlmeans_blockwise_roi(noisy_data):
+    """Only the bounding box of the ROI should be denoised."""
+    roi = np.zeros(noisy_data.shape)
+    roi[4:8, 5:9, 8:12] = 1
+    data_ref = nlmeans(noisy_data, 10., patch_radius=1, block_radius=2)
+    data_den = denoise.nlmeans_blockwise(noisy_data, 10., patch_radius=1, block_radius=2, roi=roi)
+    assert np.allclose(data_den[4:8, 5:9, 8:12], data_ref[4:8, 5:9, 8:12])
+    data_den[4:8, 5:9, 8:12] = noisy_data[4:8, 5:9, 8:12]
+    assert np.array_equal(data_den, noisy_data)
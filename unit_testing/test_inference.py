@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.inference
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+import pytest
+
+import numpy as np
+
+from spinalcordtoolbox import inference
+
+
+class DummyModel(object):
+    """Model doubling its input, recording the size of each batch"""
+
+    def __init__(self, factor=2.):
+        self.factor = factor
+        self.batch_sizes = []
+
+    def predict(self, x, batch_size=32, verbose=0):
+        self.batch_sizes.append(len(x))
+        return x * self.factor
+
+
+@pytest.fixture()
+def dummy_loader(monkeypatch):
+    loaded = []
+
+    def load_dummy(factor):
+        loaded.append(DummyModel(factor))
+        return loaded[-1]
+
+    monkeypatch.setitem(inference.LOADERS, 'dummy', load_dummy)
+    monkeypatch.setattr(inference, '_models', {})
+    return loaded
+
+
+@pytest.fixture()
+def server(tmpdir, monkeypatch):
+    socket_path = str(tmpdir.join('inference.sock'))
+    monkeypatch.setenv(inference.ENV_SOCKET, socket_path)
+    server = inference.InferenceServer(batch_delay=0.2)
+    server.thread = threading.Thread(target=server.serve_forever)
+    server.thread.start()
+    assert server.ready.wait(5)
+    yield server
+    server.shutdown()
+    server.thread.join(5)
+    assert not os.path.exists(socket_path)
+
+
+def test_get_model_in_process(tmpdir, monkeypatch, dummy_loader):
+    monkeypatch.setenv(inference.ENV_SOCKET, str(tmpdir.join('no_server.sock')))
+    model = inference.get_model('dummy', factor=2.)
+    assert isinstance(model, DummyModel)
+    # models are only loaded once per process
+    assert inference.get_model('dummy', factor=2.) is model
+    assert len(dummy_loader) == 1
+
+
+def test_server_batching(server, dummy_loader):
+    nb_clients = 4
+    data = [np.random.RandomState(i).rand(3, 8, 8, 1).astype(np.float32) for i in range(nb_clients)]
+    preds = [None] * nb_clients
+    models = [inference.get_model('dummy', factor=3.) for _ in range(nb_clients)]
+    assert all([isinstance(model, inference.RemoteModel) for model in models])
+
+    def predict(i):
+        preds[i] = models[i].predict(data[i], batch_size=4)
+
+    threads = [threading.Thread(target=predict, args=(i,)) for i in range(nb_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    for i in range(nb_clients):
+        assert preds[i].dtype == np.float32
+        assert np.allclose(preds[i], data[i] * 3)
+    # the model is loaded once, and requests received at the same time are run in the same batch
+    assert len(dummy_loader) == 1
+    assert sum(dummy_loader[0].batch_sizes) == 3 * nb_clients
+    assert len(dummy_loader[0].batch_sizes) < nb_clients
+    for model in models:
+        model.close()
+
+
+def test_server_error(server, dummy_loader):
+    model = inference.get_model('unknown_loader')
+    with pytest.raises(RuntimeError):
+        model.predict(np.zeros((1, 2)))
+    # the connection is still usable
+    model.spec = {'loader': 'dummy', 'params': {'factor': 2.}}
+    assert np.array_equal(model.predict(np.ones((1, 2))), 2 * np.ones((1, 2)))
+    model.close()
+
+
+def test_fallback_when_server_stops(server, dummy_loader):
+    model = inference.get_model('dummy', factor=2.)
+    assert isinstance(model, inference.RemoteModel)
+    server.shutdown()
+    server.thread.join(5)
+    assert np.array_equal(model.predict(np.ones((2, 2))), 2 * np.ones((2, 2)))
+    assert model.sock is None
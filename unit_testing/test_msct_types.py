@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_types
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+
+from msct_types import Centerline
+
+
+@pytest.fixture()
+def helix():
+    """Helix of radius 5 mm along z (z increasing with the index of the points)"""
+    t = np.linspace(0, 4 * np.pi, 200)
+    return Centerline(5 * np.cos(t), 5 * np.sin(t), 8 * t, -5 * np.sin(t), 5 * np.cos(t), 8 * np.ones_like(t))
+
+
+def frames_loop(points, derivatives):
+    """Reference coordinate systems and plane parameters, computed point by point"""
+    matrices, inverse_matrices, plans_parameters = [], [], []
+    for point, derivative in zip(points, derivatives):
+        z_prime_axis = derivative / np.linalg.norm(derivative)
+        y_axis = np.array([0, 1, 0])
+        y_prime_axis = y_axis - np.dot(y_axis, z_prime_axis) * z_prime_axis
+        y_prime_axis /= np.linalg.norm(y_prime_axis)
+        x_prime_axis = np.cross(y_prime_axis, z_prime_axis)
+        x_prime_axis /= np.linalg.norm(x_prime_axis)
+        matrix = np.array([[x_prime_axis[0], y_prime_axis[0], z_prime_axis[0]],
+                           [x_prime_axis[1], y_prime_axis[1], z_prime_axis[1]],
+                           [x_prime_axis[2], y_prime_axis[2], z_prime_axis[2]]])
+        matrices.append(matrix)
+        inverse_matrices.append(np.linalg.inv(matrix))
+        a, b, c = z_prime_axis
+        plans_parameters.append([a, b, c, -(a * point[0] + b * point[1] + c * point[2])])
+    return np.array(matrices), np.array(inverse_matrices), np.array(plans_parameters)
+
+
+def lengths_loop(points):
+    """Reference lengths, accumulated point by point from both ends"""
+    progressive_length, incremental_length = [0.0], [0.0]
+    progressive_length_inverse, incremental_length_inverse = [0.0], [0.0]
+    for i in range(len(points) - 1):
+        distance = np.sqrt(np.sum((points[i] - points[i + 1]) ** 2))
+        progressive_length.append(distance)
+        incremental_length.append(incremental_length[-1] + distance)
+    for i in range(len(points) - 1, 0, -1):
+        distance = np.sqrt(np.sum((points[i] - points[i - 1]) ** 2))
+        progressive_length_inverse.append(distance)
+        incremental_length_inverse.append(incremental_length_inverse[-1] + distance)
+    return progressive_length, incremental_length, progressive_length_inverse, incremental_length_inverse
+
+
+def dist_points_rel_loop(c):
+    """Reference vertebral distribution, computed point by point from the discs found by the centerline"""
+    index_disk_inv = sorted([[index, disk] for disk, index in c.index_disk.items()] + [[0, 'bottom']])
+    l_points = [0] * c.number_of_points
+    for i in range(1, len(index_disk_inv)):
+        for j in range(index_disk_inv[i - 1][0], index_disk_inv[i][0]):
+            l_points[j] = index_disk_inv[i][1]
+    progress_length = np.zeros(c.number_of_points)
+    for i in range(c.number_of_points - 1):
+        progress_length[i + 1] = progress_length[i] + c.progressive_length[i]
+    dist_points = [progress_length[c.index_disk[c.label_reference]] - progress_length[i]
+                   for i in range(c.number_of_points)]
+    rank = lambda label: c.list_labels.index(c.labels_regions[label])
+    dist_points_rel = [0] * c.number_of_points
+    for i in range(c.number_of_points):
+        current_label = l_points[i]
+        if current_label == 0:
+            if 'PMG' in c.index_disk:
+                dist_points_rel[i] = dist_points[i] - dist_points[c.index_disk['PMG']]
+                continue
+            else:
+                current_label = 'PMG'
+        if rank(current_label) < c.list_labels.index(c.first_label):
+            dist_points_rel[i] = dist_points[i] - dist_points[c.index_disk[c.regions_labels[str(c.first_label)]]]
+        elif rank(current_label) >= c.list_labels.index(c.last_label):
+            dist_points_rel[i] = dist_points[i] - dist_points[c.index_disk[c.regions_labels[str(c.last_label)]]]
+        else:
+            next_label = c.regions_labels[str(c.list_labels[rank(current_label) + 1])]
+            dist_current = dist_points[c.index_disk[current_label]]
+            if next_label in c.index_disk:
+                dist_next = dist_points[c.index_disk[next_label]]
+                dist_points_rel[i] = (dist_points[i] - dist_current) / abs(dist_next - dist_current)
+            else:
+                dist_points_rel[i] = (dist_points[i] - dist_current) / c.average_vert_length[current_label]
+    return l_points, dist_points, dist_points_rel
+
+
+def test_centerline_frames(helix):
+    matrices, inverse_matrices, plans_parameters = frames_loop(helix.points, helix.derivatives)
+    assert np.allclose(helix.matrices, matrices)
+    assert np.allclose(helix.inverse_matrices, inverse_matrices)
+    assert np.allclose(helix.plans_parameters, plans_parameters)
+    assert np.allclose(helix.offset_plans, plans_parameters[:, 3])
+    # per-index accessors read the same frames
+    origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix, inverse_matrix = helix.compute_coordinate_system(17)
+    assert np.allclose(matrix, matrices[17]) and np.allclose(inverse_matrix, inverse_matrices[17])
+    assert np.allclose(helix.get_plan_parameters(17), plans_parameters[17])
+
+
+def test_centerline_batch_coordinates(helix):
+    rs = np.random.RandomState(0)
+    coordinates = helix.points[rs.randint(0, helix.number_of_points, 50)] + rs.randn(50, 3)
+    indexes = helix.find_nearest_indexes(coordinates)
+    in_planes = helix.get_in_plans_coordinates(coordinates, indexes)
+    projected = helix.get_projected_coordinates_on_planes(coordinates, indexes)
+    distances = helix.get_distances_from_planes(coordinates, indexes)
+    for i, (coord, index) in enumerate(zip(coordinates, indexes)):
+        assert np.allclose(in_planes[i], helix.get_in_plane_coordinates(coord, index))
+        assert np.allclose(projected[i], helix.get_projected_coordinates_on_plane(coord, index))
+        assert np.isclose(distances[i], helix.get_distance_from_plane(coord, index))
+    assert np.allclose(helix.get_inverse_plans_coordinates(in_planes, indexes), coordinates)
+
+
+def test_centerline_lengths(helix):
+    progressive, incremental, progressive_inv, incremental_inv = lengths_loop(helix.points)
+    assert np.allclose(helix.progressive_length, progressive)
+    assert np.allclose(helix.incremental_length, incremental)
+    assert np.allclose(helix.progressive_length_inverse, progressive_inv)
+    assert np.allclose(helix.incremental_length_inverse, incremental_inv)
+    # length of a helix: number of turns * sqrt((2 pi r)^2 + pitch^2), with a pitch of 2 pi * 8
+    assert np.isclose(helix.length, 2 * np.sqrt((2 * np.pi * 5) ** 2 + (2 * np.pi * 8) ** 2), rtol=1e-3)
+
+
+def test_centerline_vertebral_distribution(helix):
+    # discs from top (C1) to bottom, C2 and C6 are missing (C2 is interpolated between C1 and C3)
+    disks_levels = [list(helix.points[index]) + [label] for index, label in [(190, 1), (150, 3), (120, 4),
+                                                                               (90, 5), (40, 7)]]
+    helix.compute_vertebral_distribution(disks_levels)
+    assert helix.index_disk['C2'] == 170
+    l_points, dist_points, dist_points_rel = dist_points_rel_loop(helix)
+    assert helix.l_points == l_points
+    assert np.allclose(helix.dist_points, dist_points)
+    assert np.allclose(helix.dist_points_rel, dist_points_rel)
@@ -11,8 +11,10 @@ import csv
 import tempfile
 import os
 import nibabel as nib
+from scipy import ndimage
 from skimage.transform import rotate
 from spinalcordtoolbox import process_seg
+import msct_shape
 from spinalcordtoolbox.image import Image
 from sct_process_segmentation import Param
 
@@ -114,6 +116,30 @@ def test_compute_shape_noangle(dummy_segmentation):
     assert np.mean(metrics['solidity'].data[30:70]) == pytest.approx(1.0, rel=0.05)
 
 
+def test_properties2d_batch():
+    """Batched shape properties should match the ones of properties2d, computed with regionprops."""
+    rs = np.random.RandomState(0)
+    patches = np.array([ndimage.gaussian_filter(rs.rand(40, 36), 3) > 0.5 for _ in range(20)]).astype(float)
+    patches[0] = 0  # empty patch
+    properties = msct_shape.properties2d_batch(patches, [0.5, 0.5])
+    assert np.isnan(properties['area'][0])
+    for i in range(1, len(patches)):
+        properties_ref = msct_shape.properties2d(patches[i], [0.5, 0.5])
+        for key in ['area', 'equivalent_diameter', 'minor_axis_length', 'major_axis_length', 'ratio_minor_major',
+                    'eccentricity', 'solidity']:
+            assert properties[key][i] == pytest.approx(properties_ref[key])
+
+
+def test_properties2d_batch_orientation():
+    """The orientation is the angle between X' and the major axis"""
+    xx, yy = np.mgrid[:41, :41] - 20.
+    patches = np.array([((xx / 15) ** 2 + (yy / 8) ** 2 <= 1), ((xx / 8) ** 2 + (yy / 15) ** 2 <= 1)]).astype(float)
+    properties = msct_shape.assign_AP_and_RL_diameter(msct_shape.properties2d_batch(patches))
+    assert np.abs(properties['orientation']) == pytest.approx([0., 90.])
+    assert properties['RL_diameter'] == pytest.approx([properties['major_axis_length'][0],
+                                                      properties['minor_axis_length'][1]])
+
+
 # TODO: once PR #1931 is merged, work on the test below.
 # noinspection 801,PyShadowingNames
 # def test_compute_shape(dummy_segmentation):
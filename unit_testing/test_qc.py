@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.reports
+
+from __future__ import absolute_import
+
+import os
+import json
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+import matplotlib.image as mpimg
+
+from spinalcordtoolbox.image import Image
+import spinalcordtoolbox.reports.qc as qc
+import spinalcordtoolbox.reports.slice as qcslice
+import spinalcordtoolbox.reports.render as qcrender
+import spinalcordtoolbox.reports.store as qcstore
+
+
+@pytest.fixture(scope="session")
+def image_and_seg():
+    """Create a 3d image and a segmentation of a cord which moves across slices."""
+    affine = np.diag([0.7, 0.7, 1., 1.])
+    data = np.random.RandomState(0).rand(30, 30, 40) * 100
+    data_seg = np.zeros(data.shape)
+    for z in range(data.shape[2]):
+        data_seg[10 + z // 5:14 + z // 5, 12:16, z] = 1
+    im = Image(data, hdr=nib.Nifti1Image(data, affine).header)
+    im_seg = Image(data_seg, hdr=nib.Nifti1Image(data_seg, affine).header)
+    return im, im_seg
+
+
+def _append_entries(args):
+    """Append entries from a worker process"""
+    root_folder, worker = args
+    store = qcstore.QcStore(root_folder)
+    for i in range(20):
+        store.append([{'worker': worker, 'entry': i}])
+
+
+@pytest.mark.parametrize('nb_channels', [1, 3, 4])
+def test_write_png(tmpdir, nb_channels):
+    data = np.random.RandomState(0).randint(0, 256, (13, 17, nb_channels)).astype(np.uint8)
+    fname = str(tmpdir.join('img.png'))
+    qcrender.write_png(fname, data[..., 0] if nb_channels == 1 else data)
+    data_read = np.round(mpimg.imread(fname) * 255).astype(np.uint8)
+    assert np.array_equal(data_read.reshape(data.shape), data)
+
+
+def test_canvas():
+    canvas = qcrender.Canvas((10, 20), aspect=2., zoom=1.5)
+    assert canvas.rgba.shape == (30, 30, 4)
+    # fully transparent layer leaves the canvas unchanged
+    canvas.imshow(np.zeros((10, 20, 4)))
+    assert not canvas.rgba.any()
+    canvas.imshow(qcrender.gray_to_rgba(np.arange(200).reshape(10, 20)))
+    assert np.all(canvas.rgba[..., 3] == 1)
+    assert canvas.rgba[0, 0, 0] == 0 and canvas.rgba[-1, -1, 0] == 1
+    canvas.text(2, 8, 'A', color='yellow')
+    assert np.any(canvas.rgba[..., 2] < canvas.rgba[..., 0])
+
+
+@pytest.mark.parametrize('shape,size', [((5, 40, 40), 15), ((5, 12, 9), 15), ((5, 31, 31), 5)])
+def test_crop_patches(shape, size):
+    """Vectorized cropping should give the same squares as crop() followed by add_slice()."""
+    rs = np.random.RandomState(0)
+    slices = rs.rand(*shape)
+    centers_x = rs.rand(shape[0]) * shape[1]
+    centers_y = rs.rand(shape[0]) * shape[2]
+    patches = qcslice.Slice.crop_patches(slices, centers_x, centers_y, size, size)
+    for i in range(shape[0]):
+        patch_ref = qcslice.Slice.add_slice(np.zeros((size * 2, size * 2)), 0, 1, size,
+                                            qcslice.Slice.crop(slices[i], int(centers_x[i]), int(centers_y[i]), size,
+                                                               size))
+        assert np.array_equal(patches[i], patch_ref)
+
+
+def test_add_entry(tmpdir, image_and_seg):
+    path_qc = str(tmpdir.join('qc'))
+    kwargs = dict(src=str(tmpdir.join('dataset', 'sub-01', 'anat', 't2.nii.gz')), process='sct_deepseg_sc',
+                  args=['-i', 't2.nii.gz'], path_qc=path_qc, plane='Axial', qcslice_layout=lambda x: x.mosaic(),
+                  qcslice_operations=[qc.QcImage.listed_seg], stretch_contrast_method='equalized')
+    description = qc.add_entry(qcslice=qcslice.Axial(image_and_seg, p_resample=None), update_description=False,
+                               **kwargs)
+    assert not os.path.isfile(os.path.join(path_qc, 'qc_results.json'))
+    img_bkg = mpimg.imread(os.path.join(path_qc, description['background_img']))
+    img_overlay = mpimg.imread(os.path.join(path_qc, description['overlay_img']))
+    # both images are stacked in the html page: they must have the same size
+    assert img_bkg.shape == img_overlay.shape
+    assert np.any(img_overlay[..., 3] > 0)
+    assert description['subject'] == 'sub-01'
+
+    qc.add_entry(qcslice=qcslice.Axial(image_and_seg, p_resample=None), **kwargs)
+    assert len(json.load(open(os.path.join(path_qc, 'qc_results.json')))) == 1
+    assert os.path.isfile(os.path.join(path_qc, 'index.html'))
+
+
+def test_store_concurrent_append(tmpdir):
+    from multiprocessing import Pool
+    root_folder = str(tmpdir.join('qc'))
+    pool = Pool(4)
+    try:
+        pool.map(_append_entries, [(root_folder, worker) for worker in range(8)])
+    finally:
+        pool.close()
+        pool.join()
+    store = qcstore.QcStore(root_folder)
+    entries = store.read()
+    assert len(entries) == 160
+    # entries of each worker are kept in order
+    for worker in range(8):
+        assert [e['entry'] for e in entries if e['worker'] == worker] == list(range(20))
+    assert not os.path.isfile(store.fname_json)
+    store.generate_index()
+    assert json.load(open(store.fname_json)) == entries
+    assert os.path.isfile(os.path.join(root_folder, 'index.html'))
+
+
+def test_store_legacy_folder(tmpdir):
+    """Entries of qc_results.json written by previous versions should be kept"""
+    root_folder = str(tmpdir.mkdir('qc'))
+    json.dump([{'entry': 0}, {'entry': 1}], open(os.path.join(root_folder, 'qc_results.json'), 'w'))
+    store = qcstore.QcStore(root_folder)
+    assert store.read() == [{'entry': 0}, {'entry': 1}]
+    store.append([{'entry': 2}])
+    assert [e['entry'] for e in qcstore.generate_index(root_folder)] == [0, 1, 2]
+
+
+def test_add_entry_deferred_index(tmpdir, image_and_seg, monkeypatch):
+    monkeypatch.setenv('SCT_QC_DEFER_INDEX', '1')
+    path_qc = str(tmpdir.join('qc'))
+    qc.add_entry(str(tmpdir.join('dataset', 'sub-01', 'anat', 't2.nii.gz')), 'sct_deepseg_sc', [], path_qc, 'Axial',
+                 qcslice=qcslice.Axial(image_and_seg, p_resample=None), qcslice_layout=lambda x: x.mosaic(),
+                 qcslice_operations=[qc.QcImage.listed_seg])
+    assert not os.path.isfile(os.path.join(path_qc, 'index.html'))
+    assert len(qcstore.generate_index(path_qc)) == 1
+    assert os.path.isfile(os.path.join(path_qc, 'index.html'))
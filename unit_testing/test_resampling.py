@@ -87,3 +87,49 @@ def test_nipy_resample_image_4d(fake_4dimage_nipy):
     assert img_r.get_data()[8, 8, 4, 0] == 1.0  # make sure there is no displacement in world coordinate system
     assert img_r.get_data()[8, 8, 4, 1] == 0.0
     assert nipy2nifti(img_r).header.get_zooms() == (0.5, 0.5, 1.0, 1.0)
+
+
+def test_resample_image():
+    """Test in-memory resampling of an Image"""
+    from spinalcordtoolbox.image import Image
+    data = np.zeros((9, 9, 9))
+    data[4, 4, 4] = 1.
+    nii = nib.nifti1.Nifti1Image(data, np.eye(4))
+    im_r = resampling.resample_image(Image(data, hdr=nii.header), '0.5x0.5x1', 'mm', 'nn', verbose=0)
+    assert im_r.data.shape == (18, 18, 9)
+    assert im_r.data[8, 8, 4] == 1.0
+    assert im_r.dim[4:7] == (0.5, 0.5, 1.0)
+
+
+@pytest.mark.parametrize('interp_order', [0, 1, 2])
+def test_iter_resample_4d(interp_order):
+    """Test the resampling of 4d data by chunks, which must match the resampling of each volume"""
+    from scipy.ndimage import affine_transform
+    data = np.random.RandomState(0).rand(9, 8, 7, 5)
+    R = np.diag([0.5, 0.5, 2., 1.])
+    shape_r = (18, 16, 4)
+    chunks = list(resampling.iter_resample_4d(data, R, shape_r, interp_order, dtype=np.float32, chunk_size=2))
+    assert [t for t, _ in chunks] == [0, 2, 4]
+    data_r = np.concatenate([data_r for _, data_r in chunks], axis=3)
+    assert data_r.shape == (18, 16, 4, 5)
+    assert data_r.dtype == np.float32
+    for it in range(5):
+        expected = affine_transform(data[..., it], R[:3, :3], offset=R[:3, 3], output_shape=shape_r,
+                                    order=interp_order, mode='nearest')
+        assert np.allclose(data_r[..., it], expected, atol=1e-6)
+
+
+def test_save_4d_chunks(tmpdir):
+    """Test the chunked writing of 4d data"""
+    data = np.random.RandomState(0).rand(4, 3, 2, 5).astype(np.float32)
+    affine = np.diag([0.5, 0.5, 2., 1.])
+    fname = str(tmpdir.join('data.nii.gz'))
+    chunks = [(t, data[..., t:t + 2]) for t in range(0, 5, 2)]
+    resampling.save_4d_chunks(chunks, fname, data.shape, affine, dtype=np.float32)
+    nii = nib.load(fname)
+    assert nii.header.get_data_dtype() == np.float32
+    assert np.array_equal(np.asanyarray(nii.dataobj), data)
+    assert np.allclose(nii.affine, affine)
+    assert nii.header.get_zooms()[:3] == (0.5, 0.5, 2.)
+    with pytest.raises(ValueError):
+        resampling.save_4d_chunks(chunks[:2], fname, data.shape, affine, dtype=np.float32)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.resources
+
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from spinalcordtoolbox import resources
+
+
+@pytest.mark.parametrize('nb_cores,function,nb_threads,expected', [
+    (64, 'sct_propseg', None, (64, 1)),
+    (64, 'sct_register_to_template', None, (16, 4)),
+    (64, 'sct_propseg', 8, (8, 8)),
+    (6, 'sct_propseg', 4, (1, 4)),
+    (2, 'sct_straighten_spinalcord', None, (1, 2)),
+    (0, None, None, (1, 1)),
+])
+def test_get_budget(nb_cores, function, nb_threads, expected):
+    assert resources.get_budget(nb_cores, function=function, nb_threads=nb_threads) == expected
+
+
+def test_set_thread_budget(monkeypatch):
+    # register the variables so that monkeypatch restores them after the test
+    for var in resources.THREAD_ENV_VARS + ['TF_NUM_INTEROP_THREADS', resources.ENV_THREADS]:
+        monkeypatch.setenv(var, '')
+    assert resources.get_thread_budget() is None
+    resources.set_thread_budget(3)
+    assert resources.get_thread_budget() == 3
+    for var in resources.THREAD_ENV_VARS:
+        assert os.environ[var] == '3'
+    assert os.environ['TF_NUM_INTEROP_THREADS'] == '1'
+
+
+def test_get_nb_processes(monkeypatch):
+    from multiprocessing import cpu_count
+    monkeypatch.setenv(resources.ENV_THREADS, '')
+    assert resources.get_nb_processes() == cpu_count()
+    assert resources.get_nb_processes(64) == 64
+    assert resources.get_nb_processes(0) == 0
+    monkeypatch.setenv(resources.ENV_THREADS, '3')
+    assert resources.get_nb_processes() == 3
+    assert resources.get_nb_processes(2) == 2
+    assert resources.get_nb_processes(8) == 3
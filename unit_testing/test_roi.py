@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.roi
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import roi
+
+
+@pytest.fixture(scope="session")
+def image_and_seg():
+    """Create a 4d image and a 3d segmentation which only covers a small part of the FOV."""
+    affine = np.array([[0.5, 0, 0, -10], [0, 0.5, 0, 5], [0, 0, 2., 30], [0, 0, 0, 1]])
+    data = np.random.RandomState(0).rand(20, 22, 10, 3)
+    data_seg = np.zeros((20, 22, 10), dtype=np.uint8)
+    data_seg[8:11, 9:13, 2:8] = 1
+    im = Image(data, hdr=nib.Nifti1Image(data, affine).header)
+    im_seg = Image(data_seg, hdr=nib.Nifti1Image(data_seg, affine).header)
+    return im, im_seg
+
+
+def test_get_bounding_box():
+    mask = np.zeros((10, 10, 10))
+    mask[2:4, 5, 6:9] = 1
+    assert roi.get_bounding_box(mask) == (slice(2, 4), slice(5, 6), slice(6, 9))
+    assert roi.get_bounding_box(mask, pad=2) == (slice(0, 6), slice(3, 8), slice(4, 10))
+    assert roi.get_bounding_box(mask, pad=[0, 1, 0]) == (slice(2, 4), slice(4, 7), slice(6, 9))
+    assert roi.get_bounding_box(np.zeros((3, 3, 3))) is None
+
+
+def test_crop_and_paste_image(image_and_seg):
+    im, im_seg = image_and_seg
+    bbox = roi.get_bounding_box(im_seg.data, pad=1)
+    im_crop = roi.crop_image(im, bbox)
+    assert im_crop.data.shape == (5, 6, 8, 3)
+    # the first voxel of the cropped image should be at the same physical position as in the native image
+    pos_native = np.dot(im.header.get_best_affine(), [7, 8, 1, 1])
+    pos_crop = np.dot(im_crop.header.get_best_affine(), [0, 0, 0, 1])
+    assert np.allclose(pos_native, pos_crop)
+    # pasting back should restore the native grid
+    im_paste = roi.paste_image(im_crop, im, bbox)
+    assert im_paste.data.shape == im.data.shape
+    assert np.allclose(im_paste.header.get_best_affine(), im.header.get_best_affine())
+    assert np.array_equal(im_paste.data[bbox], im.data[bbox])
+    assert im_paste.data.sum() == im.data[bbox].sum()
+
+
+def test_run_in_roi(image_and_seg):
+    im, im_seg = image_and_seg
+
+    def mean_in_seg(im_crop, im_seg_crop):
+        im_out = Image(im_crop.data.mean(axis=3) * im_seg_crop.data)
+        return im_out, Image(im_seg_crop.data.copy())
+
+    im_mean, im_seg_out = roi.run_in_roi(mean_in_seg, [im, im_seg], im_seg, pad=2)
+    assert np.allclose(im_mean.data, im.data.mean(axis=3) * im_seg.data)
+    assert np.array_equal(im_seg_out.data, im_seg.data)
+    assert np.allclose(im_mean.header.get_best_affine(), im.header.get_best_affine())
+
+
+def test_run_in_roi_wrong_grid(image_and_seg):
+    im, im_seg = image_and_seg
+    with pytest.raises(ValueError):
+        roi.run_in_roi(lambda x: x, [Image(np.zeros((3, 3, 3)))], im_seg)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.scheduler
+
+from __future__ import absolute_import
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from spinalcordtoolbox import scheduler
+
+
+def square(job):
+    name, value = job
+    if value < 0:
+        raise ValueError("negative value")
+    return {'name': name, 'value': value ** 2}
+
+
+def crash_once(job):
+    """Fail the first time the job is run (the marker file is given in the job)"""
+    fname_marker, value = job
+    if not os.path.isfile(fname_marker):
+        open(fname_marker, 'w').close()
+        os._exit(1)  # kill the worker process
+    return value
+
+
+def test_run_jobs(tmpdir):
+    fname_table = str(tmpdir.join('jobs.jsonl'))
+    jobs = [('a', 1), ('b', 2), ('c', -1)]
+    finished = []
+    results = scheduler.run_jobs(square, jobs, lambda: ProcessPoolExecutor(2),
+                                 job_table=scheduler.JobTable(fname_table), max_retries=1, backoff=0.01,
+                                 callback=lambda job, result, record: finished.append(tuple(job)))
+    assert results == [{'name': 'a', 'value': 1}, {'name': 'b', 'value': 4}, None]
+    assert sorted(finished) == sorted(jobs)
+    records = [json.loads(line) for line in open(fname_table)]
+    # 2 jobs done + 2 attempts of the failing job
+    assert len(records) == 4
+    assert [r['attempt'] for r in records if r['job'] == ['c', -1]] == [1, 2]
+    assert all([r['status'] == 'failed' and 'ValueError' in r['error'] for r in records if r['job'] == ['c', -1]])
+
+
+def test_run_jobs_resume(tmpdir):
+    fname_table = str(tmpdir.join('jobs.jsonl'))
+    table = scheduler.JobTable(fname_table)
+    table.add(('a', 1), 'done', 1, duration=1., result={'name': 'a', 'value': 'cached'})
+    table.add(('b', 2), 'failed', 1, duration=1., error='ValueError')
+    # only the jobs which are not done are run
+    results = scheduler.run_jobs(square, [('a', 1), ('b', 2)], lambda: ProcessPoolExecutor(2),
+                                 job_table=scheduler.JobTable(fname_table))
+    assert results == [{'name': 'a', 'value': 'cached'}, {'name': 'b', 'value': 4}]
+    assert scheduler.JobTable(fname_table).is_done(('b', 2))
+
+
+def test_run_jobs_resume_none(tmpdir):
+    """Jobs done without result are not deserialized on resume"""
+    fname_table = str(tmpdir.join('jobs.jsonl'))
+    table = scheduler.JobTable(fname_table)
+    table.add(('a', 1), 'done', 1, duration=1., result=None)
+    results = scheduler.run_jobs(square, [('a', 1)], lambda: ProcessPoolExecutor(2),
+                                 job_table=scheduler.JobTable(fname_table), deserialize=lambda x: x['value'])
+    assert results == [None]
+
+
+def test_run_jobs_broken_pool(tmpdir):
+    """The pool should be restarted if a worker process dies"""
+    jobs = [(str(tmpdir.join('marker_{}'.format(i))), i) for i in range(3)]
+    results = scheduler.run_jobs(crash_once, jobs, lambda: ProcessPoolExecutor(2), max_retries=2, backoff=0.01)
+    assert results == [0, 1, 2]
+
+
+def test_estimate_durations():
+    table = scheduler.JobTable()
+    table.add(('f', 'sub1', '-a'), 'done', 1, duration=10.)
+    table.add(('f', 'sub1', '-b'), 'done', 1, duration=20.)
+    table.add(('f', 'sub2', '-a'), 'failed', 1, duration=3.)
+    jobs = [('f', 'sub2', '-a'), ('f', 'sub1', '-c'), ('f', 'sub3', '-a')]
+    assert table.estimate_durations(jobs, group_key=1) == [3., 15., 11.]
+    assert scheduler.JobTable().estimate_durations(jobs) == [0., 0., 0.]
+
+
+def test_job_table_corrupted_line(tmpdir):
+    fname_table = str(tmpdir.join('jobs.jsonl'))
+    scheduler.JobTable(fname_table).add(('a', 1), 'done', 1, duration=1., result=1)
+    with open(fname_table, 'a') as f:
+        f.write('{"job": ["b", 2], "sta')
+    table = scheduler.JobTable(fname_table)
+    assert table.is_done(('a', 1))
+    assert table.get_last(('b', 2)) is None
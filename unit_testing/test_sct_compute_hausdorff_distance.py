@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_compute_hausdorff_distance
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+
+from sct_compute_hausdorff_distance import Thinning, HausdorffDistance
+
+
+def zhang_suen_loop(image):
+    """Reference pixel-wise Zhang-Suen thinning (interior pixels only)"""
+    image = image.copy()
+    rows, columns = image.shape
+    changing = True
+    while changing:
+        changing = False
+        for step in [1, 2]:
+            to_remove = []
+            for x in range(1, rows - 1):
+                for y in range(1, columns - 1):
+                    if image[x, y] != 1:
+                        continue
+                    n = [image[x - 1, y], image[x - 1, y + 1], image[x, y + 1], image[x + 1, y + 1],
+                         image[x + 1, y], image[x + 1, y - 1], image[x, y - 1], image[x - 1, y - 1]]
+                    P2, P3, P4, P5, P6, P7, P8, P9 = n
+                    transitions = sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:] + n[:1]))
+                    if step == 1:
+                        cond_34 = P2 * P4 * P6 == 0 and P4 * P6 * P8 == 0
+                    else:
+                        cond_34 = P2 * P4 * P8 == 0 and P2 * P6 * P8 == 0
+                    if 2 <= sum(n) <= 6 and transitions == 1 and cond_34:
+                        to_remove.append((x, y))
+            for x, y in to_remove:
+                image[x, y] = 0
+            changing = changing or len(to_remove) > 0
+    return image
+
+
+def hausdorff_loop(data1, data2, spacing):
+    """Reference relative distances, computed between all pairs of points"""
+    coord1 = np.transpose(np.nonzero(data1)) * spacing
+    coord2 = np.transpose(np.nonzero(data2)) * spacing
+    dist = np.sqrt(((coord1[:, None, :] - coord2[None, :, :]) ** 2).sum(axis=2))
+    return dist.min(axis=1), dist.min(axis=0)
+
+
+def random_masks(shape, n):
+    rs = np.random.RandomState(0)
+    masks = []
+    for _ in range(n):
+        mask = np.zeros(shape, dtype=np.uint8)
+        # a few rectangles, some of them touching the border of the image
+        for _ in range(3):
+            x, y = rs.randint(0, shape[0] - 2), rs.randint(0, shape[1] - 2)
+            mask[x:x + rs.randint(2, 8), y:y + rs.randint(2, 8)] = 1
+        masks.append(mask)
+    return masks
+
+
+@pytest.mark.parametrize('mask', random_masks((12, 15), 5))
+def test_zhang_suen(mask):
+    thinned = Thinning.__new__(Thinning).zhang_suen(mask)
+    assert np.array_equal(thinned, zhang_suen_loop(mask))
+
+
+def test_zhang_suen_border():
+    # a filled image touches the border everywhere: only the interior is thinned
+    mask = np.ones((6, 7), dtype=np.uint8)
+    thinning = Thinning.__new__(Thinning)
+    thinned = thinning.zhang_suen(mask)
+    assert np.array_equal(thinned, zhang_suen_loop(mask))
+    assert thinned[0].all() and thinned[-1].all() and thinned[:, 0].all() and thinned[:, -1].all()
+
+
+def test_zhang_suen_stack():
+    # slices of a 3D array are thinned independently
+    masks = random_masks((10, 11), 4)
+    thinned = Thinning.__new__(Thinning).zhang_suen(np.array(masks))
+    for mask, thinned_slice in zip(masks, thinned):
+        assert np.array_equal(thinned_slice, zhang_suen_loop(mask))
+
+
+@pytest.mark.parametrize('spacing', [None, [0.5, 2.]])
+def test_hausdorff_distance(spacing):
+    data1, data2 = random_masks((12, 15), 2)
+    dist = HausdorffDistance(data1, data2, v=0, spacing=spacing)
+    ref1, ref2 = hausdorff_loop(data1, data2, [1., 1.] if spacing is None else spacing)
+    assert np.allclose(dist.min_distances_1[np.nonzero(data1)], ref1)
+    assert np.allclose(dist.min_distances_2[np.nonzero(data2)], ref2)
+    assert np.isclose(dist.H, max(ref1.max(), ref2.max()))
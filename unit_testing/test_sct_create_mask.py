@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_create_mask
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from spinalcordtoolbox.image import Image
+from sct_create_mask import Param, get_centers_of_mass, create_mask3d
+
+
+@pytest.fixture()
+def im_data():
+    data = np.zeros((20, 16, 6))
+    affine = np.diag([0.5, 0.8, 2., 1])
+    return Image(data, hdr=nib.Nifti1Image(data, affine).header)
+
+
+def create_mask2d(param, center, shape, size, px, py, nx, ny):
+    """Reference 2D mask, built slice by slice as sct_create_mask used to do"""
+    offset = [int(o) for o in param.offset.split(',')]
+    xx, yy = np.mgrid[:nx, :ny]
+    xc, yc = center
+    if 'mm' in size:
+        size = float(size[:-2])
+        radius_x = np.ceil((int(np.round(size / px)) - 1) / 2.0)
+        radius_y = np.ceil((int(np.round(size / py)) - 1) / 2.0)
+    else:
+        radius_x = np.ceil((int(size) - 1) / 2.0)
+        radius_y = radius_x
+    if shape == 'box':
+        return ((abs(xx + offset[0] - xc) <= radius_x) & (abs(yy + offset[1] - yc) <= radius_y)) * 1
+    elif shape == 'cylinder':
+        return (((xx + offset[0] - xc) / radius_x) ** 2 + ((yy + offset[1] - yc) / radius_y) ** 2 <= 1) * 1
+    elif shape == 'gaussian':
+        sigma = float(radius_x)
+        return np.exp(-(((xx + offset[0] - xc) ** 2) / (2 * (sigma ** 2)) +
+                        ((yy + offset[1] - yc) ** 2) / (2 * (sigma ** 2))))
+
+
+def test_get_centers_of_mass():
+    data = np.zeros((10, 12, 4))
+    data[2:5, 3, 0] = 1
+    data[7, 1:9, 1] = 2
+    data[1, 1, 3] = data[8, 10, 3] = 1
+    centers = get_centers_of_mass(data)
+    for iz in [0, 1, 3]:
+        assert np.allclose(centers[iz], ndimage.center_of_mass(data[:, :, iz]))
+    assert np.isnan(centers[2]).all()
+    assert np.allclose(get_centers_of_mass(data[:, :, 0]), [ndimage.center_of_mass(data[:, :, 0])])
+
+
+@pytest.mark.parametrize('shape', ['box', 'cylinder', 'gaussian'])
+@pytest.mark.parametrize('size', ['5', '4mm'])
+def test_create_mask3d(im_data, shape, size):
+    param = Param()
+    param.offset = '1,-2'
+    nx, ny, nz = im_data.data.shape
+    centers = np.array([[10, 8], [3.5, 7.2], [np.nan, np.nan], [0, 15], [18.3, 1], [10, 8]])
+    mask = create_mask3d(param, centers, shape, size, im_data)
+    assert mask.shape == (nx, ny, nz)
+    for iz, center in enumerate(centers):
+        if np.isnan(center).any():
+            assert not mask[:, :, iz].any()
+        else:
+            assert np.allclose(mask[:, :, iz], create_mask2d(param, center, shape, size, 0.5, 0.8, nx, ny))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_dmri_compute_dti
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+from dipy.core.gradients import gradient_table
+import dipy.reconst.dti as dti
+
+from sct_dmri_compute_dti import fit_dti
+
+
+@pytest.fixture(scope='module')
+def dwi():
+    """Small synthetic DWI: random tensors, 2 b=0 and 12 diffusion directions, with some noise"""
+    rs = np.random.RandomState(0)
+    bvecs = rs.randn(12, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1, keepdims=True)
+    bvals = np.array([0, 0] + [800] * 12)
+    bvecs = np.concatenate([np.zeros((2, 3)), bvecs])
+    gtab = gradient_table(bvals, bvecs)
+    shape = (6, 5, 4)
+    # tensors D = R diag(evals) R^T, with random rotations
+    evals = np.array([1.7e-3, 0.4e-3, 0.3e-3]) * rs.uniform(0.5, 1.5, shape + (3,))
+    rotations = np.linalg.qr(rs.randn(*shape + (3, 3)))[0]
+    tensors = np.einsum('...ij,...j,...kj->...ik', rotations, evals, rotations)
+    adc = np.einsum('vi,...ij,vj->...v', bvecs, tensors, bvecs)
+    data = 1000 * np.exp(-bvals * adc) + rs.uniform(0, 5, shape + (len(bvals),))
+    return data, gtab
+
+
+def assert_metrics_equal(metrics, tenfit, index=Ellipsis):
+    assert np.allclose(metrics['FA'][index], tenfit.fa[index], rtol=1e-5, atol=1e-6)
+    for name, ref in [('MD', tenfit.md), ('RD', tenfit.rd), ('AD', tenfit.ad)]:
+        assert np.allclose(metrics[name][index], ref[index], rtol=1e-5, atol=1e-9)
+    # eigenvectors are defined up to their sign
+    for idim in range(3):
+        dot = np.sum(metrics['V' + str(idim + 1)][index] * tenfit.evecs[index][..., idim], axis=-1)
+        assert np.allclose(np.abs(dot), 1, atol=1e-4)
+
+
+@pytest.mark.parametrize('nb_proc,chunk_size', [(0, 10000), (0, 7), (2, 7)])
+def test_fit_dti(dwi, nb_proc, chunk_size):
+    data, gtab = dwi
+    tenfit = dti.TensorModel(gtab).fit(data)
+    metrics = fit_dti(data, gtab, evecs=True, nb_proc=nb_proc, chunk_size=chunk_size)
+    assert list(metrics.keys()) == ['FA', 'MD', 'RD', 'AD', 'V1', 'V2', 'V3']
+    assert metrics['FA'].shape == data.shape[:3] and metrics['V1'].shape == data.shape[:3] + (3,)
+    assert_metrics_equal(metrics, tenfit)
+
+
+def test_fit_dti_mask(dwi):
+    data, gtab = dwi
+    tenfit = dti.TensorModel(gtab).fit(data)
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[1:4, 2:5, 1] = True
+    mask[2, 3, 2] = True
+    metrics = fit_dti(data, gtab, evecs=True, mask=mask, chunk_size=4)
+    assert_metrics_equal(metrics, tenfit, mask)
+    for name in metrics:
+        assert metrics[name].shape[:3] == data.shape[:3]
+        assert not metrics[name][~mask].any()
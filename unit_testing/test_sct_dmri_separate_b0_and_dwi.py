@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_dmri_separate_b0_and_dwi
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from sct_dmri_separate_b0_and_dwi import separate_b0_and_dwi
+
+
+@pytest.fixture()
+def im_dmri():
+    """Small 4d diffusion series: each volume is filled with its index, plus some random values"""
+    data = np.random.RandomState(0).rand(2, 3, 4, 6) + np.arange(6)
+    return Image(data, hdr=nib.Nifti1Image(data, np.eye(4)).header)
+
+
+@pytest.mark.parametrize('index_b0,index_dwi', [
+    ([0, 3], [1, 2, 4, 5]),
+    ([0], [1, 2, 3, 4, 5]),
+    ([5, 1], [4, 0, 2]),
+])
+def test_separate_b0_and_dwi(im_dmri, index_b0, index_dwi):
+    im_b0, im_b0_mean, im_dwi, im_dwi_mean = separate_b0_and_dwi(im_dmri, index_b0, index_dwi, average=True)
+    for im, im_mean, index in [(im_b0, im_b0_mean, index_b0), (im_dwi, im_dwi_mean, index_dwi)]:
+        assert im.data.shape == (2, 3, 4, len(index))
+        for i, t in enumerate(index):
+            assert np.array_equal(im.data[..., i], im_dmri.data[..., t])
+        assert im_mean.data.shape == (2, 3, 4)
+        assert np.allclose(im_mean.data, np.mean([im_dmri.data[..., t] for t in index], axis=0))
+
+
+def test_separate_b0_and_dwi_no_average(im_dmri):
+    im_b0, im_b0_mean, im_dwi, im_dwi_mean = separate_b0_and_dwi(im_dmri, [0, 3], [1, 2, 4, 5], average=False)
+    assert im_b0_mean is None and im_dwi_mean is None
+    assert np.array_equal(im_b0.data, im_dmri.data[..., [0, 3]])
+    assert np.array_equal(im_dwi.data, im_dmri.data[..., [1, 2, 4, 5]])
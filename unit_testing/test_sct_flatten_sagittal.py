@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_flatten_sagittal
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+from skimage import transform
+
+from sct_flatten_sagittal import translate_slices_x
+
+
+def translate_slices_x_skimage(data, translation_x):
+    """Reference: translation of each axial slice with skimage, as sct_flatten_sagittal used to do"""
+    data_out = np.zeros(data.shape)
+    for iz in range(data.shape[2]):
+        tform = transform.SimilarityTransform(translation=(0, translation_x[iz]))
+        data_out[:, :, iz] = transform.warp(data[:, :, iz].astype(np.float64), tform, order=1, mode='constant',
+                                            cval=0)
+    return data_out
+
+
+@pytest.mark.parametrize('translation_x', [
+    [0, 1, -1, 2, -3, 0, 5, -6],  # integer
+    [0.25, -0.25, 1.5, -2.75, 3.1, -0.9, 6.6, -6.6],  # fractional, up to the border of the volume
+    [7.5, -7.5, 8, -8, 12.3, -20, 100, -100.5],  # out of the volume
+])
+def test_translate_slices_x(translation_x):
+    data = np.random.RandomState(0).rand(7, 5, 8) * 100
+    translation_x = np.array(translation_x, dtype=np.float64)
+    data_out = translate_slices_x(data, translation_x)
+    assert data_out.dtype == np.float32
+    assert np.allclose(data_out, translate_slices_x_skimage(data, translation_x), rtol=1e-5, atol=1e-4)
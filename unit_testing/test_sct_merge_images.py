@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_merge_images
+
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+
+import sct_utils as sct
+from spinalcordtoolbox.image import Image
+import sct_merge_images
+from sct_merge_images import Param, merge_images, warp_with_partial_volume
+
+
+def make_image(data, affine=np.eye(4)):
+    return Image(data, hdr=nib.Nifti1Image(data, affine).header)
+
+
+def save_image(data, fname):
+    make_image(data).save(fname, verbose=0)
+    return fname
+
+
+def get_warp(displacement_z):
+    """Constant ITK displacement field along z, on the grid of the sources"""
+    data_warp = np.zeros((2, 2, 10, 1, 3))
+    data_warp[..., 2] = displacement_z
+    return data_warp
+
+
+@pytest.fixture()
+def sources():
+    """Two sources along z which overlap on slices 3 and 4"""
+    data1 = np.zeros((2, 2, 10))
+    data1[:, :, :5] = 2
+    data2 = np.zeros((2, 2, 10))
+    data2[:, :, 3:] = 4
+    return make_image(data1), make_image(data2)
+
+
+def test_warp_with_partial_volume_identity(sources):
+    param = Param()
+    im_dest = make_image(np.zeros((2, 2, 10)))
+    im_warp = make_image(get_warp(0))
+    for im_src in sources:
+        data, partial_volume = warp_with_partial_volume(im_src, im_warp, im_dest, param)
+        assert np.allclose(data, im_src.data)
+        assert np.array_equal(partial_volume, im_src.data > 0)
+
+
+def test_warp_with_partial_volume_translation(sources):
+    param = Param()
+    im_dest = make_image(np.zeros((2, 2, 10)))
+    # each destination voxel is sampled 0.5 mm further along z in the sources (z is the same in RAS and LPS)
+    im_warp = make_image(get_warp(0.5))
+    for im_src in sources:
+        data, partial_volume = warp_with_partial_volume(im_src, im_warp, im_dest, param)
+        # linear interpolation between slices z and z + 1. The last slice is sampled outside of the source: 0
+        d = im_src.data[0, 0]
+        assert np.allclose(data[0, 0], np.append((d[:-1] + d[1:]) / 2., 0))
+        assert np.allclose(partial_volume[0, 0], np.append(((d[:-1] > 0) * 1. + (d[1:] > 0)) / 2., 0))
+
+
+@pytest.mark.parametrize('displacement_z,expected', [
+    # average of both sources where they overlap
+    (0, [2, 2, 2, 3, 3, 4, 4, 4, 4, 4]),
+    # e.g. slice 2: source 1 is 2 with a partial volume of 1, source 2 is 2 with a partial volume of 0.5, so
+    # (2 * 1 + 2 * 0.5) / 1.5. The last slice is sampled outside of the sources: 0
+    (0.5, [2, 2, 2, 3, 3, 4, 4, 4, 4, 0]),
+])
+def test_merge_images(tmpdir, monkeypatch, sources, displacement_z, expected):
+    list_fname_src = [save_image(im.data, str(tmpdir.join('src{}.nii.gz'.format(i)))) for i, im in enumerate(sources)]
+    fname_warp = save_image(get_warp(displacement_z), str(tmpdir.join('warp.nii.gz')))
+    fname_dest = save_image(np.zeros((2, 2, 10)), str(tmpdir.join('dest.nii.gz')))
+    param = Param()
+    param.fname_out = str(tmpdir.join('merged.nii.gz'))
+    param.verbose = 0
+
+    # displacement fields are applied in-process: no temporary folder
+    def tmp_create(*args, **kwargs):
+        raise AssertionError('No temporary folder expected')
+    monkeypatch.setattr(sct, 'tmp_create', tmp_create)
+
+    merge_images(list_fname_src, fname_dest, [fname_warp, fname_warp], param)
+    data_merged = nib.load(param.fname_out).get_fdata()
+    assert data_merged.shape == (2, 2, 10)
+    assert np.allclose(data_merged[0, 0], expected)
+    assert np.allclose(data_merged, data_merged[0, 0])
+
+
+@pytest.mark.parametrize('rm_tmp', [True, False])
+def test_merge_images_apply_transfo(tmpdir, monkeypatch, sources, rm_tmp):
+    """Transformations which are not displacement fields (e.g. affine) go through sct_apply_transfo, in a temporary
+    folder removed at the end"""
+    list_fname_src = [save_image(im.data, str(tmpdir.join('src{}.nii.gz'.format(i)))) for i, im in enumerate(sources)]
+    fname_warp = save_image(get_warp(0), str(tmpdir.join('warp.nii.gz')))
+    fname_affine = str(tmpdir.join('affine.txt'))
+    fname_dest = save_image(np.zeros((2, 2, 10)), str(tmpdir.join('dest.nii.gz')))
+    param = Param()
+    param.fname_out = str(tmpdir.join('merged.nii.gz'))
+    param.rm_tmp = rm_tmp
+    param.verbose = 0
+
+    path_tmp = str(tmpdir.mkdir('tmp'))
+    monkeypatch.setattr(sct, 'tmp_create', lambda *args, **kwargs: path_tmp)
+    calls = []
+
+    def apply_transfo_with_partial_volume(fname_src, fname_warp, fname_dest, prefix_tmp, param):
+        # identity transformation, with a temporary file as sct_apply_transfo would write
+        calls.append((fname_src, fname_warp))
+        assert os.path.dirname(prefix_tmp) == path_tmp
+        open(prefix_tmp + '_template.nii.gz', 'w').close()
+        data = nib.load(fname_src).get_fdata()
+        return data, (data > param.almost_zero) * 1.
+    monkeypatch.setattr(sct_merge_images, 'apply_transfo_with_partial_volume', apply_transfo_with_partial_volume)
+
+    merge_images(list_fname_src, fname_dest, [fname_warp, fname_affine], param)
+    assert calls == [(list_fname_src[1], fname_affine)]
+    assert np.allclose(nib.load(param.fname_out).get_fdata()[0, 0], [2, 2, 2, 3, 3, 4, 4, 4, 4, 4])
+    assert os.path.isdir(path_tmp) != rm_tmp
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_straighten_spinalcord
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+
+from msct_types import Centerline
+from sct_straighten_spinalcord import trim_lookup_table, compute_warping_field
+
+
+def trim_lookup_table_loop(lookup):
+    """Reference trimming of the lookup tables, as done point by point by the straightener"""
+    lookup = list(lookup)
+    for p in range(0, len(lookup) // 2):
+        if lookup[p] == lookup[p + 1]:
+            lookup[p] = 0
+        else:
+            break
+    for p in range(len(lookup) - 1, len(lookup) // 2, -1):
+        if lookup[p] == lookup[p - 1]:
+            lookup[p] = 0
+        else:
+            break
+    return np.array(lookup)
+
+
+def compute_warping_field_loop(shape, affine, centerline_src, centerline_dest, lookup, threshold_distance, rotate):
+    """Reference warping field, computed slice by slice on all the voxels of the grid, in float64"""
+    nx, ny, nz = shape
+    data_warp = np.zeros((nx, ny, nz, 1, 3))
+    for u in range(nz):
+        x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
+        indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
+        physical_coordinates = np.array([np.dot(affine, list(index) + [1])[:3] for index in indexes])
+        nearest_indexes = centerline_src.find_nearest_indexes(physical_coordinates)
+        distances = centerline_src.get_distances_from_planes(physical_coordinates, nearest_indexes)
+        lookup_nearest = lookup[nearest_indexes]
+        indexes_out_distance = np.logical_or(np.logical_or(distances > threshold_distance,
+                                                           distances < -threshold_distance), lookup_nearest == 0)
+        projected_points = centerline_src.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+        coord_in_planes = centerline_src.get_in_plans_coordinates(projected_points, nearest_indexes)
+        if rotate:
+            coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup_nearest)
+        else:
+            coord_dest = centerline_dest.points[lookup_nearest]
+            coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+            coord_dest[:, 2] += distances
+        displacements = coord_dest - physical_coordinates
+        displacements[:, 2] = -displacements[:, 2]
+        displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+        data_warp[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements
+    return data_warp
+
+
+@pytest.fixture(scope='module')
+def centerlines():
+    """Curved centerline (S-shape in x, oblique in y) and the corresponding straight centerline"""
+    z = np.linspace(-5., 25., 61)
+    x = 4 * np.sin(z / 6.)
+    y = 0.2 * z
+    centerline_curved = Centerline(x, y, z, 4 / 6. * np.cos(z / 6.), 0.2 * np.ones_like(z), np.ones_like(z))
+    length = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(centerline_curved.points, axis=0), axis=1))))
+    z_straight = length - 5.
+    zeros = np.zeros_like(z_straight)
+    centerline_straight = Centerline(zeros, zeros, z_straight, zeros, zeros, np.ones_like(z_straight))
+    return centerline_curved, centerline_straight
+
+
+@pytest.mark.parametrize('lookup', [
+    [3, 3, 3, 4, 5, 6, 7, 7],
+    [1, 2, 3, 4, 5, 6, 7, 8, 9],
+    [5, 5, 5, 5, 5, 5, 5],
+    [0, 1, 2, 2, 2, 2, 2, 2, 2, 2],
+    [2, 2],
+    [4],
+])
+def test_trim_lookup_table(lookup):
+    assert np.array_equal(trim_lookup_table(lookup), trim_lookup_table_loop(lookup))
+
+
+@pytest.mark.parametrize('rotate', [True, False])
+def test_compute_warping_field(centerlines, rotate):
+    centerline_curved, centerline_straight = centerlines
+    if rotate:
+        # straight -> curved: field defined on the grid of the straight image
+        centerline_src, centerline_dest = centerline_straight, centerline_curved
+    else:
+        centerline_src, centerline_dest = centerline_curved, centerline_straight
+    # the first and last points are excluded, as done by trim_lookup_table
+    lookup = np.arange(centerline_src.number_of_points)
+    lookup[:3] = 0
+    lookup[-3:] = 0
+    shape = (9, 8, 14)
+    affine = np.array([[1.2, 0, 0, -6], [0, 0.9, 0, -3], [0, 0, 2.5, -8], [0, 0, 0, 1]])
+    threshold_distance = 2.
+
+    data_warp = compute_warping_field(shape, affine, centerline_src, centerline_dest, lookup, threshold_distance,
+                                      rotate=rotate, nb_voxels_slab=200, verbose=0)
+    data_ref = compute_warping_field_loop(shape, affine, centerline_src, centerline_dest, lookup, threshold_distance,
+                                          rotate)
+    assert data_warp.dtype == np.float32
+    assert data_warp.shape == shape + (1, 3)
+    assert np.allclose(data_warp, data_ref, rtol=0, atol=1e-4)
+    # voxels out of the band (or mapped on excluded points) are filled with -100000, and the others are not
+    out_band = np.all(data_ref == -100000.0, axis=-1)
+    assert out_band.any() and not out_band.all()
+    assert np.array_equal(np.all(data_warp == -100000.0, axis=-1), out_band)
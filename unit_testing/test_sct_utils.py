@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_utils
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import sys
+import threading
+
+import pytest
+
+import sct_utils as sct
+
+
+def test_get_in_process_args():
+    assert sct._get_in_process_args(['sct_maths', '-i', 'a b.nii'], None) == ['sct_maths', '-i', 'a b.nii']
+    assert sct._get_in_process_args('sct_maths -i "a b.nii"', None) == ['sct_maths', '-i', 'a b.nii']
+    # binaries, shell constructs and custom environments are left to a subprocess
+    assert sct._get_in_process_args(['isct_antsRegistration', '-h'], None) is None
+    assert sct._get_in_process_args('sct_maths -i *.nii', None) is None
+    assert sct._get_in_process_args('sct_maths -h > usage.txt', None) is None
+    env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS='1')
+    assert sct._get_in_process_args(['sct_maths', '-h'], env) is None
+    # only the main thread can dispatch in-process
+    result = []
+    thread = threading.Thread(target=lambda: result.append(sct._get_in_process_args(['sct_maths', '-h'], None)))
+    thread.start()
+    thread.join()
+    assert result == [None]
+
+
+def test_run_in_process(tmpdir):
+    argv, cwd, handlers = sys.argv[:], os.getcwd(), sct.log.handlers[:]
+    status, output = sct.run(['sct_maths', '-h'], verbose=0, cwd=str(tmpdir))
+    assert status == 0
+    assert 'sct_maths' in output
+    # the state of the caller is restored
+    assert sys.argv == argv
+    assert os.getcwd() == cwd
+    assert sct.log.handlers == handlers
+
+
+def test_run_in_process_error():
+    with pytest.raises(sct.RunError):
+        sct.run(['sct_maths', '-i'], verbose=0)
+    status, output = sct.run(['sct_maths', '-i'], verbose=0, raise_exception=False)
+    assert status != 0
+    assert 'needs an argument' in output
+
+
+def test_run_subprocess():
+    status, output = sct.run('echo "sct_maths" | cat', verbose=0)
+    assert (status, output) == (0, 'sct_maths')
+
+
+def test_run_subprocess_output(tmpdir):
+    cmd = 'for i in 1 2 3 4 5; do echo "line $i"; done; echo error >&2; exit 3'
+    status, output = sct.run(cmd, verbose=0, raise_exception=False)
+    assert status == 3
+    assert output.split('\n') == ['line 1', 'line 2', 'line 3', 'line 4', 'line 5', 'error']
+    # ring buffer
+    assert sct.run(cmd, verbose=0, raise_exception=False, max_output_lines=2)[1] == 'line 5\nerror'
+    # output written to a file, without going through Python
+    fname = str(tmpdir.join('log.txt'))
+    assert sct.run(cmd, verbose=0, raise_exception=False, output_file=fname, capture_output=False) == (3, '')
+    assert open(fname).read().split('\n')[-2:] == ['error', '']
+    assert sct.run(cmd, verbose=0, raise_exception=False, output_file=fname, max_output_lines=1)[1] == 'error'
+
+
+def test_run_timeout():
+    status, output = sct.run('echo start; sleep 10; echo end', verbose=0, raise_exception=False, timeout=0.5)
+    assert status != 0
+    assert sct.last_run_stats['wall_time'] < 5
+    assert output.startswith('start') and 'timed out' in output
+
+
+def test_run_stats(tmpdir, monkeypatch):
+    fname_stats = str(tmpdir.join('stats.jsonl'))
+    monkeypatch.setenv('SCT_RUN_STATS', fname_stats)
+    sct.run([sys.executable, '-c', 'x = bytearray(50 * 1024 ** 2); sum(range(10 ** 6))'], verbose=0)
+    stats = sct.last_run_stats
+    assert stats['status'] == 0 and not stats['in_process']
+    assert stats['max_rss'] > 50
+    assert stats['cpu_time'] > 0 and stats['wall_time'] > 0
+    import json
+    assert [json.loads(line) for line in open(fname_stats)] == [stats]
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.trace
+
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox import trace
+from spinalcordtoolbox.image import Image
+
+
+@pytest.fixture()
+def trace_folder(tmpdir, monkeypatch):
+    folder = str(tmpdir.join('trace'))
+    monkeypatch.setenv(trace.ENV_TRACE, folder)
+    trace.reset()
+    yield folder
+    trace.reset()
+
+
+@trace.traced()
+def _square(x):
+    return x ** 2
+
+
+def _get_events(data, phase='X'):
+    return [e for e in data['traceEvents'] if e['ph'] == phase]
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.delenv(trace.ENV_TRACE, raising=False)
+    trace.reset()
+    with trace.stage('stage') as args:
+        assert args is None
+    assert _square(3) == 9
+    assert trace.export() is None
+    assert len(_get_events(trace.get_trace())) == 1  # only the process
+
+
+def test_nested_stages(trace_folder):
+    with trace.stage('outer', subject='sub-01') as args:
+        assert _square(3) == 9
+        args['nb_slices'] = 10
+    events = dict([(e['name'], e) for e in _get_events(trace.get_trace())])
+    assert events['outer']['args'] == {'subject': 'sub-01', 'nb_slices': 10}
+    # the inner stage is within the outer one
+    assert events['outer']['ts'] <= events['_square']['ts']
+    assert events['_square']['ts'] + events['_square']['dur'] <= events['outer']['ts'] + events['outer']['dur']
+    fname = trace.export()
+    assert os.path.dirname(fname) == trace_folder
+    assert len(_get_events(json.load(open(fname)))) == 3
+
+
+def test_image_save(trace_folder, tmpdir):
+    fname = str(tmpdir.join('img.nii.gz'))
+    data = np.random.RandomState(0).rand(10, 10, 10)
+    Image(data, hdr=nib.Nifti1Image(data, np.eye(4)).header).save(fname)
+    events = _get_events(trace.get_trace())
+    size = os.path.getsize(fname)
+    assert [(e['name'], e['args']['bytes']) for e in events if e['cat'] == 'io'] == [('Image.save', size)]
+    process = [e for e in events if e['cat'] == 'process'][0]
+    assert process['args']['bytes_written'] == size
+
+
+def test_merge_traces(trace_folder, tmpdir):
+    # trace written at exit by another process
+    subprocess.check_call([sys.executable, '-c', 'from spinalcordtoolbox import trace; trace.add_event("child", 0, 1)'])
+    with trace.stage('parent'):
+        pass
+    trace.export()
+    list_fname = sorted([os.path.join(trace_folder, f) for f in os.listdir(trace_folder)])
+    assert len(list_fname) == 2
+    fname_out = str(tmpdir.join('trace.json'))
+    merged = trace.merge_traces([('sub-01', list_fname), ('sub-02', list_fname[:1])], fname_out)
+    assert json.load(open(fname_out)) == merged
+    names = [e['args']['name'] for e in _get_events(merged, 'M') if e['name'] == 'process_name']
+    assert names == ['sub-01', 'sub-02']
+    events = _get_events(merged)
+    assert set([e['pid'] for e in events]) == set([1, 2])
+    assert set(['child', 'parent']) <= set([e['name'] for e in events if e['pid'] == 1])
+    # processes of a group are displayed as threads
+    assert len(set([e['tid'] for e in events if e['pid'] == 1])) == 2
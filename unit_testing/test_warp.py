@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.warp
+
+from __future__ import absolute_import
+
+import pytest
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import warp
+
+
+def _get_warp(displacement, shape=(10, 12, 14), affine=np.eye(4)):
+    """Constant ITK displacement field (LPS)"""
+    data = np.zeros(shape + (1, 3), dtype=np.float32)
+    data[...] = displacement
+    hdr = nib.Nifti1Image(data, affine).header
+    hdr.set_intent('vector', (), '')
+    return Image(data, hdr=hdr)
+
+
+def test_is_displacement_field():
+    assert warp.is_displacement_field(_get_warp([0, 0, 0]))
+    assert not warp.is_displacement_field(Image(np.zeros((10, 12, 14))))
+
+
+def test_sampling_coordinates_translation():
+    affine_src = np.diag([0.5, 0.5, 0.5, 1])
+    coordinates = warp.get_sampling_coordinates(_get_warp([1, -2, 3]), (10, 12, 14), np.eye(4), affine_src)
+    assert coordinates.shape == (3, 10, 12, 14)
+    # displacement is (-1, 2, 3) mm in RAS, i.e. (-2, 4, 6) voxels of the source
+    assert np.allclose(coordinates[:, 3, 4, 5], [2 * 3 - 2, 2 * 4 + 4, 2 * 5 + 6])
+
+
+def test_sampling_coordinates_interpolated_field():
+    # field defined on a coarser grid than the destination: the displacement is interpolated, zero outside of the field
+    affine_warp = np.diag([2, 2, 2, 1])
+    coordinates = warp.get_sampling_coordinates(_get_warp([1, 0, 0], (4, 4, 4), affine_warp), (10, 10, 10),
+                                                 np.eye(4), np.eye(4))
+    assert np.allclose(coordinates[:, 2, 2, 2], [1, 2, 2])
+    assert np.allclose(coordinates[:, 9, 9, 9], [9, 9, 9])
+
+
+def _save(data, affine, fname):
+    Image(data, hdr=nib.Nifti1Image(data, affine).header).save(fname, verbose=0)
+    return fname
+
+
+@pytest.mark.parametrize('displacement', [[0, 0, 0], [0.25, -1.5, 2]])
+def test_warp_images(tmpdir, monkeypatch, displacement):
+    # destination grid (1 mm), and a source grid of 0.5 mm shared by two files
+    shape_dest, affine_dest = (8, 9, 10), np.eye(4)
+    shape_fine, affine_fine = (20, 22, 24), np.array([[0.5, 0, 0, -1], [0, 0.5, 0, -1], [0, 0, 0.5, -1], [0, 0, 0, 1]])
+    rs = np.random.RandomState(0)
+    fname_dest = _save(np.zeros(shape_dest, dtype=np.float32), affine_dest, str(tmpdir.join('dest.nii.gz')))
+    # labels on the destination grid and on the fine grid (nearest neighbour), and a ramp along x in mm (linear)
+    ramp = (-1 + 0.5 * np.arange(shape_fine[0]))[:, None, None] * np.ones(shape_fine)
+    list_src = [(rs.randint(0, 6, shape_dest).astype(np.float32), affine_dest, 'NearestNeighbor'),
+                (ramp.astype(np.float32), affine_fine, 'Linear'),
+                (rs.randint(0, 6, shape_fine).astype(np.float32), affine_fine, 'NearestNeighbor')]
+    list_fname_src = [_save(data, affine, str(tmpdir.join('src{}.nii.gz'.format(i))))
+                      for i, (data, affine, interp) in enumerate(list_src)]
+    list_fname_out = [str(tmpdir.join('out{}.nii.gz'.format(i))) for i in range(len(list_src))]
+
+    # sampling coordinates are computed once per source grid
+    list_grids = []
+
+    def get_sampling_coordinates(im_warp, shape, affine, affine_src):
+        list_grids.append(affine_src)
+        return get_sampling_coordinates_orig(im_warp, shape, affine, affine_src)
+    get_sampling_coordinates_orig = warp.get_sampling_coordinates
+    monkeypatch.setattr(warp, 'get_sampling_coordinates', get_sampling_coordinates)
+
+    assert warp.warp_images(list_fname_src, list_fname_out, [interp for _, _, interp in list_src], fname_dest,
+                            _get_warp(displacement, shape_dest, affine_dest), nb_workers=2, verbose=0) == \
+        list_fname_out
+    assert len(list_grids) == 2
+
+    # reference: physical position of each destination voxel, moved by the displacement (LPS -> RAS)
+    physical = np.indices(shape_dest, dtype=np.float64).reshape(3, -1) + \
+        np.array([-displacement[0], -displacement[1], displacement[2]])[:, None]
+    for (data, affine, interp), fname_out in zip(list_src, list_fname_out):
+        im_out = nib.load(fname_out)
+        assert im_out.get_data_dtype() == np.float32
+        assert im_out.shape == shape_dest
+        assert np.allclose(im_out.affine, affine_dest)
+        data_out = np.asarray(im_out.dataobj)
+        m_p2f = np.linalg.inv(affine)
+        coordinates = (np.dot(m_p2f[:3, :3], physical) + m_p2f[:3, 3:]).reshape((3,) + shape_dest)
+        expected = map_coordinates(data, coordinates, order=warp.DICT_ORDER[interp], mode='constant', cval=0.)
+        assert np.allclose(data_out, expected, atol=1e-5)
+        inside = np.all([(c >= 0) & (c <= n - 1) for c, n in zip(coordinates, data.shape)], axis=0)
+        if interp == 'NearestNeighbor':
+            # labels are not blended
+            assert set(np.unique(data_out)) <= set(np.unique(data))
+        else:
+            # linear interpolation of the ramp is exact: x of the sampled position, in mm
+            assert np.allclose(data_out[inside], physical[0].reshape(shape_dest)[inside], atol=1e-5)